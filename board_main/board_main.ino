@@ -27,22 +27,67 @@ const char* sensorCharacteristicUuid = "925486c0-bcbc-11ed-a901-0800200c9a66";
 const char* loggingCharacteristicUuid = "997fda80-bcbc-11ed-a901-0800200c9a66";
 const char* logsCharacteristicUuid = "c78725f0-bcbc-11ed-a901-0800200c9a66";
 const char* endCharacteristicUuid = "493a8bb0-bccb-11ed-a901-0800200c9a66";
+const char* batchCharacteristicUuid = "b1f0e7a0-bcbc-11ed-a901-0800200c9a66";
 
 const char* peripheralName = "SWEATsens";
 
-typedef struct btOut_type{
-  unsigned long timeOut;
-  uint16_t voltOut;
-};
-
-const int union_size = sizeof(btOut_type);
-
-typedef union btPacketOut{
- btOut_type structure;
- byte byteArray[union_size]; /* you can use other variable types if you want. Like: a 32bit integer if you have 4 8bit variables in your struct */
-};
-
-btPacketOut packet;  
+// batched BLE notification, several samples per logsCharacteristic value
+// layout is sequence number (2) + sample count (1) + millis of the first sample (4),
+// then per sample the ms since the previous sample (2) + voltage (2), little endian
+// this must match frames.py in the python app
+const int batchHeaderSize = 7;
+const int batchSampleSize = 4;
+const int minBatchSamples = 3;  // fits the default 23 byte MTU
+const int maxBatchSamples = 59; // fits a 247 byte MTU, 7 + 59 * 4 bytes of its 244
+const unsigned long batchTimeout = 100; // ms before a partial batch is sent anyway
+byte batchPacket[batchHeaderSize + maxBatchSamples * batchSampleSize];
+
+// the central sets the batch size from the MTU it negotiated
+int batchSamples = minBatchSamples;
+int batchCount = 0;
+uint16_t batchSeq = 0;
+unsigned long batchFirstMillis = 0;
+unsigned long batchLastMillis = 0;
+
+// binary serial frame, millis and voltage with a sync word and checksum
+// layout is sync (2) + millis (4) + voltage (2) + checksum (1), little endian
+// this must match frames.py in the python app
+const uint16_t frameSync = 0xA55A;
+const int frameSize = 9;
+byte serialFrame[frameSize];
+
+// serial output formats, 0 prints "millis,value" lines and 1 writes binary frames
+const int asciiFormat = 0;
+const int binaryFormat = 1;
+
+// serial commands are "func,val" or "func,val,id" lines
+// a command with an id is acknowledged with an "ack,id,func" line, or in binary mode with
+// a frame laid out like writeFrame with ackSync, the id in place of millis and func in
+// place of the voltage, this must match frames.py in the python app
+// a command also ends after commandTimeout ms without a byte, for hosts that send no newline
+const uint16_t ackSync = 0xA55B;
+const int commandSize = 48;
+const unsigned long commandTimeout = 50;
+char commandBuffer[commandSize];
+int commandLength = 0;
+unsigned long lastCommandByte = 0;
+
+// serial link rate, the host starts at safeBaud and moves up one rate at a time
+// "6,baud" switches after the acknowledgement has gone out, and goes back to the rate
+// before unless "6,baud" arrives again at the new rate within baudConfirm ms, so a rate
+// the link can not carry is never kept
+// "7,n" sends n test frames (frame i has millis i and voltage testValue(i)) and then an
+// ack frame, whatever the output format, so the host can count what arrives intact
+// the rate only matters on a UART, the native USB port runs at full speed at any rate
+// this must match link.py in the python app
+const unsigned long safeBaud = 9600;
+const unsigned long baudConfirm = 2000;
+const unsigned long maxTestFrames = 4096;
+unsigned long serialBaud = safeBaud;
+unsigned long previousBaud = safeBaud;
+unsigned long nextBaud = 0;
+unsigned long baudChangedAt = 0;
+bool baudConfirmed = true;
 
 // set a unique service ID for communication to the app
 BLEService sweatService(deviceServiceUuid);
@@ -53,8 +98,9 @@ BLEByteCharacteristic testingCharacteristic(testingCharacteristicUuid, BLERead |
 BLEByteCharacteristic stimulationCharacteristic(stimulationCharacteristicUuid, BLERead | BLEWrite);
 BLEByteCharacteristic sensorCharacteristic(sensorCharacteristicUuid, BLERead | BLEWrite);
 BLEByteCharacteristic loggingCharacteristic(loggingCharacteristicUuid, BLERead | BLEWrite);
-BLECharacteristic logsCharacteristic(logsCharacteristicUuid, BLERead | BLEWrite | BLENotify, sizeof packet.byteArray, false);
+BLECharacteristic logsCharacteristic(logsCharacteristicUuid, BLERead | BLEWrite | BLENotify, sizeof batchPacket, false);
 BLEByteCharacteristic endCharacteristic(endCharacteristicUuid, BLERead | BLEWrite);
+BLEByteCharacteristic batchCharacteristic(batchCharacteristicUuid, BLERead | BLEWrite);
 
 // define pins
 const int ledPin = LED_BUILTIN; // pin to use for the LED
@@ -93,6 +139,7 @@ unsigned long previousMillis = 0;
 unsigned long startMillis = 0;
 unsigned long startLogMillis = 0;
 unsigned long interval = 2000;
+int outputFormat = asciiFormat;
 
 
 void startStim(float stimState) {
@@ -223,6 +270,197 @@ void stopSense() {
     digitalWrite(greenPin, HIGH);
 }
 
+void writeFrame(unsigned long timeOut, uint16_t voltOut) {
+  // sample frame
+  writeSyncFrame(frameSync, timeOut, voltOut);
+}
+
+void writeSyncFrame(uint16_t sync, unsigned long timeOut, uint16_t voltOut) {
+  // pack the sync word, time and voltage into the frame
+  serialFrame[0] = sync & 0xFF;
+  serialFrame[1] = sync >> 8;
+  serialFrame[2] = timeOut & 0xFF;
+  serialFrame[3] = (timeOut >> 8) & 0xFF;
+  serialFrame[4] = (timeOut >> 16) & 0xFF;
+  serialFrame[5] = (timeOut >> 24) & 0xFF;
+  serialFrame[6] = voltOut & 0xFF;
+  serialFrame[7] = voltOut >> 8;
+
+  // checksum is the sum of the payload bytes
+  byte check = 0;
+  for (int i = 2; i < 8; i++) {
+    check += serialFrame[i];
+  }
+  serialFrame[8] = check;
+
+  Serial.write(serialFrame, frameSize);
+}
+
+void writeAck(unsigned long id, int func) {
+  // acknowledge a command in the current output format
+  if (outputFormat == binaryFormat) {
+    // same layout as a sample frame with the other sync word
+    writeSyncFrame(ackSync, id, func);
+  } else {
+    Serial.print("ack,");
+    Serial.print(id);
+    Serial.print(',');
+    Serial.println(func);
+  }
+}
+
+uint16_t testValue(unsigned long i) {
+  // voltage of test frame i, every bit changes often
+  return (uint16_t)(i * 0x9E37UL);
+}
+
+void writeTestFrames(unsigned long count, unsigned long id) {
+  // send the test pattern and an ack frame after it
+  count = min(count, maxTestFrames);
+  for (unsigned long i = 0; i < count; i++) {
+    writeSyncFrame(frameSync, i, testValue(i));
+  }
+  writeSyncFrame(ackSync, id, 7);
+}
+
+void setBaud(unsigned long baud) {
+  // the same rate again keeps it, another one is switched to once the ack has gone out
+  if (baud == serialBaud) {
+    baudConfirmed = true;
+  } else if (baud >= safeBaud) {
+    nextBaud = baud;
+  }
+}
+
+void switchBaud() {
+  // change the rate asked for by setBaud, and go back if it is not kept in time
+  if (nextBaud != 0) {
+    Serial.flush();
+    previousBaud = serialBaud;
+    serialBaud = nextBaud;
+    nextBaud = 0;
+    Serial.begin(serialBaud);
+    baudChangedAt = millis();
+    baudConfirmed = false;
+  } else if (!baudConfirmed && millis() - baudChangedAt > baudConfirm) {
+    serialBaud = previousBaud;
+    Serial.begin(serialBaud);
+    baudConfirmed = true;
+  }
+}
+
+void runCommand(char* command) {
+  // split the command into the function, the value and the optional id
+  char* comma = strchr(command, ',');
+  if (comma == NULL) {
+    return;
+  }
+  int func = atoi(command);
+  float val = atof(comma + 1);
+  char* idComma = strchr(comma + 1, ',');
+
+  // update the functions based on the values
+  if (func == 0) {
+    testing = val;
+  } else if (func == 1) {
+    ledState = val;
+  } else if (func == 2) {
+    stimState = val;
+  } else if (func == 3) {
+    loggingState = val;
+    outputFormat = asciiFormat;
+  } else if (func == 4) {
+    sensorState = val;
+  } else if (func == 5) {
+    // same as 3 but the samples are sent as binary frames
+    loggingState = val;
+    outputFormat = binaryFormat;
+  } else if (func == 6) {
+    // the value is too big for a float to hold exactly
+    setBaud(strtoul(comma + 1, NULL, 10));
+  } else if (func == 7) {
+    // the test pattern carries its own ack
+    writeTestFrames(strtoul(comma + 1, NULL, 10), idComma != NULL ? strtoul(idComma + 1, NULL, 10) : 0);
+    return;
+  }
+
+  // acknowledge after the change, so a logging command is answered in its new format
+  if (idComma != NULL) {
+    writeAck(strtoul(idComma + 1, NULL, 10), func);
+  }
+}
+
+void endCommand() {
+  // run the command collected so far and start a new one
+  if (commandLength > 0) {
+    commandBuffer[commandLength] = '\0';
+    runCommand(commandBuffer);
+    commandLength = 0;
+  }
+}
+
+void readCommands() {
+  // collect the bytes that have arrived, a newline ends the command
+  // unlike Serial.readString() this returns straight away
+  while (Serial.available()) {
+    char c = Serial.read();
+    lastCommandByte = millis();
+    if (c == '\n' || c == '\r') {
+      endCommand();
+    } else if (commandLength < commandSize - 1) {
+      commandBuffer[commandLength++] = c;
+    }
+  }
+
+  // older hosts send no newline, their command ends when the bytes stop
+  if (commandLength > 0 && millis() - lastCommandByte > commandTimeout) {
+    endCommand();
+  }
+
+  // a new rate starts after its ack
+  switchBaud();
+}
+
+void sendBatch() {
+  // send the samples held in batchPacket as one notification
+  if (batchCount == 0) {
+    return;
+  }
+
+  // fill in the header, the board is little endian like the layout
+  memcpy(batchPacket, &batchSeq, 2);
+  batchPacket[2] = batchCount;
+  memcpy(batchPacket + 3, &batchFirstMillis, 4);
+
+  logsCharacteristic.writeValue(batchPacket, batchHeaderSize + batchCount * batchSampleSize);
+  batchSeq++;
+  batchCount = 0;
+}
+
+void addToBatch(unsigned long currentMillis, uint16_t value) {
+  // add one sample to the batch and send it once it is full
+
+  // a gap too long for the 16 bit delta starts a new batch
+  if (batchCount > 0 && currentMillis - batchLastMillis > 0xFFFF) {
+    sendBatch();
+  }
+  if (batchCount == 0) {
+    batchFirstMillis = currentMillis;
+    batchLastMillis = currentMillis;
+  }
+
+  uint16_t delta = currentMillis - batchLastMillis;
+  byte* sample = batchPacket + batchHeaderSize + batchCount * batchSampleSize;
+  memcpy(sample, &delta, 2);
+  memcpy(sample + 2, &value, 2);
+  batchLastMillis = currentMillis;
+  batchCount++;
+
+  if (batchCount >= batchSamples) {
+    sendBatch();
+  }
+}
+
 void startLogging(uint16_t loggingState, BLEDevice central) {
 
   ledState = HIGH;
@@ -243,6 +481,11 @@ void startLogging(uint16_t loggingState, BLEDevice central) {
   // get current time
   unsigned long currentMillis = millis();
 
+  // do not hold a partial batch back for long at slow intervals
+  if (batchCount > 0 && currentMillis - batchFirstMillis >= batchTimeout) {
+    sendBatch();
+  }
+
   // check if enough time has passed between readings
   if (currentMillis - previousMillis > interval) {
 
@@ -274,19 +517,22 @@ void startLogging(uint16_t loggingState, BLEDevice central) {
     digitalWrite(csLogADC, HIGH);
 
     // output to serial just in case
-    Serial.println(voltage);
+    // skipped in binary mode so the frames are not interleaved with text
+    if (outputFormat == asciiFormat) {
+      Serial.println(voltage);
+    }
     
     // output if there is a serial connection
     if (central) {
-      // format 
-      packet.structure.timeOut = currentMillis;
-      packet.structure.voltOut = sensorValue;
-
-      logsCharacteristic.writeValue(packet.byteArray, sizeof packet.byteArray);
+      // batched, sent once batchSamples samples are held
+      addToBatch(currentMillis, sensorValue);
     }
 
     // output if there is a serial connection
-    if (Serial) {
+    if (Serial && outputFormat == binaryFormat) {
+      // binary frame
+      writeFrame(currentMillis, sensorValue);
+    } else if (Serial) {
       // format 
       Serial.print(millis());
       Serial.print(',');
@@ -299,6 +545,8 @@ void stopLogging() {
   // only reset to 0 if testing is not happening below
   if (loggingState == 0) {
     // otherwise turn off logging
+    // send what is left of the batch
+    sendBatch();
     startLogMillis = 0;
     previousMillis = 0;
 
@@ -330,7 +578,7 @@ void onBLEDisconnected(BLEDevice central) {
 
 void onSwitchUpdate(BLEDevice central, BLECharacteristic characteristic) {
   
-  if (characteristic.value()) {
+  if (switchCharacteristic.value()) {
     Serial.println("LED on");
     digitalWrite(pwrledPin, HIGH);
     ledState = 1;
@@ -343,7 +591,7 @@ void onSwitchUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
 void onStimUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
-  if (characteristic.value()) {
+  if (stimulationCharacteristic.value()) {
     stimState = 1;
     Serial.println("Stimulation = 1.");
   } else {
@@ -354,7 +602,7 @@ void onStimUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
 void onSenseUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
-  if (characteristic.value()) {
+  if (sensorCharacteristic.value()) {
     sensorState = 1;
     Serial.println("Sensor = 1.");
   } else {
@@ -365,7 +613,7 @@ void onSenseUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
 void onTestingUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
-  if (characteristic.value()) {
+  if (testingCharacteristic.value()) {
     testing = 1;
     Serial.println("Testing = 1.");
   } else {
@@ -374,15 +622,22 @@ void onTestingUpdate(BLEDevice central, BLECharacteristic characteristic) {
   }
 }
 
+void onBatchUpdate(BLEDevice central, BLECharacteristic characteristic) {
+
+  // samples per notification, the central works it out from the negotiated MTU
+  batchSamples = constrain(batchCharacteristic.value(), minBatchSamples, maxBatchSamples);
+  Serial.print("Batch = ");
+  Serial.println(batchSamples);
+}
+
 void onLoggingUpdate(BLEDevice central, BLECharacteristic characteristic) {
 
-  if (characteristic.value()) {
-    loggingState = 1;
-    Serial.println("Logging = 1.");
-  } else {
-    loggingState = 0;
-    Serial.println("Logging = 0.");
-  }
+  // the byte is the logging interval in ms, as with "3,<interval>" over serial
+  // logging runs while it is more than 1
+  // read through the typed characteristic, characteristic.value() is a pointer and always true
+  loggingState = loggingCharacteristic.value();
+  Serial.print("Logging = ");
+  Serial.println(loggingState);
 }
 
 void endUpdate(BLEDevice central, BLECharacteristic characteristic) {
@@ -393,9 +648,11 @@ void endUpdate(BLEDevice central, BLECharacteristic characteristic) {
   stimulationCharacteristic.writeValue(0);
   sensorCharacteristic.writeValue(0);
   loggingCharacteristic.writeValue(0);
-  packet.structure.timeOut = 0;
-  packet.structure.voltOut = 0;
-  logsCharacteristic.writeValue(packet.byteArray, sizeof packet.byteArray);
+  batchCharacteristic.writeValue(minBatchSamples);
+  batchSamples = minBatchSamples;
+  batchCount = 0;
+  memset(batchPacket, 0, batchHeaderSize);
+  logsCharacteristic.writeValue(batchPacket, batchHeaderSize);
 
   onBLEDisconnected(central);
   central.disconnect();
@@ -406,7 +663,7 @@ void endUpdate(BLEDevice central, BLECharacteristic characteristic) {
 void setup() {
 
   // set baud rate for serial communication
-  Serial.begin(9600);
+  Serial.begin(safeBaud);
 
   // this waits for serial connnection
   // while (!Serial);
@@ -447,6 +704,7 @@ void setup() {
   sweatService.addCharacteristic(loggingCharacteristic);
   sweatService.addCharacteristic(logsCharacteristic);
   sweatService.addCharacteristic(endCharacteristic);
+  sweatService.addCharacteristic(batchCharacteristic);
 
   // add service
   BLE.addService(sweatService);
@@ -462,6 +720,7 @@ void setup() {
   sensorCharacteristic.setEventHandler(BLEWritten, onSenseUpdate);
   loggingCharacteristic.setEventHandler(BLEWritten, onLoggingUpdate);
   endCharacteristic.setEventHandler(BLEWritten, endUpdate);
+  batchCharacteristic.setEventHandler(BLEWritten, onBatchUpdate);
 
   // set the initial value for the characeristic
   switchCharacteristic.writeValue(0);
@@ -469,9 +728,11 @@ void setup() {
   stimulationCharacteristic.writeValue(0);
   sensorCharacteristic.writeValue(0);
   loggingCharacteristic.writeValue(0);
-  packet.structure.timeOut = 0;
-  packet.structure.voltOut = 0;
-  logsCharacteristic.writeValue(packet.byteArray, sizeof packet.byteArray);
+  batchCharacteristic.writeValue(minBatchSamples);
+  batchSamples = minBatchSamples;
+  batchCount = 0;
+  memset(batchPacket, 0, batchHeaderSize);
+  logsCharacteristic.writeValue(batchPacket, batchHeaderSize);
 
   // start advertising
   BLE.advertise();
@@ -581,38 +842,9 @@ void loop() {
   }
 
   // if there is a serial run the serial commands
+  // only the bytes already received are read, sampling never waits for a command
   if (Serial) {
-
-    // if there is data
-    if (Serial.available()) {
-
-      // read string until timeou, 1s
-      String teststr = Serial.readString();
-
-      // remove any \r \n whitespace at the end of the String
-      teststr.trim();
-
-      // get the index of the comma
-      int commaInd = teststr.indexOf(',');
-
-      // split the string into the function and value
-      int func = teststr.substring(0,commaInd).toInt();
-      float val = teststr.substring(commaInd+1).toFloat();
-
-      // update the functions based on the values
-      if (func == 0) {
-        testing = val;
-      } else if (func == 1) {
-        ledState = val;
-      } else if (func == 2) {
-        stimState = val;
-      } else if (func == 3) {
-        loggingState = val;
-      } else if (func == 4) {
-        sensorState = val;
-      }
-
-    }
+    readCommands();
 
     // if in testing mode, output a random value every 500ms
     if (testing) {
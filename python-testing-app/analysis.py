@@ -0,0 +1,300 @@
+# analysis.py
+# offline analysis of recorded sessions
+#
+# every routine works on whole numpy arrays and is O(n), there are no python loops over
+# samples, so a 24 hour session at 1 kHz (86 million samples) is processed in seconds
+# - load_session, reads csv, chunk (.swt) and spill (_spill.bin) files
+# - iter_session, reads them block by block
+# - counts_to_volts, raw ADC counts (0 - 4095) to volts (0 - 3.3 V)
+# - resample, onto a uniform time grid
+# - detrend and remove_baseline, take out electrode drift
+# - moving_mean, moving_std, moving_min and moving_max over a window of samples
+# - detect_onsets, the start of sweat responses
+# moving windows are trailing by default, center=True centres them (for offline use,
+# the end is padded with the last value)
+#
+# run "python analysis.py <session files>" to print the onsets found in each file, with
+# --start and --end (minutes) only that part of each session is read (session.SessionReader)
+
+# import statements
+import os
+import sys
+import argparse
+import numpy as np
+import session
+from ringbuffer import SPILL_DTYPE
+
+# the board reads a 12 bit ADC with a 3.3 V reference
+ADC_MAX = 4095
+VREF = 3.3
+
+# dtype of the onsets found by detect_onsets
+ONSET_DTYPE = np.dtype([('index', '<i8'), ('millis', '<f8'), ('amplitude', '<f8')])
+
+
+def load_session(path, start=None, end=None):
+    # this function reads any session file into arrays of times (ms) and values
+    # with start or end (ms) only that part of the session is read
+    if start is not None or end is not None:
+        reader = session.SessionReader(path)
+        millis, values = reader.read_range(-np.inf if start is None else start, np.inf if end is None else end)
+        millis, values = millis.astype(np.int64), values.astype(np.float64)
+        reader.close()
+        return millis, values
+    if path.endswith(".swt"):
+        millis, values = session.SessionFile(path).read()
+    elif path.endswith("_spill.bin"):
+        data = np.fromfile(path, dtype=SPILL_DTYPE)
+        millis, values = data['time'], data['value']
+    else:
+        millis, values = session.read_csv(path)
+    return millis.astype(np.int64), values.astype(np.float64)
+
+
+def iter_session(path, rows=session.CHUNK_SIZE):
+    # this function reads any session file in blocks of times and values
+    # only one block is held at a time, so memory stays flat for any file size
+    if path.endswith(".swt"):
+        f = session.SessionFile(path)
+        for i in range(len(f.index)):
+            millis, values = f.read_chunk(i)
+            yield millis.astype(np.int64), values.astype(np.float64)
+    elif path.endswith("_spill.bin"):
+        if os.path.getsize(path) == 0:
+            return
+        data = np.memmap(path, dtype=SPILL_DTYPE, mode='r')
+        for start in range(0, len(data), rows):
+            block = data[start:start + rows]
+            yield block['time'].astype(np.int64), block['value'].astype(np.float64)
+    else:
+        for millis, values in session.iter_csv(path, rows):
+            yield millis, values
+
+
+def is_counts(values):
+    # this function guesses whether values are raw ADC counts rather than volts
+    # binary frames and chunk sessions carry counts, the old csv logs carry volts
+    return len(values) > 0 and values.max() > VREF and np.all(values == np.round(values))
+
+
+def counts_to_volts(counts, vref=VREF, full_scale=ADC_MAX):
+    # this function converts ADC counts to volts
+    return np.asarray(counts, dtype=np.float64) * (vref / full_scale)
+
+
+def merge_duplicates(millis, values):
+    # this function averages samples that share a timestamp and sorts by time
+    # the board stamps ascii lines with millis(), so fast logging repeats timestamps
+    millis = np.asarray(millis)
+    values = np.asarray(values, dtype=np.float64)
+    if len(millis) == 0:
+        return millis, values
+    if np.any(millis[1:] < millis[:-1]):
+        order = np.argsort(millis, kind='stable')
+        millis = millis[order]
+        values = values[order]
+
+    # start of every run of equal timestamps
+    new = np.empty(len(millis), dtype=bool)
+    new[0] = True
+    np.not_equal(millis[1:], millis[:-1], out=new[1:])
+    starts = np.flatnonzero(new)
+    if len(starts) == len(millis):
+        return millis, values
+    counts = np.diff(np.append(starts, len(millis)))
+    return millis[starts], np.add.reduceat(values, starts) / counts
+
+
+def resample(millis, values, period=1.0, start=None, end=None):
+    # this function interpolates the samples onto a grid every period ms
+    # np.interp walks sorted queries in one pass, so this stays O(n)
+    t, v = merge_duplicates(millis, values)
+    if len(t) == 0:
+        return np.empty(0), np.empty(0)
+    start = t[0] if start is None else start
+    end = t[-1] if end is None else end
+    grid = start + period * np.arange(int(np.floor((end - start) / period)) + 1)
+    return grid, np.interp(grid, t, v)
+
+
+def _center(values, window, fn, edge):
+    # this function runs a trailing window function so its output is centred
+    half = window // 2
+    if half == 0:
+        return fn(values)
+    padded = np.concatenate((values, np.full(half, values[-1] if edge is None else edge)))
+    return fn(padded)[half:]
+
+
+def moving_sum(values, window):
+    # this function returns the trailing sum over window samples
+    total = np.cumsum(values, dtype=np.float64)
+    out = np.empty_like(total)
+    out[:window] = total[:window]
+    np.subtract(total[window:], total[:-window], out=out[window:])
+    return out
+
+
+def moving_mean(values, window, center=False):
+    # this function returns the mean over window samples, shorter at the start
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values.copy()
+
+    def trailing(x):
+        # remove the overall mean first so the running sum keeps its precision
+        offset = x.mean()
+        out = moving_sum(x - offset, window)
+        out /= window
+        head = min(window, len(x))
+        out[:head] *= window / np.arange(1, head + 1)
+        out += offset
+        return out
+
+    if center:
+        return _center(values, window, trailing, None)
+    return trailing(values)
+
+
+def moving_std(values, window, center=False):
+    # this function returns the standard deviation over window samples
+    values = np.asarray(values, dtype=np.float64)
+    mean = moving_mean(values, window, center)
+    square = moving_mean((values - values.mean()) ** 2, window, center)
+    var = square - (mean - values.mean()) ** 2
+    return np.sqrt(np.maximum(var, 0))
+
+
+def _moving_extreme(values, window, ufunc, fill):
+    # van Herk / Gil-Werman, the min or max over a window in O(n) whatever the window
+    # the padded signal is cut into blocks of window samples, every window spans the end of
+    # one block and the start of the next, so it is the extreme of a suffix and a prefix
+    n = len(values)
+    padded = np.concatenate((np.full(window - 1, fill), values))
+    blocks = -(-len(padded) // window)
+    padded = np.concatenate((padded, np.full(blocks * window - len(padded), fill))).reshape(blocks, window)
+    prefix = ufunc.accumulate(padded, axis=1).ravel()
+    suffix = ufunc.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+    return ufunc(suffix[:n], prefix[window - 1:window - 1 + n])
+
+
+def moving_min(values, window, center=False):
+    # this function returns the minimum over window samples
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values.copy()
+    fn = lambda x: _moving_extreme(x, window, np.minimum, np.inf)
+    if center:
+        return _center(values, window, fn, np.inf)
+    return fn(values)
+
+
+def moving_max(values, window, center=False):
+    # this function returns the maximum over window samples
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values.copy()
+    fn = lambda x: _moving_extreme(x, window, np.maximum, -np.inf)
+    if center:
+        return _center(values, window, fn, -np.inf)
+    return fn(values)
+
+
+def detrend(millis, values):
+    # this function removes the straight line that best fits the values
+    t = np.asarray(millis, dtype=np.float64)
+    v = np.asarray(values, dtype=np.float64)
+    if len(v) < 2:
+        return v - v.mean() if len(v) else v.copy()
+    tm = t.mean()
+    vm = v.mean()
+    slope = np.dot(t - tm, v - vm) / max(np.dot(t - tm, t - tm), 1e-12)
+    return v - vm - slope * (t - tm)
+
+
+def remove_baseline(values, window):
+    # this function removes slow electrode drift
+    # the baseline is the lower envelope over window samples, smoothed by a moving mean,
+    # so sweat responses (rises above the baseline) are kept
+    base = moving_mean(moving_min(values, window, center=True), window, center=True)
+    return np.asarray(values, dtype=np.float64) - base
+
+
+def detect_onsets(millis, values, smooth=1000.0, k=8.0, min_gap=10000.0, span=30000.0, min_amplitude=0.0):
+    # this function finds the start of sweat responses, where the signal rises much faster
+    # than its noise, returns an ONSET_DTYPE array, the times below are in ms
+    # - smooth, the rise is measured between moving means this far apart
+    # - k, threshold on the rise in robust standard deviations of the rise
+    # - min_gap, an onset has to be this long after the previous rise to count
+    # - span, time after the onset searched for the peak that sets the amplitude
+    millis = np.asarray(millis)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 3:
+        return np.empty(0, dtype=ONSET_DTYPE)
+
+    # the windows in samples, from the typical sample period
+    period = max(float(np.median(np.diff(millis))), 1e-9)
+    smooth, min_gap, span = [max(int(round(x / period)), 1) for x in (smooth, min_gap, span)]
+
+    s = moving_mean(values, smooth, center=True)
+    slope = np.empty_like(s)
+    slope[smooth:] = s[smooth:] - s[:-smooth]
+    slope[:smooth] = s[:smooth] - s[0]
+
+    # median absolute deviation, np.median selects instead of sorting
+    centre = np.median(slope)
+    noise = 1.4826 * np.median(np.abs(slope - centre))
+    if noise == 0:
+        noise = max(np.abs(slope - centre).mean(), 1e-12)
+
+    # rising edges of the slope going over the threshold, the last window is padded so
+    # it can not be trusted
+    above = slope > centre + k * noise
+    edges = np.flatnonzero(above[1:] & ~above[:-1]) + 1
+    edges = edges[edges < len(s) - smooth]
+    gaps = np.diff(edges, prepend=-min_gap - 1)
+    edges = edges[gaps > min_gap]
+
+    # amplitude, the highest point within span samples after the onset
+    peak = moving_max(s, span)
+    ends = np.minimum(edges + span - 1, len(s) - 1)
+    amplitude = peak[ends] - s[edges]
+    keep = amplitude >= min_amplitude
+
+    out = np.empty(int(keep.sum()), dtype=ONSET_DTYPE)
+    out['index'] = edges[keep]
+    out['millis'] = np.asarray(millis)[edges[keep]]
+    out['amplitude'] = amplitude[keep]
+    return out
+
+
+def main(argv):
+    # print the onsets found in each session given on the command line
+    parser = argparse.ArgumentParser(description="find sweat response onsets in SWEATsens sessions")
+    parser.add_argument("paths", nargs="+", help="session files")
+    parser.add_argument("--start", type=float, default=None, help="only from this many minutes into the session")
+    parser.add_argument("--end", type=float, default=None, help="only up to this many minutes")
+    args = parser.parse_args(argv)
+
+    for path in args.paths:
+        # the minutes count from the first sample of the session
+        start = end = None
+        if args.start is not None or args.end is not None:
+            reader = session.SessionReader(path)
+            first = reader.time_range()[0] or 0
+            reader.close()
+            start = None if args.start is None else first + args.start * 60000
+            end = None if args.end is None else first + args.end * 60000
+        millis, values = load_session(path, start, end)
+        if is_counts(values):
+            values = counts_to_volts(values)
+        grid, volts = resample(millis, values)
+        onsets = detect_onsets(grid, remove_baseline(volts, 60000))
+        print(os.path.basename(path) + ": " + str(len(millis)) + " samples, " + str(len(onsets)) + " onsets")
+        for onset in onsets:
+            print("  %10.1f s  %.3f V" % (onset['millis'] / 1000.0, onset['amplitude']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
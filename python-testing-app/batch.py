@@ -0,0 +1,288 @@
+# batch.py
+# process a whole directory of session logs from the command line
+#
+# every file is read block by block (analysis.iter_session) and passed through a pipeline
+# of steps, each step sees every block in turn and keeps only running totals, so memory
+# stays flat whatever the size of the file
+# the files are spread over a process pool and the results are printed as one table
+#
+# steps
+# - volts, converts raw ADC counts to volts, for the steps after it
+# - stats, samples, duration, rate, min, max, mean, std
+# - gaps, longest gap between samples and how many gaps are longer than gap_ms
+# - onsets, sweat response onsets (analysis.detect_onsets after remove_baseline)
+#
+# run "python batch.py <directories, files or globs>" for the default steps
+# e.g. "python batch.py logs/ --steps volts,stats,onsets --workers 8 --csv summary.csv"
+
+# import statements
+import os
+import sys
+import csv
+import glob
+import argparse
+import concurrent.futures
+import numpy as np
+import analysis
+import session
+
+# file endings of the session files
+SESSION_ENDINGS = (".csv", ".swt", "_spill.bin")
+
+DEFAULT_STEPS = "volts,stats,gaps,onsets"
+
+
+class VoltsStep:
+    # this class converts ADC counts to volts, decided once on the first block
+
+    columns = []
+
+    def __init__(self):
+        self.counts = None
+
+    def feed(self, millis, values):
+        if self.counts is None and len(values):
+            self.counts = analysis.is_counts(values)
+        if self.counts:
+            values = analysis.counts_to_volts(values)
+        return millis, values
+
+    def result(self):
+        return {}
+
+
+class StatsStep:
+    # this class keeps the count, range and moments of the values
+
+    columns = ["samples", "seconds", "rate", "min", "max", "mean", "std"]
+
+    def __init__(self):
+        self.n = 0
+        self.first = None
+        self.last = None
+        self.low = np.inf
+        self.high = -np.inf
+
+        # sums are taken around the first value so they keep their precision
+        self.shift = None
+        self.total = 0.0
+        self.squares = 0.0
+
+    def feed(self, millis, values):
+        if len(values) == 0:
+            return millis, values
+        if self.shift is None:
+            self.shift = float(values[0])
+            self.first = int(millis[0])
+        self.last = int(millis[-1])
+        self.n += len(values)
+        self.low = min(self.low, float(values.min()))
+        self.high = max(self.high, float(values.max()))
+        d = values - self.shift
+        self.total += float(d.sum())
+        self.squares += float(np.dot(d, d))
+        return millis, values
+
+    def result(self):
+        if self.n == 0:
+            return dict.fromkeys(self.columns, "")
+        mean = self.total / self.n
+        seconds = (self.last - self.first) / 1000.0
+        return {
+            "samples": self.n,
+            "seconds": seconds,
+            "rate": self.n / seconds if seconds > 0 else 0.0,
+            "min": self.low,
+            "max": self.high,
+            "mean": self.shift + mean,
+            "std": np.sqrt(max(self.squares / self.n - mean * mean, 0.0)),
+        }
+
+
+class GapsStep:
+    # this class finds the gaps in the recording, e.g. where the board was disconnected
+
+    columns = ["max_gap", "gaps"]
+
+    def __init__(self, gap_ms=1000.0):
+        self.gap_ms = gap_ms
+        self.last = None
+        self.max_gap = 0
+        self.gaps = 0
+
+    def feed(self, millis, values):
+        if len(millis) == 0:
+            return millis, values
+        times = millis if self.last is None else np.concatenate(([self.last], millis))
+        self.last = int(millis[-1])
+        diffs = np.diff(times)
+        if len(diffs):
+            self.max_gap = max(self.max_gap, int(diffs.max()))
+            self.gaps += int((diffs > self.gap_ms).sum())
+        return millis, values
+
+    def result(self):
+        return {"max_gap": self.max_gap / 1000.0, "gaps": self.gaps}
+
+
+class OnsetsStep:
+    # this class finds sweat response onsets block by block
+    # the last overlap ms of every block are kept and put in front of the next one, so
+    # the baseline and the onsets near the edge of a block see enough signal
+
+    columns = ["onsets", "first_onset", "mean_amplitude"]
+
+    def __init__(self, baseline_ms=60000.0, overlap_ms=120000.0, min_gap=10000.0):
+        self.baseline_ms = baseline_ms
+        self.overlap_ms = overlap_ms
+        self.min_gap = min_gap
+        self.tail = (np.empty(0, dtype=np.int64), np.empty(0))
+        self.last_onset = -np.inf
+        self.start = None
+        self.count = 0
+        self.first = None
+        self.amplitude = 0.0
+
+    def feed(self, millis, values):
+        if len(millis) == 0:
+            return millis, values
+        if self.start is None:
+            self.start = int(millis[0])
+        t = np.concatenate((self.tail[0], millis))
+        v = np.concatenate((self.tail[1], values))
+        keep = t > t[-1] - self.overlap_ms
+        self.tail = (t[keep], v[keep])
+        if len(t) < 3:
+            return millis, values
+
+        # the baseline window in samples, from the typical sample period
+        period = max(float(np.median(np.diff(t))), 1e-9)
+        window = max(int(self.baseline_ms / period), 1)
+        onsets = analysis.detect_onsets(t, analysis.remove_baseline(v, window), min_gap=self.min_gap)
+
+        # onsets in the overlap were already counted with the previous block
+        onsets = onsets[onsets['millis'] > self.last_onset + self.min_gap]
+        if len(onsets):
+            self.last_onset = float(onsets['millis'][-1])
+            if self.first is None:
+                self.first = (float(onsets['millis'][0]) - self.start) / 1000.0
+            self.count += len(onsets)
+            self.amplitude += float(onsets['amplitude'].sum())
+        return millis, values
+
+    def result(self):
+        return {
+            "onsets": self.count,
+            "first_onset": "" if self.first is None else self.first,
+            "mean_amplitude": self.amplitude / self.count if self.count else "",
+        }
+
+
+# the steps by name
+STEPS = {
+    "volts": VoltsStep,
+    "stats": StatsStep,
+    "gaps": GapsStep,
+    "onsets": OnsetsStep,
+}
+
+
+def find_sessions(patterns):
+    # this function expands directories and globs into a sorted list of session files
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for path in glob.glob(pattern):
+            if os.path.isfile(path) and path.endswith(SESSION_ENDINGS):
+                paths.append(path)
+    return sorted(set(paths))
+
+
+def process_file(path, steps=DEFAULT_STEPS, rows=session.CHUNK_SIZE):
+    # this function runs the pipeline over one file and returns a row of the summary
+    # it runs in a worker process, so errors are returned as a column instead of raised
+    row = {"file": os.path.basename(path), "error": ""}
+    pipeline = [STEPS[name]() for name in steps.split(",")]
+    try:
+        for millis, values in analysis.iter_session(path, rows):
+            for step in pipeline:
+                millis, values = step.feed(millis, values)
+    except Exception as e:
+        row["error"] = type(e).__name__ + ": " + str(e)
+    for step in pipeline:
+        row.update(step.result())
+    return row
+
+
+def _process(args):
+    return process_file(*args)
+
+
+def run(paths, steps=DEFAULT_STEPS, workers=None, rows=session.CHUNK_SIZE):
+    # this function processes the files on a pool of processes, the rows keep the order of paths
+    # thousands of small files are handed out in chunks to keep the pool overhead down
+    workers = workers or os.cpu_count() or 1
+    jobs = [(path, steps, rows) for path in paths]
+    if workers == 1:
+        return [_process(job) for job in jobs]
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_process, jobs, chunksize=chunksize))
+
+
+def columns_for(steps):
+    # this function returns the summary columns in order for a list of steps
+    columns = ["file"]
+    for name in steps.split(","):
+        columns += STEPS[name].columns
+    return columns + ["error"]
+
+
+def format_table(rows, columns):
+    # this function lays the rows out as an aligned text table
+    def cell(value):
+        if isinstance(value, float):
+            return "%.4g" % value
+        return str(value)
+
+    cells = [[cell(row.get(c, "")) for c in columns] for row in rows]
+    widths = [max([len(c)] + [len(r[i]) for r in cells]) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    for r in cells:
+        lines.append("  ".join(v.ljust(w) for v, w in zip(r, widths)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="process SWEATsens session logs in bulk")
+    parser.add_argument("paths", nargs="+", help="session files, directories or globs")
+    parser.add_argument("--steps", default=DEFAULT_STEPS, help="comma separated steps: " + ", ".join(STEPS))
+    parser.add_argument("--workers", type=int, default=None, help="processes to use, all cores by default")
+    parser.add_argument("--rows", type=int, default=session.CHUNK_SIZE, help="samples read at a time")
+    parser.add_argument("--csv", default=None, help="also write the summary to this csv file")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.steps.split(",") if name not in STEPS]
+    if unknown:
+        parser.error("unknown steps: " + ", ".join(unknown))
+
+    paths = find_sessions(args.paths)
+    if not paths:
+        print("No session files found!")
+        return 1
+
+    rows = run(paths, args.steps, args.workers, args.rows)
+    columns = columns_for(args.steps)
+    print(format_table(rows, columns))
+
+    if args.csv:
+        with open(args.csv, "w", newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1560 @@
+# benchmark.py
+# benchmarks for the host side of the logger
+# run with: python benchmark.py <name>
+# "python benchmark.py suite" is the end to end suite, it writes its results to a json file
+# (--out) and with --baseline <earlier results> exits 1 on a regression
+
+# import statements
+import os
+import sys
+import tty
+import time
+import argparse
+import subprocess
+import tempfile
+import socket
+import csv
+import json
+import resource
+import tracemalloc
+from queue import Queue
+from threading import Thread
+import numpy as np
+import serial
+import serial.tools.list_ports
+import frames
+from ringbuffer import RingBuffer, SPILL_DTYPE
+import session
+from pipeline import Pipeline
+from simulator import BoardSimulator
+from engine import Engine
+from multidevice import MultiLogger
+from simulator import FakeBleClient
+from bluetooth import BleDevice
+import analysis
+import batch
+import fastcsv
+import pyramid
+import timesync
+from commands import LatencyHistogram
+import link
+import metrics
+
+
+def fake_serial(payload):
+    # this function opens a pty backed serial port and writes the payload into it from a thread
+    # returns the host side serial port, the feeding thread and the board side of the pty
+    master, slave = os.openpty()
+
+    # raw mode so the line discipline does not touch the bytes
+    tty.setraw(slave)
+
+    def feed():
+        # write the payload in board sized pieces
+        view = memoryview(payload)
+        for i in range(0, len(view), 4096):
+            os.write(master, view[i:i + 4096])
+
+    ser = serial.Serial(os.ttyname(slave), 9600, timeout=0.2)
+    t = Thread(target=feed, daemon=True)
+    t.start()
+    return ser, t, master
+
+
+def synthetic_samples(n):
+    # this function makes n samples that look like the board output
+    millis = 359452 + np.arange(n, dtype=np.uint32) * 5
+    values = (2048 + 2000 * np.sin(np.arange(n) / 50.0)).astype(np.uint16)
+    return millis, values
+
+
+def read_ascii(ser, n):
+    # the per line path used by logging() in ascii mode
+    count = 0
+    while count < n:
+        ser_bytes = ser.readline()
+        if not ser_bytes:
+            break
+        decoded_bytes = str(ser_bytes[0:len(ser_bytes) - 2].decode("utf-8"))
+        if ',' in decoded_bytes:
+            txt = decoded_bytes.split(',')
+            float(txt[0])
+            float(txt[1])
+            count += 1
+    return count
+
+
+def read_binary(ser, n):
+    # the bulk path used by logging() in binary mode
+    reader = frames.FrameReader(ser)
+    count = 0
+    idle = 0
+    while count < n and idle < 5:
+        samples = reader.read()
+        idle = idle + 1 if len(samples) == 0 else 0
+        count += len(samples)
+    return count
+
+
+def bench_frames(n):
+    # compare the ascii readline path with the binary frame reader
+    millis, values = synthetic_samples(n)
+    ascii_payload = ''.join('%d,%d\r\n' % (t, v) for t, v in zip(millis.tolist(), values.tolist())).encode('utf-8')
+    binary_payload = frames.encode_frames(millis, values)
+
+    for name, payload, reader in (("ascii", ascii_payload, read_ascii), ("binary", binary_payload, read_binary)):
+        ser, t, master = fake_serial(payload)
+        start = time.perf_counter()
+        count = reader(ser, n)
+        elapsed = time.perf_counter() - start
+        ser.close()
+        os.close(master)
+        print("%-8s %9d samples %8.3f s %12.0f samples/s" % (name, count, elapsed, count / elapsed))
+
+
+def bench_ring(n=10 ** 7, capacity=2 ** 22, batch=1000):
+    # memory and latency of the ring buffer against the old pair of queues
+    millis, values = synthetic_samples(batch)
+
+    # the old design, measured on a slice of the run and scaled up
+    q_n = min(n, 1000000)
+    tracemalloc.start()
+    time_q = Queue()
+    val_q = Queue()
+    start = time.perf_counter()
+    for i in range(q_n):
+        time_q.put(float(i))
+        val_q.put(float(i))
+    put_time = time.perf_counter() - start
+    q_mem = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    np.array(list(time_q.queue))
+    np.array(list(val_q.queue))
+    q_plot = time.perf_counter() - start
+    tracemalloc.stop()
+    del time_q, val_q
+    print("queue    %9d samples %8.1f MB %10.3f us/sample  plot copy %8.2f ms"
+          % (q_n, q_mem / 1e6, 1e6 * put_time / q_n, 1e3 * q_plot))
+    print("queue    projected to %d samples: %8.1f MB" % (n, q_mem / 1e6 * n / q_n))
+
+    # the ring buffer with spilling to a temporary file
+    with tempfile.TemporaryDirectory() as tmp:
+        tracemalloc.start()
+        rb = RingBuffer(capacity, os.path.join(tmp, "spill.bin"))
+        lat = np.empty(n // batch)
+        for i in range(n // batch):
+            start = time.perf_counter()
+            rb.append(millis, values)
+            lat[i] = time.perf_counter() - start
+        rb_mem = tracemalloc.get_traced_memory()[1]
+        start = time.perf_counter()
+        x_time, y_val = rb.view()
+        rb_plot = time.perf_counter() - start
+        tracemalloc.stop()
+        rb.close()
+        print("ring     %9d samples %8.1f MB %10.3f us/sample  plot view %8.3f ms  spilled %d"
+              % (rb.total, rb_mem / 1e6, 1e6 * lat.sum() / rb.total, 1e3 * rb_plot, rb.spilled))
+        print("ring     batch append latency p50 %.1f us p99 %.1f us max %.1f us"
+              % tuple(1e6 * np.percentile(lat, [50, 99, 100])))
+
+
+def bench_liveplot(rate=1000, fps=30, hours=(0, 1, 8), frames_per_point=100):
+    # time per redraw of the live plot after sessions of increasing length
+    # the plot is drawn on an off screen canvas so no display is needed
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from liveplot import LivePlot
+
+    per_frame = rate // fps
+    for h in hours:
+        fig = Figure(figsize=(5, 5))
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        rb = RingBuffer(2 ** 20)
+        live = LivePlot(fig, ax, canvas, rb)
+        canvas.draw()
+
+        # bring the session up to length in large untimed batches
+        n = int(h * 3600 * rate)
+        step = 1000000
+        for i in range(0, n, step):
+            m = min(step, n - i)
+            t = (i + np.arange(m)) * (1000.0 / rate)
+            rb.append(t, np.sin(t / 1000.0))
+            live.update()
+
+        # then time frames that each bring one frame worth of new samples
+        times = np.empty(frames_per_point)
+        for k in range(frames_per_point):
+            t = (n + k * per_frame + np.arange(per_frame)) * (1000.0 / rate)
+            rb.append(t, np.sin(t / 1000.0))
+            start = time.perf_counter()
+            live.update()
+            times[k] = time.perf_counter() - start
+
+        print("%2d h  %9d samples  frame p50 %6.2f ms  p99 %6.2f ms  budget %.1f ms  points drawn %d"
+              % (h, rb.total, 1e3 * np.median(times), 1e3 * np.percentile(times, 99), 1e3 / fps,
+                 len(live.band.get_xy())))
+
+
+def bench_session(hours=24, rate=1000):
+    # write, open and read a long session in the chunk format, compared with csv
+    n = int(hours * 3600 * rate)
+    step = 1000000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # csv size and write speed, measured on a slice and scaled up
+        csv_n = min(n, step)
+        millis, values = synthetic_samples(csv_n)
+        writer = session.open_writer(os.path.join(tmp, "s"), session.CSV)
+        start = time.perf_counter()
+        writer.write(millis, values)
+        writer.close()
+        csv_time = (time.perf_counter() - start) * n / csv_n
+        csv_size = os.path.getsize(os.path.join(tmp, "s.csv")) * n / csv_n
+        print("csv      %9d samples  write %8.2f s  size %8.1f MB (projected)" % (n, csv_time, csv_size / 1e6))
+
+        # the chunk format over the whole session
+        writer = session.open_writer(os.path.join(tmp, "s"), session.CHUNK, 'u2')
+        millis, values = synthetic_samples(step)
+        start = time.perf_counter()
+        for i in range(0, n, step):
+            m = min(step, n - i)
+            writer.write(millis[:m].astype(np.int64) + 5 * i, values[:m])
+        writer.close()
+        chunk_time = time.perf_counter() - start
+        chunk_size = os.path.getsize(os.path.join(tmp, "s.swt"))
+
+        start = time.perf_counter()
+        sf = session.SessionFile(os.path.join(tmp, "s.swt"))
+        open_time = time.perf_counter() - start
+        start = time.perf_counter()
+        sf.read_chunk(len(sf.index) // 2)
+        chunk_read = time.perf_counter() - start
+        print("chunk    %9d samples  write %8.2f s  size %8.1f MB (%.1f%% of csv)"
+              % (len(sf), chunk_time, chunk_size / 1e6, 100.0 * chunk_size / csv_size))
+        print("chunk    open %.2f ms  read one chunk %.2f ms" % (1e3 * open_time, 1e3 * chunk_read))
+
+
+class SlowSink:
+    # session writer that stalls on every write, standing in for a slow disk
+
+    def __init__(self, delay, stall_every=20, stall=1.0):
+        self.delay = delay
+        self.stall_every = stall_every
+        self.stall = stall
+        self.writes = 0
+        self.millis = []
+        self.values = []
+
+    def write(self, millis, values):
+        self.writes += 1
+        time.sleep(self.stall if self.writes % self.stall_every == 0 else self.delay)
+        self.millis.append(np.array(millis))
+        self.values.append(np.array(values))
+
+    def close(self):
+        pass
+
+
+def bench_pipeline(n, delay=0.05):
+    # run both serial formats through the pipeline into a slow sink and check nothing is lost
+    millis, values = synthetic_samples(n)
+    ascii_payload = ''.join('%d,%d\r\n' % (t, v) for t, v in zip(millis.tolist(), values.tolist())).encode('utf-8')
+    binary_payload = frames.encode_frames(millis, values)
+
+    for name, payload, fmt in (("ascii", ascii_payload, frames.ASCII), ("binary", binary_payload, frames.BINARY)):
+        ser, t, master = fake_serial(payload)
+        sink = SlowSink(delay)
+        pipe = Pipeline(ser, sink, RingBuffer(2 ** 16), fmt, max_batches=4, max_pending=20000)
+        start = time.perf_counter()
+        pipe.start()
+
+        # wait until every sample has been read, then let the writer drain
+        while pipe.stats.samples_in < n and time.perf_counter() - start < 120:
+            time.sleep(0.01)
+        read_time = time.perf_counter() - start
+        pipe.stop()
+        ser.close()
+        os.close(master)
+
+        out_millis = np.concatenate(sink.millis) if sink.millis else np.empty(0)
+        out_values = np.concatenate(sink.values) if sink.values else np.empty(0)
+        lost = n - len(out_millis)
+        assert lost == 0 and np.array_equal(out_millis, millis) and np.array_equal(out_values, values), \
+            name + ": " + str(lost) + " samples lost"
+
+        s = pipe.stats
+        print("%-8s %9d samples  read %6.2f s  writes %5d  max queue %2d  max pending %7d  waits %d (%.2f s)  lost %d"
+              % (name, s.samples_out, read_time, sink.writes, s.max_depth, s.max_pending, s.waits, s.wait_time, lost))
+
+
+def bench_simulator(rates=(1000, 10000, 50000, 100000), seconds=2.0, baud=4000000):
+    # read from the simulated board at stepped rates and report throughput and latency
+    for fmt, cmd in ((frames.ASCII, b"3,2"), (frames.BINARY, b"5,2")):
+        for rate in rates:
+            sim = BoardSimulator(rate=rate, baud=baud).start()
+            ser = serial.Serial(sim.port, baud, timeout=0.05)
+            ser.write(cmd)
+            reader = frames.FrameReader(ser) if fmt == frames.BINARY else frames.LineReader(ser)
+
+            # skip the start up and time a fixed window
+            time.sleep(0.2)
+            ser.reset_input_buffer()
+            count = 0
+            latency = []
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                if fmt == frames.BINARY:
+                    millis = reader.read()['millis']
+                else:
+                    millis = reader.read()[0]
+                if len(millis):
+                    count += len(millis)
+                    latency.append(sim.millis() - int(millis[-1]))
+            elapsed = time.perf_counter() - start
+            ser.close()
+            sim.stop()
+
+            lat = np.array(latency) if latency else np.zeros(1)
+            print("%-7s target %7d/s  received %9.0f/s  latency p50 %4.0f ms  p99 %4.0f ms"
+                  % ("ascii" if fmt == frames.ASCII else "binary", rate, count / elapsed,
+                     np.percentile(lat, 50), np.percentile(lat, 99)))
+
+
+def bench_engine(devices=4, seconds=3.0):
+    # idle cpu of the engine against the old 100 ms comports() polling thread,
+    # then several logging sessions in one process with a clean shutdown
+    def poll(stop):
+        while not stop:
+            [tuple(p) for p in list(serial.tools.list_ports.comports())]
+            time.sleep(0.1)
+
+    stop = []
+    t = Thread(target=poll, args=(stop,), daemon=True)
+    t.start()
+    start = time.process_time()
+    time.sleep(seconds)
+    print("polling thread  idle cpu %5.1f%%" % (100 * (time.process_time() - start) / seconds))
+    stop.append(1)
+    t.join()
+
+    sims = [BoardSimulator(rate=1000, baud=1000000, command_gap=0.02).start() for _ in range(devices)]
+    engine = Engine().start()
+    devs = [engine.open_device(sim.port, command_gap=0.05) for sim in sims]
+
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    time.sleep(seconds)
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    print("engine %d ports  process cpu %5.1f%% (including the idle simulators)"
+          % (devices, 100 * (end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime) / seconds))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, dev in enumerate(devs):
+            engine.call(dev.start_logging(2, frames.BINARY, session.CHUNK, base=os.path.join(tmp, "s%d" % i))).result()
+        time.sleep(seconds)
+        start = time.perf_counter()
+        engine.shutdown()
+        print("engine %d sessions  shutdown %.1f ms  samples read/written %s"
+              % (devices, 1e3 * (time.perf_counter() - start),
+                 " ".join("%d/%d" % (d.stats.samples_in, d.stats.samples_out) for d in devs)))
+    for sim in sims:
+        sim.stop()
+
+
+def spawn_simulators(count, rate, baud):
+    # this function starts simulated boards in their own processes and returns them with their ports
+    here = os.path.dirname(os.path.abspath(__file__))
+    procs = []
+    ports = []
+    for _ in range(count):
+        proc = subprocess.Popen([sys.executable, "-u", os.path.join(here, "simulator.py"), "--rate", str(rate),
+                                 "--baud", str(baud)], stdout=subprocess.PIPE, text=True)
+        ports.append(proc.stdout.readline().split()[-1])
+        procs.append(proc)
+    return procs, ports
+
+
+def bench_multidevice(counts=(1, 2, 4, 8, 16), rate=2000, seconds=3.0, baud=1000000):
+    # aggregate throughput with more and more simulated boards on one engine
+    for count in counts:
+        procs, ports = spawn_simulators(count, rate, baud)
+        with tempfile.TemporaryDirectory() as tmp:
+            logger = MultiLogger(ports, tmp, command_gap=0.05)
+            logger.start(2, frames.BINARY, session.CHUNK)
+            cpu = resource.getrusage(resource.RUSAGE_SELF)
+            time.sleep(seconds)
+            end = resource.getrusage(resource.RUSAGE_SELF)
+            rates, total = logger.report()
+            logger.stop()
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+        used = end.ru_utime + end.ru_stime - cpu.ru_utime - cpu.ru_stime
+        print("%2d boards  total %8.0f samples/s  per board %6.0f  efficiency %5.1f%%  host cpu %5.1f%%"
+              % (count, total, total / count, 100 * total / (count * rate), 100 * used / seconds))
+
+
+def bench_ble(n, rates=(100, 1000, 5000), mtus=(23, 247), drop=0.01, seconds=3.0):
+    # decode of batched BLE notifications against one btOut_type per notification,
+    # then dropped samples, latency and notification rate with a fake client
+    millis, values = synthetic_samples(n)
+    single = frames.pack_ble(millis, values)
+    start = time.perf_counter()
+    decoded = frames.decode_ble(b''.join(single))
+    decoded['millis'].astype(np.int64), decoded['value'].copy()
+    elapsed = time.perf_counter() - start
+    print("single   decode %10.0f samples/s  %7d notifications" % (n / elapsed, len(single)))
+
+    for mtu in mtus:
+        batched = frames.pack_ble_batches(millis, values, frames.batch_samples(mtu))
+        start = time.perf_counter()
+        frames.decode_ble_batches(b''.join(batched), [len(p) for p in batched])
+        elapsed = time.perf_counter() - start
+        print("mtu %3d  decode %10.0f samples/s  %7d notifications" % (mtu, n / elapsed, len(batched)))
+
+    engine = Engine().start()
+    for mtu in mtus:
+        for rate in rates:
+            client = FakeBleClient(rate, drop, mtu)
+            ble = BleDevice(client=client)
+            with tempfile.TemporaryDirectory() as tmp:
+                engine.call(ble.connect()).result()
+                engine.call(ble.start_logging(2, session.CHUNK, os.path.join(tmp, "ble"))).result()
+                time.sleep(seconds)
+                notifier = client.notifier
+                engine.call(ble.disconnect()).result()
+            s = ble.stats
+            p50, p90, p99 = s.latency_percentiles()
+            print("mtu %3d  %5d/s  received %6d  notifications/s %5.0f  dropped %4d  detected %4d  "
+                  "latency p50 %.1f p90 %.1f p99 %.1f ms"
+                  % (mtu, rate, s.samples, s.notifications / seconds, notifier.dropped, s.dropped, p50, p90, p99))
+    engine.shutdown()
+
+
+def bench_analysis(hours=(1, 4), rate=1000):
+    # offline analysis of a synthetic session, time per stage and the 24 hour estimate
+    for h in hours:
+        n = int(h * 3600 * rate)
+        millis = np.arange(n, dtype=np.int64) * (1000 // rate)
+        counts = np.clip(1000 + 200 * np.sin(millis / 600000.0) + np.random.randint(-20, 21, n), 0, 4095)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.swt")
+            writer = session.ChunkSessionWriter(path, 'u2')
+            writer.write(millis, counts)
+            writer.close()
+            del millis, counts
+
+            times = []
+            start = time.perf_counter()
+            t, v = analysis.load_session(path)
+            times.append(("load", time.perf_counter() - start))
+            steps = [
+                ("volts", lambda: analysis.counts_to_volts(v)),
+                ("resample", lambda: analysis.resample(t, v)),
+                ("baseline", lambda: analysis.remove_baseline(v, 60 * rate)),
+                ("std", lambda: analysis.moving_std(v, rate)),
+                ("onsets", lambda: analysis.detect_onsets(t, v)),
+            ]
+            for name, step in steps:
+                start = time.perf_counter()
+                step()
+                times.append((name, time.perf_counter() - start))
+        total = sum(x[1] for x in times)
+        print("%2d h  %9d samples  %s  total %.2f s  (24 h about %.1f s)" %
+              (h, n, "  ".join("%s %.2f" % x for x in times), total, total * 24 / h))
+
+
+def make_corpus(directory, count, samples=5000, rate=100):
+    # this function writes count synthetic sessions, alternating csv and chunk files
+    for i in range(count):
+        millis = np.arange(samples, dtype=np.int64) * (1000 // rate) + i
+        counts = np.clip(1000 + 200 * np.sin(millis / 60000.0) + np.random.randint(-20, 21, samples), 0, 4095)
+        base = os.path.join(directory, "2023-03-02-17-%02d-%02d_%05d" % (i // 60 % 60, i % 60, i))
+        writer = session.open_writer(base, session.CHUNK if i % 2 else session.CSV, 'u2')
+        writer.write(millis, counts)
+        writer.close()
+
+
+def bench_batch(count=2000, big=2 * 10 ** 7):
+    # batch processing of a synthetic corpus with one process and with all cores,
+    # then peak memory of one large file read in blocks
+    with tempfile.TemporaryDirectory() as tmp:
+        make_corpus(tmp, count)
+        paths = batch.find_sessions([tmp])
+        for workers in sorted({1, max(os.cpu_count() or 1, 2)}):
+            start = time.perf_counter()
+            rows = batch.run(paths, workers=workers)
+            elapsed = time.perf_counter() - start
+            errors = sum(1 for row in rows if row["error"])
+            print("%5d sessions  %2d workers  %6.2f s  %7.0f sessions/s  errors %d" %
+                  (len(paths), workers, elapsed, len(paths) / elapsed, errors))
+
+        path = os.path.join(tmp, "big.swt")
+        writer = session.ChunkSessionWriter(path, 'u2')
+        for start in range(0, big, 10 ** 6):
+            millis = np.arange(start, start + 10 ** 6, dtype=np.int64)
+            writer.write(millis, np.random.randint(0, 4096, len(millis)))
+        writer.close()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        batch.process_file(path, "volts,stats,gaps")
+        elapsed = time.perf_counter() - start
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print("%d samples in one file  %.2f s  peak memory grew %.0f MB" % (big, elapsed, grown / 1024.0))
+
+
+def read_csv_rows(path):
+    # the row by row csv.reader loop the csv logs used to be read with, for comparison
+    millis = []
+    values = []
+    with open(path, newline='', encoding='utf-8', errors='replace') as f:
+        for row in csv.reader(f):
+            try:
+                t = int(float(row[0]))
+                v = float(row[1])
+            except (IndexError, ValueError):
+                continue
+            millis.append(t)
+            values.append(v)
+    return np.array(millis, dtype=np.int64), np.array(values, dtype=np.float64)
+
+
+def make_legacy_csv(path, n, debug_every=10000):
+    # this function writes n rows the way the old logger did, "millis,volts," with \r\n,
+    # debug lines from the firmware every debug_every rows and a partial last line
+    millis = 359452 + np.cumsum(np.random.randint(4, 7, n))
+    volts = np.round(1.2 + np.sin(millis / 60000.0) + np.random.rand(n) * 0.1, 2)
+    debug = ["Connected event\r\n", "LED on\r\n", "1234\r\n"]
+    with open(path, "w", newline='') as f:
+        for start in range(0, n, debug_every):
+            rows = ["%d,%g,\r\n" % x for x in zip(millis[start:start + debug_every].tolist(),
+                                                  volts[start:start + debug_every].tolist())]
+            f.write("".join(rows))
+            f.write(debug[start // debug_every % len(debug)])
+        f.write("%d,1." % (millis[-1] + 5))
+
+
+def bench_csv(n=2 * 10 ** 6):
+    # the csv.reader loop against fastcsv on a legacy log
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "legacy.csv")
+        make_legacy_csv(path, n)
+        size = os.path.getsize(path)
+
+        times = []
+        for name, read in (("csv.reader", lambda: read_csv_rows(path)), ("fastcsv", lambda: fastcsv.load(path))):
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                out = read()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+            print("%-10s  %6.3f s  %6.1f MB/s  %9.0f lines/s" % (name, best, size / best / 1e6, n / best))
+
+        # csv.reader also keeps the partial last line, fastcsv counts it as malformed
+        old_millis, old_values = read_csv_rows(path)
+        millis, values, errors = out
+        same = np.array_equal(millis, old_millis[:-1]) and np.array_equal(values, old_values[:-1])
+        print("speedup %.1fx  samples %d  malformed lines %d  same samples %s" % (times[0] / times[1], len(millis), errors, same))
+
+
+def bench_range(n=2 * 10 ** 6, minutes=1.0):
+    # reading one minute from the middle of a long session, against reading all of it
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, "legacy.csv"), os.path.join(tmp, "session.swt"), os.path.join(tmp, "session_spill.bin")]
+        make_legacy_csv(paths[0], n)
+        millis, values = session.read_csv(paths[0])
+        writer = session.ChunkSessionWriter(paths[1], 'f4')
+        writer.write(millis, values)
+        writer.close()
+        spill = np.empty(len(millis), dtype=SPILL_DTYPE)
+        spill['time'] = millis
+        spill['value'] = values
+        spill.tofile(paths[2])
+        t0 = millis[len(millis) // 2]
+        t1 = t0 + minutes * 60000
+
+        for path in paths:
+            start = time.perf_counter()
+            analysis.load_session(path)
+            full = time.perf_counter() - start
+
+            start = time.perf_counter()
+            reader = session.SessionReader(path)
+            opened = time.perf_counter() - start
+            reader.close()
+            start = time.perf_counter()
+            reader = session.SessionReader(path)
+            reopened = time.perf_counter() - start
+
+            start = time.perf_counter()
+            t, v = reader.read_range(t0, t1)
+            ranged = time.perf_counter() - start
+            reader.close()
+            print("%-18s  whole file %6.3f s  first open %6.3f s  open %7.4f s  %.0f min range %7.4f s  (%d samples)" %
+                  (os.path.basename(path), full, opened, reopened, minutes, ranged, len(t)))
+
+
+def bench_pyramid(hours=(1, 8), rate=1000, width=500, batch=1000):
+    # redraw time of a recorded session at several zoom levels, from the pyramid against
+    # reading the samples in view, and the cost of building the pyramid while logging
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from liveplot import SessionPlot
+
+    # building, in batches the size logging() writes
+    millis, values = synthetic_samples(10 ** 6)
+    with tempfile.TemporaryDirectory() as tmp:
+        builder = pyramid.PyramidBuilder(os.path.join(tmp, "s.lod"))
+        start = time.perf_counter()
+        for i in range(0, len(millis), batch):
+            builder.write(millis[i:i + batch], values[i:i + batch])
+        builder.close()
+        elapsed = time.perf_counter() - start
+    print("build  %.0f ns/sample  %.1f us per batch of %d  (%.1f M samples/s)"
+          % (1e9 * elapsed / len(millis), 1e6 * elapsed * batch / len(millis), batch, len(millis) / elapsed / 1e6))
+
+    for h in hours:
+        n = int(h * 3600 * rate)
+        step = 10 ** 6
+        with tempfile.TemporaryDirectory() as tmp:
+            # a spill file of the session and its pyramid, written a step at a time
+            path = os.path.join(tmp, "s_spill.bin")
+            builder = pyramid.PyramidBuilder(pyramid.lod_path(path))
+            with open(path, "wb") as f:
+                for i in range(0, n, step):
+                    m = min(step, n - i)
+                    spill = np.empty(m, dtype=SPILL_DTYPE)
+                    spill['time'] = (i + np.arange(m)) * (1000.0 / rate)
+                    spill['value'] = np.sin(spill['time'] / 60000.0) + 0.1 * np.sin(spill['time'] / 50.0)
+                    spill.tofile(f)
+                    builder.write(spill['time'], spill['value'])
+            builder.close()
+
+            reader = session.SessionReader(path)
+            levels = pyramid.Pyramid(pyramid.lod_path(path))
+            fig = Figure(figsize=(5, 5))
+            canvas = FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            plots = {"pyramid": SessionPlot(fig, ax, canvas, reader, levels, width),
+                     "samples": SessionPlot(fig, ax, canvas, reader, None, width)}
+
+            # views centred on the middle of the session, from all of it down to 5 s
+            first, last = reader.time_range()
+            middle = (first + last) / 2
+            for span in (last - first, 3600000.0, 60000.0, 5000.0):
+                if span > last - first:
+                    continue
+                t0 = middle - span / 2
+                t1 = middle + span / 2
+                line = "%2d h  view %9.0f s" % (h, span / 1000)
+                for name, plot in plots.items():
+                    times = []
+                    for k in range(5):
+                        start = time.perf_counter()
+                        x, lo, hi = plot.envelope(t0, t1)
+                        times.append(time.perf_counter() - start)
+                    line += "  %s %8.2f ms (%5d buckets)" % (name, 1e3 * np.median(times), len(x))
+                print(line)
+            levels.close()
+            reader.close()
+            del plots
+
+
+def bench_stats(n=10 ** 6, window=1000, batches=(10, 100, 1000, 100000), seconds=3.0):
+    # running statistics on a simulator trace, throughput by batch size, agreement with the
+    # offline moving windows of analysis.py, then live on the engine with a simulated board
+    from simulator import sine_signal
+    from streamstats import StreamStats, Alarm
+
+    millis = np.arange(n, dtype=np.int64)
+    counts = sine_signal(millis)
+    alarms = [Alarm("high", "ewma", high=2.5, hysteresis=0.05), Alarm("falling", "slope", low=-0.4, hysteresis=0.05)]
+    for size in batches:
+        stats = StreamStats(window, alarms=[Alarm(a.name, a.column, a.high, a.low, a.hysteresis) for a in alarms])
+        m = min(n, size * 10000)
+        parts = []
+        events = 0
+        start = time.perf_counter()
+        for i in range(0, m, size):
+            rows, found = stats.feed(millis[i:i + size], counts[i:i + size])
+            parts.append(rows)
+            events += len(found)
+        elapsed = time.perf_counter() - start
+        print("batch %6d  %6.2f M samples/s  %7.1f us per batch  %d alarms"
+              % (size, m / elapsed / 1e6, 1e6 * elapsed * size / m, events))
+
+    # the last run against the offline functions
+    rows = np.concatenate(parts)
+    volts = analysis.counts_to_volts(counts[:len(rows)])
+    print("max difference  mean %.2g  std %.2g  min %.2g  max %.2g" % (
+        np.abs(rows['mean'] - analysis.moving_mean(volts, window)).max(),
+        np.abs(rows['std'] - analysis.moving_std(volts, window)).max(),
+        np.abs(rows['min'] - analysis.moving_min(volts, window)).max(),
+        np.abs(rows['max'] - analysis.moving_max(volts, window)).max()))
+
+    # live, counting what reaches the notify callback
+    sim = BoardSimulator(rate=10000, baud=4000000, command_gap=0.02).start()
+    engine = Engine().start()
+    received = {'stats': 0, 'alarm': 0}
+    dev = engine.open_device(sim.port, command_gap=0.05, monitor=StreamStats(window, alarms=alarms),
+                             notify=lambda d, event, *args: received.__setitem__(event, received.get(event, 0) + 1))
+    with tempfile.TemporaryDirectory() as tmp:
+        engine.call(dev.start_logging(2, frames.BINARY, session.CHUNK, base=os.path.join(tmp, "s"))).result()
+        time.sleep(seconds)
+        engine.shutdown()
+    sim.stop()
+    print("live  %d samples read  %d fed  %d stats posts  %d alarms"
+          % (dev.stats.samples_in, dev.monitor.samples, received['stats'], received['alarm']))
+
+
+def bench_clock(hours=6, drift_ppm=30.0, period=0.05, rate=1000, seconds=6.0):
+    # clock alignment on a synthetic day with a drifting board clock, then live across the
+    # millis() wrap with two simulated boards merged onto one time axis
+    rng = np.random.default_rng(0)
+    sync = timesync.TimeSync()
+    sync.wall = 0.0
+    per_batch = int(rate * period)
+    batches = int(hours * 3600 / period)
+    errors = np.empty(batches)
+    last = -np.inf
+    steps_back = 0
+    start_millis = timesync.WRAP - 3600 * 1000
+    elapsed = 0.0
+    for k in range(batches):
+        # samples are taken up to the batch time and arrive after a random delay
+        taken = k * period * 1000 - np.arange(per_batch)[::-1] * (1000.0 / rate)
+        board = (start_millis + np.floor(taken * (1 + drift_ppm * 1e-6)).astype(np.int64)) % timesync.WRAP
+        received = (k * period * 1000 + rng.exponential(5.0)) / 1000
+        start = time.perf_counter()
+        millis, host, keep = sync.feed(board.astype(np.uint32), received)
+        elapsed += time.perf_counter() - start
+        errors[k] = np.abs(host - taken).max()
+        steps_back += host[0] < last
+        last = host[-1]
+    settled = errors[int(600 / period):]
+    print("%d h  board fast by %.1f ppm, fitted %.2f ppm  error p50 %.2f ms  p99 %.2f ms  max %.2f ms  steps back %d  %.1f us per batch"
+          % (hours, drift_ppm, -sync.drift_ppm(), np.median(settled), np.percentile(settled, 99), settled.max(),
+             steps_back, 1e6 * elapsed / batches))
+
+    # live, one board about to wrap
+    sims = [BoardSimulator(rate=rate, baud=1000000, command_gap=0.02, start_millis=timesync.WRAP - 2000).start(),
+            BoardSimulator(rate=rate, baud=1000000, command_gap=0.02).start()]
+    engine = Engine().start()
+    devs = [engine.open_device(sim.port, command_gap=0.05) for sim in sims]
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i, dev in enumerate(devs):
+            engine.call(dev.start_logging(2, frames.BINARY, session.CHUNK, base=os.path.join(tmp, "s%d" % i))).result()
+            paths.append(dev.writer.path)
+        time.sleep(seconds)
+        engine.shutdown()
+        for sim, dev, path in zip(sims, devs, paths):
+            millis, values = analysis.load_session(path)
+            host = timesync.to_host(timesync.load_clock(path), millis)
+            truth = (sim.start_time + dev.clock.wall) * 1000 + (millis - sim.start_millis)
+            print("live  start %10d  last %10d  steps back %d  error p50 %.2f ms  max %.2f ms"
+                  % (sim.start_millis, millis[-1], int((np.diff(millis) < 0).sum()),
+                     np.median(np.abs(host - truth)), np.abs(host - truth).max()))
+        merged = timesync.merge(paths)
+        print("merged %d samples from %d sessions, in order %s"
+              % (len(merged), len(paths), bool(np.all(np.diff(merged['host']) >= 0))))
+    for sim in sims:
+        sim.stop()
+
+
+def bench_commands(count=200, spacing=0.02, rate=1000, seconds=2.0):
+    # acknowledgements decoded out of a run of frames and lines, then the round trip of
+    # commands sent while logging, and the sampling lost to commands on readString() firmware
+    millis, values = synthetic_samples(100000)
+    ids = np.arange(1, 101)
+    payload = bytearray(frames.encode_frames(millis, values))
+    for i, rid in enumerate(ids.tolist()):
+        pos = (len(payload) // frames.FRAME_SIZE) * (i + 1) // (len(ids) + 1) * frames.FRAME_SIZE
+        payload[pos:pos] = frames.encode_acks([rid], [2])
+    reader = frames.FrameReader()
+    start = time.perf_counter()
+    samples = np.concatenate([reader.feed(bytes(payload[i:i + 4096])) for i in range(0, len(payload), 4096)])
+    elapsed = time.perf_counter() - start
+    print("frames  %d samples  %d acks  in order %s  errors %d  %.1f ns per frame"
+          % (len(samples), len(reader.acks), [a[0] for a in reader.acks] == ids.tolist(), reader.errors,
+             1e9 * elapsed / len(samples)))
+    lines = frames.LineReader()
+    t, v = lines.feed(b"1,2\r\nack,7,3\r\n2\r\n3,4\r\n")
+    print("lines   %d samples  acks %s  messages %s" % (len(t), lines.acks, lines.messages))
+
+    # live, commands while logging in both formats
+    for fmt, name in ((frames.BINARY, "binary"), (frames.ASCII, "ascii")):
+        sim = BoardSimulator(rate=rate, baud=1000000).start()
+        engine = Engine().start()
+        dev = engine.open_device(sim.port)
+        with tempfile.TemporaryDirectory() as tmp:
+            engine.call(dev.start_logging(2, fmt, session.CHUNK, base=os.path.join(tmp, "s"))).result()
+            time.sleep(0.5)
+            for i in range(count):
+                dev.send("2," + ("3.3" if i % 2 else "0"))
+                time.sleep(spacing)
+            time.sleep(seconds)
+            engine.shutdown()
+            millis, values = analysis.load_session(dev.writer.path)
+        sim.stop()
+        print("%-7s %s  largest sample gap %d ms" % (name, dev.channel.summary(), np.diff(millis).max()))
+
+    # older firmware, readString() holds up sampling for its 1 s timeout on every command
+    for legacy in (True, False):
+        sim = BoardSimulator(rate=rate, baud=1000000, command_gap=1.0, legacy=legacy).start()
+        engine = Engine().start()
+        dev = engine.open_device(sim.port)
+        with tempfile.TemporaryDirectory() as tmp:
+            engine.call(dev.start_logging(2, frames.BINARY, session.CHUNK, base=os.path.join(tmp, "s"))).result()
+            time.sleep(2.0)
+            start = time.perf_counter()
+            for value in ("3.3", "0", "0.6", "0"):
+                dev.send(("2," if value != "0.6" else "4,") + value)
+            while len(sim.commands) < 5 and time.perf_counter() - start < 10:
+                time.sleep(0.01)
+            applied = time.perf_counter() - start
+            time.sleep(seconds)
+            engine.shutdown()
+            millis, values = analysis.load_session(dev.writer.path)
+        sim.stop()
+        gaps = np.diff(millis)
+        print("%-7s 4 commands applied in %.3f s  %d samples  lost about %d ms of sampling"
+              % ("legacy" if legacy else "acked", applied, len(millis), int(gaps[gaps > 10].sum())))
+
+
+def bench_link(limits=(115200, 921600, None), rate=5000, seconds=2.0):
+    # rate negotiation against simulated UARTs that carry up to each limit intact (None is
+    # the native USB port), then the samples/s logged in ascii at the safe rate and at the
+    # negotiated one, and firmware that does not know "6,"
+    for limit in limits:
+        sim = BoardSimulator(rate=rate, baud=link.SAFE_BAUD, max_baud=limit).start()
+        engine = Engine().start()
+        dev = engine.open_device(sim.port)
+        with tempfile.TemporaryDirectory() as tmp:
+            logged = []
+            for negotiate in (False, True):
+                if negotiate:
+                    start = time.perf_counter()
+                    best = engine.call(dev.negotiate()).result()
+                    took = time.perf_counter() - start
+                engine.call(dev.start_logging(2, frames.ASCII, session.CSV, base=os.path.join(tmp, "s%d" % negotiate))).result()
+                time.sleep(seconds)
+                engine.call(dev.stop_logging()).result()
+                time.sleep(0.2)
+                millis, values = analysis.load_session(dev.writer.path)
+                logged.append(len(millis) / seconds)
+            engine.shutdown()
+        sim.stop()
+        print("limit %s  settled on %d baud in %.2f s  board %d  garbled %d bytes"
+              % ("usb" if limit is None else limit, best, took, sim.baud, sim.garbled))
+        print(link.describe(dev.link))
+        print("ascii logging  %.0f samples/s at %d baud  %.0f samples/s at %d baud"
+              % (logged[0], link.SAFE_BAUD, logged[1], best))
+
+    sim = BoardSimulator(baud=link.SAFE_BAUD, max_baud=921600, legacy=True).start()
+    engine = Engine().start()
+    dev = engine.open_device(sim.port)
+    start = time.perf_counter()
+    best = engine.call(dev.negotiate()).result()
+    print("readString() firmware  stays at %d baud after %.2f s, board %d" % (best, time.perf_counter() - start, sim.baud))
+    engine.shutdown()
+    sim.stop()
+
+
+def thread_cpu(thread):
+    # this function returns the cpu seconds used by one thread so far
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+
+def bench_hotplug(seconds=3.0, away=1.5, rate=1000):
+    # idle cpu of the port watch, then how fast an unplugged board is noticed and picked up
+    # again, with inotify and with the polling fallback, and whether the session carries on
+    # the cpu is that of the thread doing the watching, the simulators run in this process too
+    def poll(stop):
+        while not stop:
+            [tuple(p) for p in list(serial.tools.list_ports.comports())]
+            time.sleep(0.1)
+
+    stop = []
+    t = Thread(target=poll, args=(stop,), daemon=True)
+    t.start()
+    time.sleep(0.1)
+    start = thread_cpu(t)
+    time.sleep(seconds)
+    print("comports() every 100 ms  idle cpu %6.3f%%" % (100 * (thread_cpu(t) - start) / seconds))
+    stop.append(1)
+    t.join()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for use_inotify in (True, False):
+            name = "inotify" if use_inotify else "polling"
+            sim = BoardSimulator(rate=rate, baud=1000000, alias=os.path.join(tmp, "ttySWEAT")).start()
+            events = {}
+            engine = Engine(use_inotify=use_inotify).start()
+            dev = engine.open_device(sim.port, notify=lambda d, event, *args: events.setdefault(event, time.perf_counter()))
+            start = thread_cpu(engine.thread)
+            time.sleep(seconds)
+            print("%-7s engine thread idle cpu %6.3f%%" % (name, 100 * (thread_cpu(engine.thread) - start) / seconds))
+
+            engine.call(dev.start_logging(2, frames.BINARY, session.CHUNK, base=os.path.join(tmp, name))).result()
+            time.sleep(1.0)
+            unplugged = time.perf_counter()
+            sim.unplug()
+            time.sleep(away)
+            plugged = time.perf_counter()
+            sim.plug()
+            time.sleep(1.0)
+            engine.shutdown()
+            sim.stop()
+            millis, values = analysis.load_session(dev.writer.path)
+            print("%-7s unplug noticed in %.1f ms  back %.1f ms after plugging in  one session of %d samples, "
+                  "read %d written %d" % (name, 1e3 * (events['unplugged'] - unplugged),
+                                          1e3 * (events['reconnected'] - plugged), len(millis),
+                                          dev.stats.samples_in, dev.stats.samples_out))
+
+
+def proc_cpu(pid):
+    # this function returns the cpu seconds used by another process so far (linux)
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def bench_daemon(rate=5000, seconds=10.0, stalled=3, calls=200):
+    # the daemon and a simulated board in their own processes, ingest with no subscribers
+    # against one subscriber reading everything and a few that never read (their socket
+    # buffers fill after a few seconds, then their queues), then the round trip of control
+    # commands
+    from daemon import DaemonClient
+    here = os.path.dirname(os.path.abspath(__file__))
+    procs, ports = spawn_simulators(1, rate, 1000000)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "daemon.sock")
+        proc = subprocess.Popen([sys.executable, os.path.join(here, "daemon.py"), "serve", "--port", ports[0],
+                                 "--socket", path, "--no-negotiate"], cwd=tmp, stdout=subprocess.PIPE, text=True)
+        proc.stdout.readline()
+        control = DaemonClient(path)
+
+        def phase(name):
+            # log for a while and return the samples read per second and the daemon cpu
+            before = control.call("status")['samples_in']
+            cpu = proc_cpu(proc.pid)
+            time.sleep(seconds)
+            status = control.call("status")
+            used = proc_cpu(proc.pid) - cpu
+            print("%-24s read %7.0f samples/s  daemon cpu %5.1f%%"
+                  % (name, (status['samples_in'] - before) / seconds, 100 * used / seconds))
+            return status
+
+        control.call("log_start", val="2", fmt="binary", storage="chunk")
+        time.sleep(0.5)
+        phase("no subscribers")
+
+        # clients that subscribe and then never read, with a small socket buffer
+        slow = []
+        for _ in range(stalled):
+            client = DaemonClient(path)
+            client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            client.call("subscribe")
+            slow.append(client)
+
+        # a client that reads everything until logging stops
+        fast = DaemonClient(path)
+        fast.call("subscribe")
+        got = []
+
+        def read():
+            for message in fast.messages():
+                if 'millis' in message:
+                    got.append(message['millis'])
+                elif message['event'] == 'logging' and not message['args'][0]:
+                    break
+
+        t = Thread(target=read, daemon=True)
+        t.start()
+        status = phase("1 reading + %d stalled" % stalled)
+        control.call("log_stop")
+        t.join()
+        millis = np.concatenate([np.asarray(m, dtype=np.int64) for m in got])
+        print("reading subscriber  %d samples  %d gaps    stalled subscribers dropped %s of %s lines"
+              % (len(millis), int((np.diff(millis) > 2).sum()),
+                 [s['dropped'] for s in status['subscribers'][:stalled]],
+                 [s['dropped'] + s['sent'] + s['queued'] for s in status['subscribers'][:stalled]]))
+
+        latency = LatencyHistogram()
+        for _ in range(calls):
+            start = time.perf_counter()
+            control.call("stim_start", val="1.5")
+            latency.add(1e3 * (time.perf_counter() - start))
+        p50, p90, p99 = latency.percentiles()
+        print("control command round trip p50 %.2f p90 %.2f p99 %.2f ms" % (p50, p90, p99))
+
+        control.call("shutdown")
+        proc.wait(30)
+        for client in slow + [fast, control]:
+            client.close()
+    for p in procs:
+        p.terminate()
+        p.wait()
+
+
+def ring_consumer(name, results):
+    # a reader process of bench_shared, it checks and summarises every sample of the ring
+    from sharedring import RingReader
+    reader = RingReader(name)
+    count = 0
+    total = 0.0
+    wrong = 0
+    while reader.wait():
+        times, values = reader.read()
+        wrong += int((values != 2 * times).sum())
+        values.std()
+        if reader.valid():
+            count += len(values)
+            total += float(times.sum())
+    results.put((count, total, reader.lost, wrong))
+    del times, values
+    reader.close()
+
+
+def queue_consumer(queue, results):
+    # the same reader fed through a multiprocessing queue
+    count = 0
+    total = 0.0
+    wrong = 0
+    while True:
+        batch = queue.get()
+        if batch is None:
+            break
+        times, values = batch
+        wrong += int((values != 2 * times).sum())
+        values.std()
+        count += len(values)
+        total += float(times.sum())
+    results.put((count, total, 0, wrong))
+
+
+def bench_shared(rate=200000, batch=1000, seconds=3.0, readers=4, board_rate=5000):
+    # a writer paced at rate samples/s in batches, with no readers, with readers on a
+    # shared memory ring and with the same readers fed by one multiprocessing queue each,
+    # then a simulated board read by core.Acquisition with and without ring readers
+    # the writer cost is the cpu of the writing process per batch (queue feeder threads
+    # included), late is how far the writer fell behind its schedule
+    import multiprocessing
+    import core
+    from sharedring import SharedRing
+
+    def write(buffer, queues):
+        # this function writes batches on schedule and returns cpu ms per batch, the p99 and
+        # max lateness in ms, samples/s and the checksum
+        n = int(rate * seconds / batch)
+        late = np.empty(n)
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        checksum = 0.0
+        for i in range(n):
+            due = start + i * batch / rate
+            now = time.perf_counter()
+            if now < due:
+                time.sleep(due - now)
+            late[i] = time.perf_counter() - due
+            times = np.arange(i * batch, (i + 1) * batch, dtype=np.float64)
+            values = 2 * times
+            checksum += float(times.sum())
+            if buffer is not None:
+                buffer.append(times, values)
+            for q in queues:
+                q.put((times, values))
+        elapsed = time.perf_counter() - start
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        used = end.ru_utime + end.ru_stime - cpu.ru_utime - cpu.ru_stime
+        return 1e3 * used / n, 1e3 * np.percentile(late, 99), 1e3 * late.max(), n * batch / elapsed, checksum
+
+    for mode in ("none", "ring", "queue"):
+        results = multiprocessing.Queue()
+        procs = []
+        queues = []
+        ring = SharedRing(2 ** 20) if mode != "queue" else None
+        for _ in range(readers if mode != "none" else 0):
+            if mode == "ring":
+                proc = multiprocessing.Process(target=ring_consumer, args=(ring.name, results))
+            else:
+                queues.append(multiprocessing.Queue())
+                proc = multiprocessing.Process(target=queue_consumer, args=(queues[-1], results))
+            proc.start()
+            procs.append(proc)
+        time.sleep(0.5)
+        ms, p99, worst, achieved, checksum = write(ring, queues)
+        for q in queues:
+            q.put(None)
+        if ring is not None:
+            ring.unlink()
+        seen = [results.get(timeout=30) for _ in procs]
+        for proc in procs:
+            proc.join()
+        ok = all(count == rate * seconds and total == checksum and lost == 0 and wrong == 0
+                 for count, total, lost, wrong in seen)
+        print("%d %-5s readers  writer %.3f ms cpu/batch  late p99 %.2f max %.2f ms  %8.0f samples/s  "
+              "readers complete %s" % (len(procs), mode, ms, p99, worst, achieved, ok if procs else "-"))
+
+    procs, ports = spawn_simulators(1, board_rate, 1000000)
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in (0, readers):
+            acq = core.Acquisition(ring="bench_ring_%d" % os.getpid())
+            acq.connect(ports[0], negotiate=False)
+            results = multiprocessing.Queue()
+            consumers = [multiprocessing.Process(target=ring_consumer, args=(acq.buffer.name, results))
+                         for _ in range(count)]
+            for proc in consumers:
+                proc.start()
+            time.sleep(0.5)
+            acq.start_logging("2", frames.BINARY, session.CHUNK, os.path.join(tmp, "r%d" % count), echo=False).result()
+            time.sleep(seconds)
+            acq.stop_logging().result()
+            samples = acq.dev.stats.samples_in
+            acq.shutdown()
+            seen = [results.get(timeout=30) for _ in consumers]
+            for proc in consumers:
+                proc.join()
+            print("board %d ring readers  read %6.0f samples/s  readers saw %s of %d"
+                  % (count, samples / seconds, [s[0] for s in seen], samples))
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+def bench_metrics(rate=50000, seconds=3.0, rounds=3, hooks=100000):
+    # cpu per sample of the engine with and without the instrumentation at the highest rate a
+    # simulated board (in its own process) reaches, in alternating rounds, then the cost of the
+    # hooks of one read timed on their own against the cpu of a read
+    # the rounds differ by more than the hooks cost, so the exit code (1 if over 2%) follows the
+    # estimate from the hooks, the rounds show it is not off by much
+    procs, ports = spawn_simulators(1, rate, 1000000)
+    cpu = {True: [], False: []}
+    reads = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(rounds):
+            for instrument in (False, True):
+                engine = Engine().start()
+                dev = engine.open_device(ports[0], instrument=instrument)
+                engine.call(dev.start_logging(2, frames.BINARY, session.CHUNK,
+                                              base=os.path.join(tmp, "m%d%d" % (i, instrument)))).result()
+                time.sleep(0.5)
+                before = dev.stats.samples_in
+                start = thread_cpu(engine.thread)
+                time.sleep(seconds)
+                used = thread_cpu(engine.thread) - start
+                samples = dev.stats.samples_in - before
+                if instrument:
+                    reads.append(dev.metrics.reads / max(dev.metrics.samples_in, 1))
+                engine.shutdown()
+                cpu[instrument].append(used / samples * 1e6)
+                print("round %d  metrics %-3s  %7.0f samples/s  engine thread %.3f us cpu/sample"
+                      % (i, "on" if instrument else "off", samples / seconds, cpu[instrument][-1]))
+    for p in procs:
+        p.terminate()
+        p.wait()
+    off = float(np.median(cpu[False]))
+    on = float(np.median(cpu[True]))
+    measured = 100 * (on - off) / off
+
+    # the hooks of one read that returns a batch, as in Device._read, _reader and _writer
+    m = metrics.Metrics()
+    start = time.perf_counter()
+    for _ in range(hooks):
+        t0 = time.perf_counter()
+        m.read.add(time.perf_counter() - t0)
+        m.serial_fill = 10
+        if 10 > m.max_serial_fill:
+            m.max_serial_fill = 10
+        m.reads += 1
+        m.bytes_in += 100
+        m.parse_errors += 0
+        t1 = time.perf_counter()
+        m.decode.add(t1 - t0)
+        m.samples_in += 10
+        m.batches += 1
+        m.queue_depth = 1
+        if 1 > m.max_queue_depth:
+            m.max_queue_depth = 1
+        t2 = time.perf_counter()
+        m.queue.add(t2 - t1)
+        m.write.add(time.perf_counter() - t2)
+    per_read = (time.perf_counter() - start) / hooks
+    start = time.perf_counter()
+    m.snapshot()
+    snapshot = time.perf_counter() - start
+    estimated = 100 * per_read * 1e6 * float(np.median(reads)) / off
+    print("hooks %.2f us per read, %.3f reads per sample, snapshot %.2f ms once a second"
+          % (per_read * 1e6, float(np.median(reads)), snapshot * 1e3))
+    print("overhead measured %+.2f%%  estimated from the hooks %.2f%%  (budget 2%%)" % (measured, estimated))
+    return 1 if estimated > 2.0 else 0
+
+
+# the configurations of the suite, the payload the board sends and how the session is stored
+# ascii is the "millis,value" lines of the sample csv, binary the btOut_type frames
+SUITE_FORMATS = (("ascii", frames.ASCII, session.CSV), ("binary", frames.BINARY, session.CHUNK))
+
+# rates tried in turn, a format stops at the first rate it does not sustain
+SUITE_RATES = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000)
+
+# a rate is sustained when this much of it reaches the disk with the p99 of the latency from
+# the board to the disk under the limit (ms)
+SUITE_SUSTAINED = 0.95
+SUITE_MAX_LATENCY = 500.0
+
+# a run is a regression against a baseline when a format sustains a lower rate, or a median
+# latency (board to disk, and every stage) is this many times the baseline and at least
+# SUITE_SLACK ms more at a rate up to half of what both sustained
+# the p99 is recorded but not compared, with a few hundred batches a run it changes by 3x from
+# run to run on a busy machine, and so do the medians close to the limit
+SUITE_TOLERANCE = 1.5
+SUITE_SLACK = 5.0
+
+
+def spawn_board(rate, baud):
+    # this function starts a simulated board in its own process and returns it with its port
+    # and the perf_counter time of its millis 0
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, "-u", os.path.join(here, "simulator.py"), "--rate", str(rate),
+                             "--baud", str(baud)], stdout=subprocess.PIPE, text=True)
+    port = proc.stdout.readline().split()[-1]
+    proc.stdout.readline()
+    zero = float(proc.stdout.readline().split()[-1])
+    return proc, port, zero
+
+
+def rss_mb():
+    # this function returns the resident memory of this process (linux)
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+def plot_frames(buffer, metrics, stop, fps=30):
+    # this function redraws a live plot of the buffer off screen at the GUI frame rate, each
+    # redraw timed as the plot stage
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from liveplot import LivePlot
+
+    fig = Figure(figsize=(5, 5))
+    canvas = FigureCanvasAgg(fig)
+    live = LivePlot(fig, fig.add_subplot(), canvas, buffer)
+    canvas.draw()
+    while not stop:
+        start = time.perf_counter()
+        live.update()
+        metrics.plot.add(time.perf_counter() - start)
+        time.sleep(max(1.0 / fps - (time.perf_counter() - start), 0.0))
+
+
+def suite_run(name, fmt, storage, rate, tmp, seconds, warmup, plot, baud):
+    # this function logs one simulated board for a while and returns what the suite records
+    proc, port, zero = spawn_board(rate, baud)
+    buffer = RingBuffer(2 ** 20)
+    engine = Engine().start()
+
+    # the metrics are only read here, once for the warm up and once for the run
+    dev = engine.open_device(port, buffer=buffer, metrics_interval=3600.0)
+    engine.call(dev.start_logging(2, fmt, storage, base=os.path.join(tmp, "%s-%d" % (name, rate)))).result()
+
+    # every batch written, with the time the write finished
+    written = []
+    write = dev.writer.write
+
+    def timed_write(millis, values):
+        write(millis, values)
+        written.append((time.perf_counter(), millis))
+
+    dev.writer.write = timed_write
+    stop = []
+    plotter = None
+    if plot:
+        plotter = Thread(target=plot_frames, args=(buffer, dev.metrics, stop), daemon=True)
+        plotter.start()
+
+    time.sleep(warmup)
+    for stage in dev.metrics.stages.values():
+        stage.flush()
+    del written[:]
+    errors = dev.metrics.parse_errors
+    before = dev.stats.samples_out
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    board_cpu = proc_cpu(proc.pid)
+    start = time.perf_counter()
+    time.sleep(seconds)
+    elapsed = time.perf_counter() - start
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    board_used = proc_cpu(proc.pid) - board_cpu
+    samples = dev.stats.samples_out - before
+    stages = {stage: dev.metrics.stages[stage].flush() for stage in metrics.STAGES}
+    memory = rss_mb()
+    stop.append(1)
+    if plotter is not None:
+        plotter.join()
+    engine.shutdown()
+    proc.terminate()
+    proc.wait()
+
+    # every sample written in the run, from when the board took it to when it was on disk
+    if written:
+        latency = np.concatenate([1e3 * done - (1e3 * zero + np.asarray(millis, dtype=np.float64))
+                                  for done, millis in written])
+    else:
+        latency = np.full(1, np.inf)
+    p50, p90, p99 = np.percentile(latency, [50, 90, 99])
+    result = {
+        'format': name,
+        'storage': storage,
+        'plot': plot,
+        'target_rate': rate,
+        'rate': samples / elapsed,
+        'latency_p50_ms': float(p50),
+        'latency_p90_ms': float(p90),
+        'latency_p99_ms': float(p99),
+        'latency_max_ms': float(latency.max()),
+        'cpu_percent': 100 * (end.ru_utime + end.ru_stime - cpu.ru_utime - cpu.ru_stime) / elapsed,
+        'board_cpu_percent': 100 * board_used / elapsed,
+        'rss_mb': memory,
+        'parse_errors': dev.metrics.parse_errors - errors,
+        'max_queue_depth': dev.stats.max_depth,
+    }
+    for stage, histogram in stages.items():
+        result[stage + '_p50_ms'], result[stage + '_p99_ms'] = histogram.percentiles((50, 99))
+    result['sustained'] = bool(result['rate'] >= SUITE_SUSTAINED * rate and p99 <= SUITE_MAX_LATENCY)
+    return result
+
+
+def suite_environment():
+    # this function describes where the suite ran, so results files can be told apart
+    import platform
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def suite_regressions(results, baseline):
+    # this function compares a run with an earlier results file, returns what got worse
+    problems = []
+    old = {(r['format'], r['target_rate']): r for r in baseline['runs']}
+    for name, best in results['max_sustained'].items():
+        before = baseline['max_sustained'].get(name)
+        if before is not None and best < before:
+            problems.append("%s sustains %d samples/s, was %d" % (name, best, before))
+    for r in results['runs']:
+        b = old.get((r['format'], r['target_rate']))
+        if b is None or not (r['sustained'] and b['sustained']):
+            continue
+        limit = min(results['max_sustained'][r['format']], baseline['max_sustained'][r['format']])
+        if r['target_rate'] > limit / 2:
+            continue
+        for key in ['latency_p50_ms'] + [stage + '_p50_ms' for stage in metrics.STAGES]:
+            if r[key] > SUITE_TOLERANCE * b[key] and r[key] - b[key] > SUITE_SLACK:
+                problems.append("%s %d samples/s %s %.1f ms, was %.1f" % (r['format'], r['target_rate'], key,
+                                                                           r[key], b[key]))
+    return problems
+
+
+def bench_suite(out=None, baseline=None, rates=SUITE_RATES, seconds=3.0, warmup=1.0, plot=True, baud=100000000):
+    # end to end throughput and latency, from a simulated board on a pty through the engine to
+    # the session file and the live plot, at stepped rates for every payload format
+    # each run has a board process and an engine of its own, the results go to a json file
+    # (suite-<time>.json if out is not given), compared with baseline when given
+    # the simulated link is fast enough (baud) that the host is what runs out first
+    # exits 1 if a run got worse than the baseline
+    results = {'environment': suite_environment(), 'seconds': seconds, 'plot': plot, 'runs': [],
+               'max_sustained': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, fmt, storage in SUITE_FORMATS:
+            best = 0
+            for rate in rates:
+                r = suite_run(name, fmt, storage, rate, tmp, seconds, warmup, plot, baud)
+                results['runs'].append(r)
+                print("%-6s %-5s target %6d/s  written %8.0f/s  latency p50 %6.1f p99 %7.1f ms  "
+                      "stages p99 read %.2f decode %.2f queue %.2f write %.2f plot %.2f ms  "
+                      "cpu %5.1f%% (board %5.1f%%)  rss %5.0f MB  %s"
+                      % (name, storage, rate, r['rate'], r['latency_p50_ms'], r['latency_p99_ms'],
+                         r['read_p99_ms'], r['decode_p99_ms'], r['queue_p99_ms'], r['write_p99_ms'],
+                         r['plot_p99_ms'], r['cpu_percent'], r['board_cpu_percent'], r['rss_mb'],
+                         "ok" if r['sustained'] else "NOT SUSTAINED"))
+                if not r['sustained']:
+                    break
+                best = rate
+            results['max_sustained'][name] = best
+            print("%-6s max sustained %d samples/s" % (name, best))
+
+    out = out or time.strftime("suite-%Y-%m-%d-%H-%M-%S.json")
+    with open(out, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Results written to " + out)
+
+    if baseline is None:
+        return 0
+    with open(baseline) as f:
+        problems = suite_regressions(results, json.load(f))
+    for problem in problems:
+        print("REGRESSION " + problem)
+    return 1 if problems else 0
+
+
+# cold start budgets in seconds, "python benchmark.py startup" fails if a median is over
+# - importing the GUI shell (logger.py), tkinter only, no window
+# - importing the headless core (core.py), numpy and the engine, no tkinter or matplotlib
+# - from starting the interpreter to the first sample in the buffer of the core, at the
+#   safe rate, and after negotiating the rate as the GUI does
+STARTUP_BUDGET = {'import logger': 0.1, 'import core': 0.4, 'first sample': 0.6, 'negotiated sample': 3.0}
+
+# the programs timed, each in a fresh interpreter, they print time.monotonic() stamps
+STARTUP_GUI = """
+import sys, time
+up = time.monotonic()
+import logger
+import tkinter
+done = time.monotonic()
+loaded = [m for m in ('numpy', 'matplotlib', 'serial', 'engine') if m in sys.modules]
+print(up, done, ','.join(loaded) or '-', tkinter._default_root is not None)
+"""
+STARTUP_CORE = """
+import sys, time
+up = time.monotonic()
+import core
+imported = time.monotonic()
+loaded = [m for m in ('matplotlib', 'tkinter') if m in sys.modules]
+acq = core.Acquisition()
+acq.connect(sys.argv[1], negotiate=sys.argv[3] == '1')
+acq.start_logging('2', base=sys.argv[2], echo=False)
+while acq.buffer.total == 0:
+    time.sleep(0.001)
+first = time.monotonic()
+acq.shutdown()
+print(up, imported, first, ','.join(loaded) or '-')
+"""
+
+
+def bench_startup(runs=5):
+    # cold start of the GUI shell and of the headless core, against the budgets
+    # returns 1 if a median is over its budget or a heavy module is imported too early
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = {name: [] for name in STARTUP_BUDGET}
+    problems = []
+    for _ in range(runs):
+        spawn = time.monotonic()
+        out = subprocess.run([sys.executable, "-c", STARTUP_GUI], cwd=here, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(out.stderr)
+            return 1
+        up, done, loaded, window = out.stdout.split()
+        times['import logger'].append(float(done) - float(up))
+        if loaded != '-' or window == 'True':
+            problems.append("import logger loaded %s, window %s" % (loaded, window))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for negotiate in ('0', '1'):
+            for i in range(runs):
+                sim = BoardSimulator(baud=1000000).start()
+                base = os.path.join(tmp, "%s_%d" % (negotiate, i))
+                spawn = time.monotonic()
+                out = subprocess.run([sys.executable, "-c", STARTUP_CORE, sim.port, base, negotiate],
+                                     cwd=here, capture_output=True, text=True, timeout=60)
+                sim.stop()
+                if out.returncode != 0:
+                    print(out.stderr)
+                    return 1
+                up, imported, first, loaded = out.stdout.split()
+                if negotiate == '0':
+                    times['import core'].append(float(imported) - float(up))
+                    times['first sample'].append(float(first) - spawn)
+                else:
+                    times['negotiated sample'].append(float(first) - spawn)
+                if loaded != '-':
+                    problems.append("import core loaded " + loaded)
+
+    failed = 0
+    for name, budget in STARTUP_BUDGET.items():
+        median = float(np.median(times[name]))
+        over = median > budget
+        failed += over
+        print("%-18s median %7.1f ms  max %7.1f ms  budget %7.1f ms  %s"
+              % (name, 1e3 * median, 1e3 * max(times[name]), 1e3 * budget, "OVER" if over else "ok"))
+    for problem in sorted(set(problems)):
+        print(problem)
+    return 1 if failed or problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SWEATsens host benchmarks")
+    parser.add_argument("name", choices=["frames", "ring", "liveplot", "session", "pipeline", "simulator", "engine",
+                                         "multidevice", "ble", "analysis", "batch", "csv", "range", "pyramid", "stats", "clock",
+                                         "commands", "link", "hotplug", "startup", "daemon", "shared", "metrics", "suite"])
+    parser.add_argument("-n", type=int, default=None, help="number of samples (200000, ring 10000000)")
+    parser.add_argument("--out", default=None, help="results file of the suite")
+    parser.add_argument("--baseline", default=None, help="results file of an earlier suite to compare with")
+    parser.add_argument("--no-plot", action="store_true", help="run the suite without the live plot")
+    args = parser.parse_args()
+    n = args.n or 200000
+
+    if args.name == "frames":
+        bench_frames(n)
+    elif args.name == "ring":
+        bench_ring(args.n or 10 ** 7)
+    elif args.name == "liveplot":
+        bench_liveplot()
+    elif args.name == "session":
+        bench_session()
+    elif args.name == "pipeline":
+        bench_pipeline(n)
+    elif args.name == "simulator":
+        bench_simulator()
+    elif args.name == "engine":
+        bench_engine()
+    elif args.name == "multidevice":
+        bench_multidevice()
+    elif args.name == "ble":
+        bench_ble(n)
+    elif args.name == "analysis":
+        bench_analysis()
+    elif args.name == "batch":
+        bench_batch()
+    elif args.name == "csv":
+        bench_csv()
+    elif args.name == "range":
+        bench_range()
+    elif args.name == "pyramid":
+        bench_pyramid()
+    elif args.name == "stats":
+        bench_stats()
+    elif args.name == "clock":
+        bench_clock()
+    elif args.name == "commands":
+        bench_commands()
+    elif args.name == "link":
+        bench_link()
+    elif args.name == "hotplug":
+        bench_hotplug()
+    elif args.name == "startup":
+        return bench_startup()
+    elif args.name == "daemon":
+        bench_daemon()
+    elif args.name == "shared":
+        bench_shared()
+    elif args.name == "metrics":
+        return bench_metrics()
+    elif args.name == "suite":
+        return bench_suite(args.out, args.baseline, plot=not args.no_plot)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,392 +1,321 @@
-# logger.py
+# bluetooth.py
 # https://bleak.readthedocs.io/en/latest/api/index.html
-# https://medium.com/analytics-vidhya/using-numpy-efficiently-between-processes-1bee17dcb01
+#
+# BLE version of the logger, talks to the board as a central through bleak
+# - logsCharacteristic notifications carry a batch of samples each (see frames.py), sized
+#   to the negotiated MTU, they are only appended to a byte buffer when they arrive and
+#   are decoded together every flush_interval
+# - the stimulation, sensor, logging and testing characteristics are written directly
+# - notification latency and dropped samples are tracked in BleStats
+# lost notifications are counted from gaps in the sequence numbers, and latency is
+# relative to the fastest sample seen because the board clock has an unknown offset
+# from the computer clock
+# the arrival times also fit the board clock to the computer clock (timesync.py), the fit
+# is saved next to the session
+# run "python bluetooth.py" to connect to the first board called SWEATsens
 
 # import statements
 import sys
-import serial
-import serial.tools.list_ports
-from datetime import datetime
 import time
-import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
-import csv
+import asyncio
+from datetime import datetime
 from tkinter import *
-from threading import Thread
-from queue import Queue
-
-# from matplotlib.animation import FuncAnimation
-# from functools import partial
-
-# plotting in tkinter
-matplotlib.use("tkAgg")
-
-# global stop variable
-stop = 0
-
-# global queue
-time_q = Queue()
-val_q = Queue()
-
-# global tkinter window for the buttons
-window = Tk()
-
-
-def log_start(btn, ser, val="500"):
-    # this function starts logging
-    # set a default interval if none is given
-    if val == '' or val is None:
-        val = "500"
-
-    # send message to arduino
-    ser.write(("3," + val).encode('utf-8'))
-
-    # update stop variable for the new logging thread
-    global stop
-    stop = 0
-
-    # create new logging thread
-    t = Thread(target=logging, args=(ser,))
-    t.start()
-
-    # output and set button colour
-    print("Logging started.")
-    btn.config(bg='green')
-
-
-def stim_start(btn, ser, val="3.3"):
-    # this function starts stimulating the skin
-    # set a default stimulation voltage if none is given
-    if val == '' or val is None:
-        val = "3.3"
-
-    # send message to arduino
-    ser.write(("2," + val).encode('utf-8'))
-
-    # output and set button colour
-    print("Stimulation started.")
-    btn.config(bg='green')
-
-
-def sens_start(btn, ser, val="0.6"):
-    # this function starts supplying the electrode with power
-    # set a default electrode voltage if none is given
-    if val == '' or val is None:
-        val = "0.6"
-
-    # send message to arduino
-    ser.write(("4," + val).encode('utf-8'))
-
-    # output and set button colour
-    print("Electrode powered.")
-    btn.config(bg='green')
-
-
-def test_start(btn, ser, val="1"):
-    # this function sets the arduino to testing mode
-    # the arduino will generate random output data
-    # send message to arduino
-    ser.write(("0," + val).encode('utf-8'))
+import numpy as np
+from bleak import BleakClient, BleakScanner
+import frames
+import session
+import timesync
+from ringbuffer import RingBuffer
+from engine import Engine, TkAdapter
+
+# advertised name of the board
+PERIPHERAL_NAME = "SWEATsens"
+
+
+class BleStats:
+    # this class tracks notifications, dropped samples and latency
+
+    def __init__(self, history=65536):
+        self.notifications = 0
+        self.samples = 0
+        self.bytes = 0
+        self.batches = 0
+        self.errors = 0
+        self.lost = 0
+        self.dropped = 0
+        self.last_seq = None
+
+        # latest latencies in ms, relative to the lowest host - board offset seen
+        self.offset = None
+        self.latency = np.zeros(history)
+        self.count = 0
+
+    def add(self, millis, host_ms, seq, batch):
+        # this function updates the statistics with one decoded flush
+        # millis and host_ms are per sample, seq is per notification
+        self.samples += len(millis)
+        self.notifications += len(seq)
+        self.batches += 1
+
+        # every skipped sequence number is a lost notification of about batch samples
+        seqs = seq.astype(np.int64)
+        if self.last_seq is not None:
+            seqs = np.concatenate(([self.last_seq], seqs))
+        if len(seqs) > 0:
+            self.last_seq = int(seqs[-1])
+        gaps = np.clip(np.diff(seqs) % 65536 - 1, 0, None)
+        lost = int(gaps.sum())
+        self.lost += lost
+        self.dropped += lost * batch
+        if len(millis) == 0:
+            return
+
+        # the smallest offset is the one with the least delay
+        offsets = host_ms - millis.astype(np.float64)
+        low = offsets.min()
+        if self.offset is None or low < self.offset:
+            self.offset = low
+        lat = offsets - self.offset
+
+        # keep the newest latencies in a circular array
+        n = min(len(lat), len(self.latency))
+        idx = (self.count + np.arange(n)) % len(self.latency)
+        self.latency[idx] = lat[-n:]
+        self.count += n
+
+    def latency_percentiles(self, q=(50, 90, 99)):
+        held = self.latency[:min(self.count, len(self.latency))]
+        if len(held) == 0:
+            return [0.0 for _ in q]
+        return list(np.percentile(held, q))
+
+
+class BleDevice:
+    # this class is one board connected over BLE
+
+    def __init__(self, buffer=None, client=None, flush_interval=0.05, notify=None):
+        self.buffer = buffer
+        self.client = client
+        self.flush_interval = flush_interval
+
+        # notify(device, event, *args) is called on the loop thread
+        self.notify = notify
+
+        # raw notifications, their sizes and arrival times, waiting to be decoded
+        self.pending = bytearray()
+        self.lengths = []
+        self.arrivals = []
+
+        # samples per notification, set from the MTU when logging starts
+        self.batch = frames.MIN_BATCH
+
+        self.writer = None
+        self.clock = None
+        self.flush_task = None
+        self.stats = BleStats()
+
+    def _emit(self, event, *args):
+        if self.notify is not None:
+            self.notify(self, event, *args)
+
+    async def connect(self, name=PERIPHERAL_NAME, timeout=10.0):
+        # this function finds the board and connects to it
+        if self.client is None:
+            device = await BleakScanner.find_device_by_name(name, timeout=timeout)
+            if device is None:
+                raise RuntimeError("No " + name + " board found!")
+            self.client = BleakClient(device, disconnected_callback=lambda c: self._emit('disconnected'))
+        await self.client.connect()
+        self._emit('connected')
+
+    async def disconnect(self):
+        await self.stop_logging()
+        await self.client.disconnect()
+
+    def _on_notify(self, sender, data):
+        # this function runs for every notification, so it only stores the bytes
+        self.pending += data
+        self.lengths.append(len(data))
+        self.arrivals.append(time.perf_counter())
+
+    def _flush(self):
+        # this function decodes everything that arrived since the last flush
+        if not self.pending:
+            return None
+        data = bytes(self.pending)
+        lengths = self.lengths
+        arrivals = np.array(self.arrivals) * 1000
+        self.pending = bytearray()
+        self.lengths = []
+        self.arrivals = []
+
+        packets, seq, counts, good = frames.decode_ble_batches(data, lengths)
+        self.stats.bytes += len(data)
+        self.stats.errors += int(len(good) - good.sum())
+        self.stats.add(packets['millis'], np.repeat(arrivals[good], counts), seq, self.batch)
+
+        millis, hosts, keep = self.clock.feed(packets['millis'], np.repeat(arrivals[good], counts) / 1000)
+        values = packets['value'].copy() if keep is None else packets['value'][keep]
+        if self.buffer is not None:
+            self.buffer.append(millis, values)
+        return millis, values
+
+    async def _flusher(self):
+        # this function decodes and writes the notifications in batches
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            batch = self._flush()
+            if batch is not None:
+                await loop.run_in_executor(None, self.writer.write, batch[0], batch[1])
+
+    async def _write(self, uuid, value):
+        await self.client.write_gatt_char(uuid, bytes([int(value)]), response=True)
+
+    async def start_logging(self, interval=10, storage=session.CSV, base=None):
+        # this function opens a session and starts the notifications
+        # the logging characteristic is one byte, so the interval is 2 - 255 ms
+        await self.stop_logging()
+        interval = min(max(int(interval), 2), 255)
+
+        # get the current date for the file name
+        if base is None:
+            base = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        self.writer = session.open_writer(base, storage, 'u2')
+        self.clock = timesync.TimeSync(timesync.clock_path(self.writer.path))
+        if self.buffer is not None:
+            self.buffer.spill_to(base + "_spill.bin")
+
+        # as many samples per notification as the MTU allows
+        self.batch = frames.batch_samples(self.client.mtu_size)
+        await self._write(frames.BATCH_UUID, self.batch)
+
+        self.stats = BleStats()
+        await self.client.start_notify(frames.LOGS_UUID, self._on_notify)
+        await self._write(frames.LOGGING_UUID, interval)
+        self.flush_task = asyncio.get_running_loop().create_task(self._flusher())
+        self._emit('logging', True)
+        return base
+
+    async def stop_logging(self):
+        # this function stops the notifications and writes what is left
+        if self.flush_task is None:
+            return
+        if self.client.is_connected:
+            await self._write(frames.LOGGING_UUID, 0)
+            await self.client.stop_notify(frames.LOGS_UUID)
+        self.flush_task.cancel()
+        await asyncio.gather(self.flush_task, return_exceptions=True)
+        self.flush_task = None
+
+        batch = self._flush()
+        if batch is not None:
+            self.writer.write(batch[0], batch[1])
+        self.writer.close()
+        self.clock.close()
+        if self.buffer is not None:
+            self.buffer.close()
+        self._emit('logging', False)
+
+    async def set_stimulation(self, on):
+        await self._write(frames.STIMULATION_UUID, on)
+
+    async def set_sensor(self, on):
+        await self._write(frames.SENSOR_UUID, on)
+
+    async def set_testing(self, on):
+        await self._write(frames.TESTING_UUID, on)
+
+
+def button_action(engine, btn, coro, message, colour):
+    # this function runs a BLE write on the engine and updates the button when it is done
+    future = engine.call(coro)
 
     # output and set button colour
-    print("Testing mode.")
-    btn.config(bg='green')
-
-
-def log_stop(btn, ser, val="0"):
-    # this function stops the logging function
-    # send message to arduino
-    ser.write(("3," + val).encode('utf-8'))
-
-    # assign global variable and set value to stop
-    global stop
-    stop = 1
-
-    # output and reset button colour
-    print("Logging stopped.")
-    btn.config(bg='SystemButtonFace')
-
-
-def stim_stop(btn, ser, val="0"):
-    # this function stops the stimulation function
-    # send message to arduino
-    ser.write(("2," + val).encode('utf-8'))
-
-    # output and reset button colour
-    print("Stimulation stopped.")
-    btn.config(bg='SystemButtonFace')
-
-
-def sens_stop(btn, ser, val="0"):
-    # this function stops powering the electrode function
-    # send message to arduino
-    ser.write(("4," + val).encode('utf-8'))
-
-    # output and reset button colour
-    print("Electrode unpowered.")
-    btn.config(bg='SystemButtonFace')
-
-
-def test_stop(btn, ser, val="0"):
-    # this function returns the arduino to normal operations
-    # send message to arduino
-    ser.write(("0," + val).encode('utf-8'))
-
-    # output and reset button colour
-    print("Normal mode.")
-    btn.config(bg='SystemButtonFace')
-
-
-def logging(ser):
-    # this function writes the data received to a file
-    # get the current date for the file name
-    now = datetime.now()
-    dt_string = now.strftime("%Y-%m-%d-%H-%M-%S")
-
-    # open the file to write to and create the writer
-    f = open(dt_string + ".csv", "a", newline='', encoding='utf-8')
-    writer = csv.writer(f, delimiter=",")
-
-    # loop while the stop condition is not met
-    while stop == 0:
-
-        # read in the next line from serial
-        ser_bytes = ser.readline()
-
-        # decode the input and convert it to a string
-        decoded_bytes = str(ser_bytes[0:len(ser_bytes) - 2].decode("utf-8"))
-
-        # print data
-        print(decoded_bytes)
-
-        # check if there is a comma separator
-        # process if there is, pass if there is not
-        if ',' in decoded_bytes:
-
-            # convert data a list
-            txt = decoded_bytes.split(',')
-
-            # write times to a queue as a float
-            global time_q
-            time_q.put(float(txt[0]))
-
-            # write voltages to a queue as a float
-            global val_q
-            val_q.put(float(txt[1]))
-
-            # write the data
-            writer.writerow(txt)
-
-    # close the file once the loop is done
-    f.close()
-
-
-def plot():
-    # this function creates a new window that plots the data just logged
-    # Toplevel object which will be treated as a new window
-    plot_window = Toplevel(window)
-
-    # set title
-    plot_window.title("Plotting")
-
-    # sets the geometry
-    plot_window.geometry("500x600")
-
-    # define a window closing protocol
-    plot_window.protocol("WM_DELETE_WINDOW", lambda: on_closing(plot_window))
-
-    # begin plotting
-    fig, ax = plt.subplots()
-
-    # create the x and y data from the collected data in the queue
-    x_time = np.array(list(time_q.queue))
-    y_val = np.array(list(val_q.queue))
-
-    # print(x, y)
-
-    # plot the data
-    ax.plot(x_time/1000/60, y_val)
-
-    # the below code is for animations, but it is not necessary
-    # line1, = ax.plot([], [], 'ro')
-    #
-    # def init():
-    #     # ax.set_xlim(0, 2 * np.pi)
-    #     # ax.set_ylim(-1, 1)
-    #     ax.set_xlim(2.3, 2.5)
-    #     ax.set_ylim(0, 3.3)
-    #     return line1,
-    #
-    # def update(frame, ln, x, y):
-    #     x.append(frame[0]/10000000)
-    #     y.append(frame[1])
-    #     # x.append(frame)
-    #     # y.append(np.sin(frame))
-    #     ln.set_data(x, y)
-    #     return ln,
-    #
-    # ani = FuncAnimation(
-    #     fig, partial(update, ln=line1, x=[], y=[]),
-    #     # frames=np.linspace(0, 2 * np.pi, 128),
-    #     frames=zip(x_time, y_val),
-    #     init_func=init,
-    #     blit=True)
-
-    # this will autoscale the plot to have the correct axes limits
-    plt.autoscale()
-
-    # format the plot
-    ax.set_xlabel("Time (min)")
-    ax.set_ylabel("Voltage (V)")
-    ax.set_title("Electrode Voltage")
-
-    fig.set_size_inches(5, 5)
-
-    # create the tkinter canvas for the figure
-    canvas = FigureCanvasTkAgg(fig, master=plot_window)
-    canvas.draw()
-
-    # place the canvas in the window
-    canvas.get_tk_widget().pack()
-
-    # create the toolbar
-    toolbar = NavigationToolbar2Tk(canvas, plot_window)
-    toolbar.update()
-
-    # place the toolbar in the window
-    canvas.get_tk_widget().pack()
-
-    # this will produce a separate plot
-    # plt.show()
-
-
-def on_closing(box):
-    # this function defines what happens when the plotting window is closed
-    # close the plot so it doesn't run in the background
-    plt.close('all')
-
-    # close the window
-    box.destroy()
-
-
-def force_closing(box):
-    # stop the program
-    box.destroy()
-    sys.exit("No Arduino connected!")
-
-
-def check_presence(correct_port, interval=0.1):
-    # this function checks if the arduino is connected and terminated the program if it is diconnected
-    # while loop to check
-    while True:
-
-        # get the available ports
-        myports = [tuple(p) for p in list(serial.tools.list_ports.comports())]
-
-        # if the desired port is not present
-        if correct_port not in myports:
-
-            # output
-            print("Arduino has been disconnected!")
-
-            # create popup window
-            top = Toplevel(window)
-            top.geometry("250x50")
-            top.title("Error")
-            label = Label(top, text="Arduino disconnected!", font=("Times New Roman", 18, "bold"))
-            label.pack()
-
-            # set window exit protocol
-            top.protocol("WM_DELETE_WINDOW", lambda: force_closing(window))
-
-            break
-        # wait 0.1s between checking
-        time.sleep(interval)
+    print(message)
+    btn.config(bg=colour)
+    return future
 
 
 def main():
+    # create a tkinter window for the buttons
+    window = Tk()
 
-    # this starts and gets the list of ports
-    myports = [tuple(p) for p in list(serial.tools.list_ports.comports())]
-
-    # see if arduino is connected
-    try:
-        arduino_port = [port for port in myports if 'COM4' in port][0]
-
-        # start checking thread if it is
-        port_controller = Thread(target=check_presence, args=(arduino_port, 0.1,))
-        port_controller.setDaemon(True)
-        port_controller.start()
-
-    # otherwise raise an error and stop the program
-    except:
-        # create popup window
-        window.geometry("250x50")
-        window.title("Error")
-        label = Label(window, text="No Arduino connected!", font=("Times New Roman", 18, "bold"))
-        label.pack()
-
-        # terminate program on window close
-        window.protocol("WM_DELETE_WINDOW", lambda: force_closing(window))
+    # buffer of the most recent samples for the plot
+    buffer = RingBuffer(capacity=2 ** 22)
 
-        # start loop
-        window.mainloop()
+    # the engine loop also runs bleak
+    engine = Engine().start()
+    adapter = TkAdapter(window)
 
-    # define serial port and baud rate
-    # find the 'COM#' in the Windows Device Manager
-    ser = serial.Serial('COM4', 9600, timeout=1)
+    def device_event(dev, event, *args):
+        # this function runs on the tkinter mainloop
+        if event == 'disconnected':
+            print("Board has been disconnected!")
 
-    # flush the input
-    ser.flushInput()
+    # connect to the board
+    ble = BleDevice(buffer, notify=lambda d, event, *args: adapter.post(device_event, d, event, *args))
+    try:
+        engine.call(ble.connect()).result()
+    except Exception as e:
+        print(e)
+        engine.shutdown()
+        window.destroy()
+        sys.exit("No board connected!")
 
     # create a frame to hold the grid of buttons
     top_frame = Frame(window)
 
-    # logging start button
-    log_start_btn = Button(top_frame, text='Start Logging', command=lambda: log_start(log_start_btn, ser, val_entry.get()))
-    log_start_btn.bind('<Button-1>')
-
-    # stimulation start button
-    stim_start_btn = Button(top_frame, text='Start Stimulation', command=lambda: stim_start(stim_start_btn, ser, val_entry.get()))
-    stim_start_btn.bind('<Button-1>')
-
-    # electrode start button
-    sens_start_btn = Button(top_frame, text='Power Electrode', command=lambda: sens_start(sens_start_btn, ser, val_entry.get()))
-    sens_start_btn.bind('<Button-1>')
-
-    # testing mode button
-    test_start_btn = Button(top_frame, text='Testing Mode', command=lambda: test_start(test_start_btn, ser))
-    test_start_btn.bind('<Button-1>')
-
-    # logging stop button
-    log_stop_btn = Button(top_frame, text='Stop Logging', command=lambda: log_stop(log_start_btn, ser), bg='red')
-    log_stop_btn.bind('<Button-1>')
-
-    # stimulation stop button
-    stim_stop_btn = Button(top_frame, text='Stop Stimulation', command=lambda: stim_stop(stim_start_btn, ser), bg='red')
-    stim_stop_btn.bind('<Button-1>')
-
-    # electrode stop button
-    sens_stop_btn = Button(top_frame, text='Stop Electrode', command=lambda: sens_stop(sens_start_btn, ser), bg='red')
-    sens_stop_btn.bind('<Button-1>')
-
-    # exit testing mode button
-    test_stop_btn = Button(top_frame, text='Normal Mode', command=lambda: test_stop(test_start_btn, ser), bg='red')
-    test_stop_btn.bind('<Button-1>')
-
-    # create a field for text entry for potential values to pass to arduino
+    # a field for the logging interval
     bottom_frame = Frame(window)
     val_entry = Entry(bottom_frame)
-    val_label = Label(bottom_frame, text="Type values here:")
+    val_label = Label(bottom_frame, text="Logging interval (ms):")
+
+    # logging buttons
+    log_start_btn = Button(top_frame, text='Start Logging', command=lambda: button_action(
+        engine, log_start_btn, ble.start_logging(val_entry.get() or 10), "Logging started.", 'green'))
+    log_stop_btn = Button(top_frame, text='Stop Logging', bg='red', command=lambda: button_action(
+        engine, log_start_btn, ble.stop_logging(), "Logging stopped.", 'SystemButtonFace'))
+
+    # stimulation buttons
+    stim_start_btn = Button(top_frame, text='Start Stimulation', command=lambda: button_action(
+        engine, stim_start_btn, ble.set_stimulation(1), "Stimulation started.", 'green'))
+    stim_stop_btn = Button(top_frame, text='Stop Stimulation', bg='red', command=lambda: button_action(
+        engine, stim_start_btn, ble.set_stimulation(0), "Stimulation stopped.", 'SystemButtonFace'))
+
+    # electrode buttons
+    sens_start_btn = Button(top_frame, text='Power Electrode', command=lambda: button_action(
+        engine, sens_start_btn, ble.set_sensor(1), "Electrode powered.", 'green'))
+    sens_stop_btn = Button(top_frame, text='Stop Electrode', bg='red', command=lambda: button_action(
+        engine, sens_start_btn, ble.set_sensor(0), "Electrode unpowered.", 'SystemButtonFace'))
+
+    # testing buttons
+    test_start_btn = Button(top_frame, text='Testing Mode', command=lambda: button_action(
+        engine, test_start_btn, ble.set_testing(1), "Testing mode.", 'green'))
+    test_stop_btn = Button(top_frame, text='Normal Mode', bg='red', command=lambda: button_action(
+        engine, test_start_btn, ble.set_testing(0), "Normal mode.", 'SystemButtonFace'))
+
+    def plot():
+        # matplotlib is imported with the first plot window
+        from liveplot import open_live_plot
+        open_live_plot(window, buffer)
 
     # plot button
     plot_btn = Button(window, text='Plot', command=plot)
-    plot_btn.bind('<Button-1>')
+
+    # label for the notification statistics
+    stats_label = Label(window, text="")
+
+    def update_stats():
+        # this function shows the notification statistics once a second
+        s = ble.stats
+        p50, p90, p99 = s.latency_percentiles()
+        stats_label.config(text="samples %d  notifications %d  dropped %d  latency p50 %.0f p99 %.0f ms" %
+                           (s.samples, s.notifications, s.dropped, p50, p99))
+        window.after(1000, update_stats)
 
     # set the window title
-    window.title('logger')
+    window.title('bluetooth')
 
     # add the buttons to the frame
     log_start_btn.grid(row=0, column=0, sticky="ew")
@@ -403,12 +332,20 @@ def main():
     val_label.grid(row=0, column=0, sticky="ew")
     val_entry.grid(row=0, column=1, sticky="ew")
 
-    # add the frame and the entry field to the window
+    # add the frames to the window
     top_frame.grid(row=0, column=0)
     bottom_frame.grid(row=1, column=0, sticky="ew")
     plot_btn.grid(row=2, column=0, sticky="ew")
+    stats_label.grid(row=3, column=0, sticky="ew")
+
+    def on_closing():
+        # disconnect and finish the session before the window goes
+        engine.call(ble.disconnect()).result(10)
+        engine.shutdown()
+        window.destroy()
 
-    # window.geometry("300x200+10+20")
+    window.protocol("WM_DELETE_WINDOW", on_closing)
+    window.after(1000, update_stats)
     window.mainloop()
 
 
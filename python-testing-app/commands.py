@@ -0,0 +1,161 @@
+# commands.py
+# request ids, acknowledgements and round trip latency of the serial commands
+#
+# every "func,val" command goes out as one line "func,val,id\n", the board runs it as soon
+# as the newline arrives and answers "ack,id,func" (or an ack frame in binary mode, see
+# frames.py), so nothing on either side waits on a timeout
+# CommandChannel keeps the commands waiting for their answer
+# - the round trip of every answered command goes into a LatencyHistogram
+# - a command not answered within timeout seconds is sent again with the same id, up to
+#   retries times, the commands only set states on the board so running one twice is safe
+# - firmware from before the acknowledgements reads commands with Serial.readString() and
+#   ignores the id, until the board has answered once nothing is sent again and commands are
+#   spaced by the old gap (see engine.Device)
+# it does no I/O itself, engine.Device writes what it returns and hands it the answers
+
+# import statements
+import numpy as np
+import frames
+
+# seconds before an unanswered command is sent again, and how many times
+COMMAND_TIMEOUT = 0.5
+COMMAND_RETRIES = 3
+
+# ids count up to this and start again at 1
+MAX_ID = 2 ** 31
+
+# latency bins, BINS_PER_DECADE log spaced bins per decade from LOW_MS to HIGH_MS
+LOW_MS = 0.01
+HIGH_MS = 100000.0
+BINS_PER_DECADE = 20
+
+
+class LatencyHistogram:
+    # this class counts latencies (ms) in log spaced bins, so it takes the same memory and
+    # time however long it runs, the percentiles are good to about 6%
+
+    def __init__(self, low=LOW_MS, high=HIGH_MS, per_decade=BINS_PER_DECADE):
+        decades = np.log10(high / low)
+        self.edges = low * 10 ** (np.arange(int(decades * per_decade) + 1) / per_decade)
+
+        # one more bin below the first edge and one above the last
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        # this function adds one latency or an array of them
+        ms = np.atleast_1d(np.asarray(ms, dtype=np.float64))
+        if len(ms) == 0:
+            return
+        np.add.at(self.counts, np.searchsorted(self.edges, ms, side='right'), 1)
+        self.count += len(ms)
+        self.total += float(ms.sum())
+        self.max = max(self.max, float(ms.max()))
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentiles(self, q=(50, 90, 99)):
+        # this function returns the percentiles, each one the middle of its bin on a log scale
+        if self.count == 0:
+            return [0.0 for _ in q]
+        cum = np.cumsum(self.counts)
+        bins = np.searchsorted(cum, np.asarray(q, dtype=np.float64) / 100.0 * self.count, side='left')
+        low = self.edges[np.clip(bins - 1, 0, len(self.edges) - 1)]
+        high = self.edges[np.clip(bins, 0, len(self.edges) - 1)]
+        return [min(float(v), self.max) for v in np.sqrt(low * high)]
+
+    def rows(self):
+        # this function returns (upper edge ms, count) for every bin with something in it
+        upper = np.append(self.edges, np.inf)
+        used = np.flatnonzero(self.counts)
+        return list(zip(upper[used].tolist(), self.counts[used].tolist()))
+
+
+class CommandChannel:
+    # this class numbers the commands and matches the answers to them
+    # times are time.perf_counter() seconds
+
+    def __init__(self, timeout=COMMAND_TIMEOUT, retries=COMMAND_RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self.next_id = 1
+
+        # id -> [command, first sent, last sent, times sent, managed]
+        self.pending = {}
+
+        # the board has answered at least once, so it understands ids
+        self.acking = False
+
+        # statistics
+        self.latency = LatencyHistogram()
+        self.sent = 0
+        self.acked = 0
+        self.retried = 0
+        self.failed = 0
+        self.unanswered = 0
+
+    def encode(self, command, now, managed=True):
+        # this function gives a command the next id and returns the id and the bytes to send
+        # managed=False is for a caller that waits for the answer itself, e.g. the link
+        # probes, the command is never sent again and its round trip is left out of the histogram
+        rid = self.next_id
+        self.next_id = rid % MAX_ID + 1
+        self.pending[rid] = [command, now, now, 1, managed]
+        self.sent += 1
+        return rid, frames.encode_command(command, rid)
+
+    def cancel(self, rid):
+        # this function stops waiting for the answer to a command
+        self.pending.pop(rid, None)
+
+    def ack(self, rid, func, now):
+        # this function takes an answer from the board and returns the command and its round
+        # trip in ms, None for an id no longer waiting (the answer to a command sent twice)
+        self.acking = True
+        entry = self.pending.pop(rid, None)
+        if entry is None:
+            return None
+        ms = (now - entry[1]) * 1000.0
+        if entry[4]:
+            self.latency.add(ms)
+        self.acked += 1
+        return entry[0], ms
+
+    def due(self, now):
+        # this function returns the seconds until the oldest unanswered command times out,
+        # None if nothing is waiting
+        last = [entry[2] for entry in self.pending.values() if entry[4]]
+        if not last:
+            return None
+        return max(min(last) + self.timeout - now, 0.0)
+
+    def expired(self, now):
+        # this function returns the bytes to send again and the commands given up on
+        resend = []
+        failed = []
+        for rid, entry in list(self.pending.items()):
+            if not entry[4] or now - entry[2] < self.timeout:
+                continue
+            if self.acking and entry[3] <= self.retries:
+                entry[2] = now
+                entry[3] += 1
+                self.retried += 1
+                resend.append(frames.encode_command(entry[0], rid))
+                continue
+            del self.pending[rid]
+            if self.acking:
+                self.failed += 1
+                failed.append(entry[0])
+            else:
+                # older firmware never answers
+                self.unanswered += 1
+        return resend, failed
+
+    def summary(self):
+        # this function returns a one line summary for the GUI and the benchmarks
+        p50, p90, p99 = self.latency.percentiles()
+        return ("commands %d  acked %d  retried %d  failed %d  round trip p50 %.1f p90 %.1f p99 %.1f max %.1f ms"
+                % (self.sent, self.acked, self.retried, self.failed, p50, p90, p99, self.latency.max))
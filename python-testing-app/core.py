@@ -0,0 +1,101 @@
+# core.py
+# headless acquisition core of the logger
+#
+# Acquisition owns what a logging session needs without a screen: the ring buffer of recent
+# samples, the engine thread, the device with its running statistics and alarms, and the
+# commands behind the buttons of logger.py (log, stim, sense, test)
+# logger.py is only the tkinter shell around it, scripts and services import this module
+# instead, it never imports tkinter or matplotlib
+# given a ring name the buffer is a sharedring.SharedRing, so other processes can read the
+# samples as they arrive
+# starting and stopping logging return the engine future, the GUI leaves it running, a script
+# can wait on it, the other commands are queued and answered as in engine.Device.send()
+
+# import statements
+import os
+import serial.tools.list_ports
+import frames
+import session
+import link
+from ringbuffer import RingBuffer
+from sharedring import SharedRing, SHARED_CAPACITY
+from engine import Engine
+from streamstats import StreamStats, Alarm
+
+# samples kept in memory, older samples spill to disk
+BUFFER_CAPACITY = 2 ** 22
+
+# values used when a command is given none
+LOG_INTERVAL = "500"
+STIM_VOLTAGE = "3.3"
+SENSE_VOLTAGE = "0.6"
+
+
+def default_alarms():
+    # this function returns the alarms on the running statistics, the electrode is near the
+    # 3.3 V reference or falling fast
+    return [
+        Alarm("saturated", "ewma", high=3.2, hysteresis=0.05),
+        Alarm("falling", "slope", low=-0.5, hysteresis=0.1),
+    ]
+
+
+def port_available(port):
+    # this function checks that a port is listed, or is a path that can be opened the same
+    # way (a pty from simulator.py is not listed as a port)
+    listed = [p.device for p in serial.tools.list_ports.comports()]
+    return port in listed or os.path.exists(port)
+
+
+class Acquisition:
+    # this class runs one board without a GUI
+
+    def __init__(self, capacity=None, alarms=None, ring=None):
+        if ring is not None:
+            self.buffer = SharedRing(capacity or SHARED_CAPACITY, name=ring)
+        else:
+            self.buffer = RingBuffer(capacity=capacity or BUFFER_CAPACITY)
+        self.engine = Engine()
+        self.alarms = default_alarms() if alarms is None else alarms
+        self.dev = None
+
+    def connect(self, port, notify=None, negotiate=True, **device_args):
+        # this function opens the port at the safe rate and, with negotiate, moves it up to the
+        # fastest rate the link carries, commands given meanwhile wait for it
+        # raises LookupError if there is no such port
+        if not port_available(port):
+            raise LookupError("no port " + port)
+        if not self.engine.thread.is_alive():
+            self.engine.start()
+        self.dev = self.engine.open_device(port, baud=link.SAFE_BAUD, buffer=self.buffer, notify=notify,
+                                           monitor=StreamStats(alarms=self.alarms), **device_args)
+        if negotiate:
+            self.engine.call(self.dev.negotiate())
+        return self.dev
+
+    def start_logging(self, val=LOG_INTERVAL, fmt=frames.ASCII, storage=session.CSV, base=None, echo=True):
+        # this function opens a session and starts logging every val ms
+        # "3," logs ascii lines and "5," logs binary frames
+        return self.engine.call(self.dev.start_logging(val or LOG_INTERVAL, fmt, storage, base, echo=echo))
+
+    def stop_logging(self):
+        # this function stops logging and finishes writing the session
+        return self.engine.call(self.dev.stop_logging())
+
+    def stimulate(self, val=STIM_VOLTAGE):
+        # this function sets the stimulation voltage, "0" stops it
+        self.dev.send("2," + (val or STIM_VOLTAGE))
+
+    def power_electrode(self, val=SENSE_VOLTAGE):
+        # this function sets the electrode voltage, "0" unpowers it
+        self.dev.send("4," + (val or SENSE_VOLTAGE))
+
+    def test_mode(self, val="1"):
+        # this function has the board generate test data, "0" returns it to normal
+        self.dev.send("0," + val)
+
+    def shutdown(self):
+        # this function closes the session and the port and stops the engine
+        self.engine.shutdown()
+        if isinstance(self.buffer, SharedRing):
+            self.buffer.unlink()
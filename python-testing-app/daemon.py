@@ -0,0 +1,422 @@
+# daemon.py
+# headless logging service with a local control socket
+#
+# "python daemon.py serve --port /dev/ttyACM0" keeps core.Acquisition running without a
+# window, for unattended overnight runs, and listens on a local socket
+# - a unix socket (SOCKET_PATH by default) or a tcp port on 127.0.0.1 (--tcp, for windows)
+# - one JSON object per line each way, {"cmd": "log_start", "val": "500"} is answered with
+#   {"ok": true, ...} or {"ok": false, "error": "..."}
+# - the commands are the buttons of logger.py, log_start (val, fmt "ascii"/"binary", storage
+#   "csv"/"chunk", base), log_stop, stim_start, stim_stop, sens_start, sens_stop, test_start
+#   and test_stop, and status (with the latest metrics), profile (seconds, path, samples the
+#   engine thread, see metrics.py), subscribe, unsubscribe and shutdown, SIGUSR1 profiles too
+# - after "subscribe" the connection also gets the new samples every STREAM_INTERVAL seconds as
+#   {"millis": [...], "value": [...]}, and the events of the board as {"event": ..., "args": [...]}
+# the samples are taken from the ring buffer and every batch is encoded once, each subscriber
+# has its own queue of QUEUE_DEPTH lines, a full queue loses its oldest line (counted in
+# "dropped") so a slow client never holds up the others or the reading of the board
+# the server runs on the engine's loop
+# with --ring <name> the buffer is in shared memory as well, for readers in other processes
+# (sharedring.RingReader), status tells its name
+#
+# "python daemon.py send log_start 500" and "python daemon.py watch" talk to a running daemon
+
+# import statements
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import threading
+import numpy as np
+import frames
+import session
+import core
+import metrics
+
+# where the daemon listens by default
+SOCKET_PATH = "sweatsens.sock"
+
+# seconds between batches of streamed samples, and batches a subscriber may fall behind
+STREAM_INTERVAL = 0.05
+QUEUE_DEPTH = 64
+
+# the daemon waits this long for a board that went away, the GUI gives up sooner
+RECONNECT_TIMEOUT = 3600.0
+
+# the commands that are the buttons of logger.py, name -> (core method, value given)
+BUTTONS = {
+    'stim_start': ('stimulate', None),
+    'stim_stop': ('stimulate', "0"),
+    'sens_start': ('power_electrode', None),
+    'sens_stop': ('power_electrode', "0"),
+    'test_start': ('test_mode', "1"),
+    'test_stop': ('test_mode', "0"),
+}
+
+
+def plain(obj):
+    # this function turns numpy values and rows into what json can write
+    if isinstance(obj, np.void) and obj.dtype.names:
+        return {name: plain(obj[name]) for name in obj.dtype.names}
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, dict):
+        return {key: plain(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [plain(value) for value in obj]
+    return obj
+
+
+def encode(message):
+    # this function returns one line of the protocol
+    return (json.dumps(plain(message)) + "\n").encode()
+
+
+class Subscriber:
+    # this class holds the lines waiting for one client, written by its own task
+
+    def __init__(self, writer, depth=QUEUE_DEPTH):
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize=depth)
+        self.sent = 0
+        self.dropped = 0
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def offer(self, line):
+        # this function queues a line without ever waiting, the oldest goes if it is full
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+    async def _run(self):
+        # this function writes the lines as fast as the client takes them
+        try:
+            while True:
+                line = await self.queue.get()
+                self.writer.write(line)
+                await self.writer.drain()
+                self.sent += 1
+        except ConnectionError:
+            # the connection handler notices it too and drops the subscriber
+            pass
+
+    def close(self):
+        self.task.cancel()
+
+    def status(self):
+        return {'sent': self.sent, 'dropped': self.dropped, 'queued': self.queue.qsize()}
+
+
+class Daemon:
+    # this class serves the control socket of an Acquisition on its engine's loop
+
+    def __init__(self, acq, depth=QUEUE_DEPTH, interval=STREAM_INTERVAL):
+        self.acq = acq
+        self.depth = depth
+        self.interval = interval
+        self.server = None
+        self.stream_task = None
+
+        # writer -> Subscriber, and writer -> task of every connection
+        self.subscribers = {}
+        self.clients = {}
+
+        # buffer total streamed so far, and samples the buffer lost before they were streamed
+        self.streamed = 0
+        self.missed = 0
+
+        # set by the shutdown command, the main thread waits on it
+        self.done = threading.Event()
+
+    async def start(self, path=SOCKET_PATH, tcp=None):
+        # this function starts listening and streaming
+        if tcp is not None:
+            self.server = await asyncio.start_server(self._client, "127.0.0.1", tcp)
+        else:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self._client, path)
+        self.streamed = self.acq.buffer.total
+        self.stream_task = asyncio.get_running_loop().create_task(self._stream())
+        return self
+
+    def notify(self, dev, event, *args):
+        # this function is the device's notify, it runs on the loop and passes the events on
+        if event == 'stats' or not self.subscribers:
+            return
+        line = encode({'event': event, 'args': args})
+        for sub in self.subscribers.values():
+            sub.offer(line)
+
+    async def _stream(self):
+        # this function passes the samples added to the buffer to every subscriber
+        buffer = self.acq.buffer
+        while True:
+            await asyncio.sleep(self.interval)
+            total = buffer.total
+            n = total - self.streamed
+            if n <= 0:
+                continue
+            if n > buffer.capacity:
+                self.missed += n - buffer.capacity
+                n = buffer.capacity
+            self.streamed = total
+            if not self.subscribers:
+                continue
+            times, values = buffer.view(n)
+            line = encode({'millis': times.astype(np.int64), 'value': values})
+            for sub in self.subscribers.values():
+                sub.offer(line)
+
+    async def _client(self, reader, writer):
+        # this function answers the commands of one connection until it closes
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    reply = await self.handle(request, writer)
+                except Exception as e:
+                    reply = {'ok': False, 'error': str(e)}
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            sub = self.subscribers.pop(writer, None)
+            if sub is not None:
+                sub.close()
+            writer.close()
+
+    async def handle(self, request, writer=None):
+        # this function runs one command and returns the reply
+        cmd = request.get('cmd')
+        val = request.get('val')
+        if val is not None:
+            val = str(val)
+        acq = self.acq
+
+        if cmd == 'log_start':
+            fmt = frames.BINARY if request.get('fmt') == 'binary' else frames.ASCII
+            storage = session.CHUNK if request.get('storage') == 'chunk' else session.CSV
+            base = await asyncio.wrap_future(acq.start_logging(val, fmt, storage, request.get('base'), echo=False))
+            return {'ok': True, 'session': base}
+
+        elif cmd == 'log_stop':
+            await asyncio.wrap_future(acq.stop_logging())
+            return {'ok': True}
+
+        elif cmd in BUTTONS:
+            method, value = BUTTONS[cmd]
+            getattr(acq, method)(value or val)
+            return {'ok': True}
+
+        elif cmd == 'status':
+            return dict(self.status(), ok=True)
+
+        elif cmd == 'subscribe':
+            if writer not in self.subscribers:
+                self.subscribers[writer] = Subscriber(writer, self.depth)
+            return {'ok': True}
+
+        elif cmd == 'unsubscribe':
+            sub = self.subscribers.pop(writer, None)
+            if sub is not None:
+                sub.close()
+            return {'ok': True}
+
+        elif cmd == 'profile':
+            # sample the engine thread, this loop included, from a worker thread
+            seconds = float(request.get('seconds', metrics.PROFILE_SECONDS))
+            path = request.get('path') or time.strftime("profile-%Y-%m-%d-%H-%M-%S.txt")
+            profiler = metrics.SamplingProfiler(acq.engine.thread.ident)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, profiler.run, seconds)
+            await loop.run_in_executor(None, profiler.write, path)
+            return {'ok': True, 'path': os.path.abspath(path), 'samples': profiler.samples, 'top': profiler.top()}
+
+        elif cmd == 'shutdown':
+            self.done.set()
+            return {'ok': True}
+
+        return {'ok': False, 'error': "unknown command %r" % (cmd,)}
+
+    def status(self):
+        # this function returns the state of the board, the session and the subscribers
+        dev = self.acq.dev
+        stats = dev.stats
+        latest = dev.monitor.latest() if dev.monitor is not None else None
+        return {
+            'port': dev.port,
+            'baud': dev.baud,
+            'connected': dev.connected,
+            'logging': dev.write_task is not None,
+            'session': dev.writer.path if dev.writer is not None else None,
+            'samples_in': stats.samples_in if stats else 0,
+            'samples_out': stats.samples_out if stats else 0,
+            'buffered': self.acq.buffer.total,
+            'ring': getattr(self.acq.buffer, 'name', None),
+            'missed': self.missed,
+            'commands': dev.channel.summary(),
+            'stats': latest,
+            'subscribers': [sub.status() for sub in self.subscribers.values()],
+            'metrics': dev.metrics.latest if dev.metrics is not None else None,
+        }
+
+    async def close(self):
+        # this function stops listening and drops the subscribers
+        if self.stream_task is not None:
+            self.stream_task.cancel()
+            await asyncio.gather(self.stream_task, return_exceptions=True)
+            self.stream_task = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        # an aborted connection ends its task as if the client had gone, close() would wait
+        # for a client that stopped reading to take what is queued for it
+        clients = list(self.clients.items())
+        for writer, task in clients:
+            writer.transport.abort()
+        await asyncio.gather(*[task for writer, task in clients], return_exceptions=True)
+
+
+class DaemonClient:
+    # this class is a blocking connection to a running daemon, for scripts
+
+    def __init__(self, path=SOCKET_PATH, tcp=None, timeout=10.0):
+        if tcp is not None:
+            self.sock = socket.create_connection(("127.0.0.1", tcp), timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        self.f = self.sock.makefile("rb")
+
+        # samples and events that came in while waiting for a reply
+        self.pending = []
+
+    def call(self, cmd, **args):
+        # this function sends a command and returns the reply
+        args['cmd'] = cmd
+        self.sock.sendall(encode(args))
+        while True:
+            message = self.read()
+            if 'ok' in message:
+                return message
+            self.pending.append(message)
+
+    def read(self):
+        # this function returns the next message, raises ConnectionError once the daemon is gone
+        line = self.f.readline()
+        if not line:
+            raise ConnectionError("daemon closed the connection")
+        return json.loads(line)
+
+    def messages(self):
+        # this function yields the samples and events after subscribe, forever
+        while True:
+            if self.pending:
+                yield self.pending.pop(0)
+            else:
+                yield self.read()
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+
+def serve(args):
+    # this function runs the daemon until the shutdown command, Ctrl-C or SIGTERM
+    acq = core.Acquisition(ring=args.ring)
+    daemon = Daemon(acq, args.depth)
+    try:
+        acq.connect(args.port, notify=daemon.notify, negotiate=not args.no_negotiate,
+                    reconnect_timeout=args.reconnect_timeout)
+    except (LookupError, OSError) as e:
+        print("No Arduino connected! (%s)" % e)
+        acq.shutdown()
+        return 1
+    acq.engine.call(daemon.start(args.socket, args.tcp)).result()
+    print("Listening on " + (args.socket if args.tcp is None else "127.0.0.1:%d" % args.tcp))
+
+    # a service manager stops the daemon with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.done.set())
+    metrics.profile_on_signal(acq.engine.thread.ident)
+    try:
+        while not daemon.done.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    acq.engine.call(daemon.close()).result()
+    acq.shutdown()
+    if args.tcp is None and os.path.exists(args.socket):
+        os.unlink(args.socket)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless SWEATsens logging service")
+    parser.add_argument("action", choices=["serve", "send", "watch"])
+    parser.add_argument("cmd", nargs="?", help="command to send, e.g. log_start or status")
+    parser.add_argument("val", nargs="?", help="value of the command")
+    parser.add_argument("--port", default="COM4", help="serial port of the board")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="unix socket to listen on")
+    parser.add_argument("--tcp", type=int, default=None, help="listen on this tcp port of 127.0.0.1 instead")
+    parser.add_argument("--ring", default=None, help="also publish the samples in this shared memory ring")
+    parser.add_argument("--depth", type=int, default=QUEUE_DEPTH, help="lines a subscriber may fall behind")
+    parser.add_argument("--reconnect-timeout", type=float, default=RECONNECT_TIMEOUT,
+                        help="seconds to wait for a board that went away")
+    parser.add_argument("--no-negotiate", action="store_true", help="stay at the safe rate")
+    parser.add_argument("--binary", action="store_true", help="log_start with binary frames")
+    parser.add_argument("--chunk", action="store_true", help="log_start with a compressed session")
+    parser.add_argument("--seconds", type=float, default=None, help="how long profile samples")
+    args = parser.parse_args()
+
+    if args.action == "serve":
+        return serve(args)
+
+    try:
+        client = DaemonClient(args.socket, args.tcp)
+    except OSError as e:
+        print("No daemon listening! (%s)" % e)
+        return 1
+    if args.action == "send":
+        request = {}
+        if args.val is not None:
+            request['val'] = args.val
+        if args.seconds is not None:
+            request['seconds'] = args.seconds
+        if args.cmd == "log_start":
+            request['fmt'] = "binary" if args.binary else "ascii"
+            request['storage'] = "chunk" if args.chunk else "csv"
+        reply = client.call(args.cmd or "status", **request)
+        print(json.dumps(reply, indent=1))
+        client.close()
+        return 0 if reply['ok'] else 1
+
+    # watch prints the samples and events as they come
+    client.call("subscribe")
+    try:
+        for message in client.messages():
+            if 'event' in message:
+                print("event %s %s" % (message['event'], message['args']))
+            elif message['millis']:
+                print("%d samples  %d ms  %.3f" % (len(message['millis']), message['millis'][-1],
+                                                   message['value'][-1]))
+    except (KeyboardInterrupt, ConnectionError):
+        pass
+    client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
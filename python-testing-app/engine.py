@@ -0,0 +1,726 @@
+# engine.py
+# asyncio acquisition engine
+#
+# the engine runs one asyncio loop on a background thread, every board is a Device with
+# its own tasks on that loop
+# - reader, waits on the serial file descriptor and decodes whatever arrived
+# - writer, takes batches off a bounded queue and writes them to the session file
+# - commands, sends "func,val" commands to the board with a request id and sends again
+#   any the board has not answered in time (commands.py)
+# negotiate() moves the port and the board to the fastest rate the link carries intact
+# (link.py), commands and sessions wait until it is done
+# - monitor, feeds the logged samples through the running statistics and alarms a few
+#   times a second on a worker thread (streamstats.py), so the reader only hands them on
+# the engine watches the ports for coming and going (hotplug.py), a board that is unplugged
+# is noticed within milliseconds, by the event or by the read failing
+# - a session stays open while the board is away, what was read is still written
+# - when the port comes back it is opened again, the rate negotiated again and logging
+#   started again into the same session, the board restarting is seen in its millis()
+# - if it is not back within reconnect_timeout seconds the session is finished
+# every stage of a read is timed and counted (metrics.py), a snapshot is emitted as 'metrics'
+# every metrics_interval seconds and logged next to the session
+# every read is stamped with the host clock, and while logging the board millis are
+# unwrapped and fitted to it (timesync.py), the fit is saved next to the session
+# nothing polls while idle, and stopping cancels the tasks in order so every sample
+# that was read is written before the files are closed
+# the GUI never touches the devices directly, events are handed to TkAdapter which
+# runs them on the tkinter mainloop
+
+# import statements
+import os
+import time
+import asyncio
+import concurrent.futures
+from datetime import datetime
+from queue import SimpleQueue
+from threading import Thread
+import numpy as np
+import serial
+import frames
+import session
+import commands
+import link
+import timesync
+import hotplug
+import metrics
+from pipeline import PipelineStats, StatusLine
+
+# older firmware reads commands with Serial.readString(), which only returns after 1 s
+# without new data, so commands closer together than this are merged into one
+# the gap is kept until the board first acknowledges a command, after that commands go
+# out as soon as they are queued
+COMMAND_GAP = 1.0
+
+# seconds close() waits for the commands still queued (the stop) to be written, the gap can
+# hold one up that long
+CLOSE_TIMEOUT = COMMAND_GAP + 1.0
+
+# seconds to wait for an unplugged board to come back before the session is finished
+RECONNECT_TIMEOUT = 60.0
+
+# seconds before opening a port that is back is tried again, udev may not have given it
+# its permissions yet
+REOPEN_DELAY = 0.1
+
+
+class Device:
+    # this class is one board on one serial port
+
+    def __init__(self, engine, port, baud=link.SAFE_BAUD, buffer=None, notify=None, reconnect=True,
+                 reconnect_timeout=RECONNECT_TIMEOUT, command_gap=COMMAND_GAP, max_batches=64, monitor=None,
+                 monitor_interval=0.2, command_timeout=commands.COMMAND_TIMEOUT,
+                 command_retries=commands.COMMAND_RETRIES, instrument=True,
+                 metrics_interval=metrics.METRICS_INTERVAL):
+        self.engine = engine
+        self.port = port
+        self.baud = baud
+        self.buffer = buffer
+        self.reconnect = reconnect
+        self.reconnect_timeout = reconnect_timeout
+        self.command_gap = command_gap
+        self.max_batches = max_batches
+
+        # request ids, answers and round trip times of the commands
+        self.channel = commands.CommandChannel(command_timeout, command_retries)
+
+        # running statistics of the logged samples, a streamstats.StreamStats or None
+        self.monitor = monitor
+        self.monitor_interval = monitor_interval
+        self.monitor_batches = []
+
+        # set by a new session, the statistics start again before its first batch, with the
+        # counts setting of its format
+        self.monitor_reset = False
+        self.monitor_counts = None
+
+        # counters and stage latencies, None leaves the hot path without them
+        self.metrics = metrics.Metrics() if instrument else None
+        self.metrics_interval = metrics_interval
+        self.metrics_log = None
+
+        # notify(device, event, *args) is called on the loop thread
+        self.notify = notify
+
+        self.ser = None
+        self.tasks = []
+        self.io_tasks = []
+        self.connected = False
+        self.closing = False
+
+        # while unplugged, when it happened and the timer that finishes the session
+        self.unplugged = None
+        self.deadline = None
+        self.reopening = False
+        self.reconnects = 0
+
+        # logging state, only set while a session is open
+        self.decoder = None
+        self.writer = None
+        self.write_queue = None
+        self.write_task = None
+        self.stats = None
+        self.status = None
+        self.clock = None
+        self.logging_command = None
+        self.fmt = None
+        self.messages = []
+        self.idle = b''
+
+        # answers waited for by request(), and the test frames of negotiate()
+        self.answers = {}
+        self.last_read = 0.0
+        self.probe = None
+        self.link = np.empty(0, dtype=link.LINK_DTYPE)
+        self.link_args = None
+
+    def _emit(self, event, *args):
+        if self.notify is not None:
+            self.notify(self, event, *args)
+
+    async def open(self):
+        # this function opens the port and starts the tasks
+        loop = asyncio.get_running_loop()
+        self.commands = asyncio.Queue()
+        self.link_lock = asyncio.Lock()
+        self._connect(self.baud)
+        if self.monitor is not None:
+            self.tasks.append(loop.create_task(self._monitor()))
+        if self.metrics is not None:
+            self.tasks.append(loop.create_task(self._metrics()))
+        self.engine.hotplug.watch(self.port, self._plugged)
+        self._emit('connected')
+
+    def _connect(self, baud):
+        # this function opens the port and starts the tasks that use it
+        loop = asyncio.get_running_loop()
+        self.ser = serial.Serial(self.port, baud, timeout=0)
+        self.ser.reset_input_buffer()
+        self.connected = True
+
+        # on posix the loop watches the port itself, so waiting for data costs nothing
+        self.readable = None
+        if os.name == 'posix':
+            self.readable = asyncio.Event()
+            loop.add_reader(self.ser.fileno(), self.readable.set)
+
+        self.io_tasks = [
+            loop.create_task(self._reader()),
+            loop.create_task(self._commands()),
+        ]
+
+    async def close(self):
+        # this function stops logging and the tasks, then closes the port
+        self.closing = True
+        self.engine.hotplug.unwatch(self.port, self._plugged)
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        await self.stop_logging(send=self.connected)
+
+        # stopping only queues "3,0", it has to go out before the commands task is cancelled
+        if self.connected:
+            try:
+                await asyncio.wait_for(self.commands.join(), CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        tasks = self.tasks + self.io_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+        self.io_tasks = []
+        if self.connected:
+            self._unwatch()
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    async def _read(self):
+        # this function returns the next bytes from the port
+        if self.readable is not None:
+            await self.readable.wait()
+            self.readable.clear()
+            m = self.metrics
+            if m is None:
+                return self.ser.read(max(self.ser.in_waiting, 1))
+
+            # the bytes waiting in the OS buffer show how close it is to overrunning
+            start = time.perf_counter()
+            waiting = self.ser.in_waiting
+            data = self.ser.read(max(waiting, 1))
+            m.read.add(time.perf_counter() - start)
+            m.serial_fill = waiting
+            if waiting > m.max_serial_fill:
+                m.max_serial_fill = waiting
+            return data
+
+        # without file descriptors (windows) a worker thread does the blocking read
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._blocking_read)
+
+    def _unwatch(self):
+        # this function stops the loop watching the port
+        if self.readable is not None:
+            asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            self.readable = None
+
+    def _blocking_read(self):
+        self.ser.timeout = 0.1
+        return self.ser.read(max(self.ser.in_waiting, 1))
+
+    async def _reader(self):
+        # this function reads and decodes everything the board sends
+        while True:
+            try:
+                data = await self._read()
+            except (OSError, serial.SerialException):
+                await self._disconnected()
+                return
+            received = time.perf_counter()
+            if not data:
+                continue
+            self.last_read = received
+            m = self.metrics
+            if m is not None:
+                m.reads += 1
+                m.bytes_in += len(data)
+
+            # test frames while the rate is negotiated
+            if self.probe is not None:
+                self._acked(self.probe.feed(data, received), received)
+                continue
+
+            # outside of a session the output is only kept as messages
+            if self.decoder is None:
+                self._idle(data, received)
+                continue
+
+            errors = self.decoder.errors
+            millis, values = self._decode(data)
+            if self.decoder.acks:
+                self._acked(self.decoder.acks, received)
+                self.decoder.acks = []
+            if m is not None:
+                m.parse_errors += self.decoder.errors - errors
+            if len(millis) == 0:
+                continue
+
+            # board millis keep counting past the 32 bit wrap, and the fit is updated, samples
+            # going back in time are garbled and dropped
+            millis, hosts, keep = self.clock.feed(millis, received)
+            if keep is not None:
+                values = values[keep]
+                if m is not None:
+                    m.parse_errors += len(keep) - len(millis)
+                if len(millis) == 0:
+                    continue
+            if m is not None:
+                decoded = time.perf_counter()
+                m.decode.add(decoded - received)
+                m.samples_in += len(millis)
+
+            # the buffer feeds the plot, keep it current even if the disk is slow
+            if self.buffer is not None:
+                self.buffer.append(millis, values)
+            if self.monitor is not None:
+                self.monitor_batches.append((millis, values))
+            self.stats.samples_in += len(millis)
+
+            # wait for the writer only when the queue is full
+            await self.write_queue.put((millis, values, time.perf_counter()))
+            depth = self.write_queue.qsize()
+            self.stats.batches += 1
+            self.stats.max_depth = max(self.stats.max_depth, depth)
+            if m is not None:
+                m.batches += 1
+                m.queue_depth = depth
+                if depth > m.max_queue_depth:
+                    m.max_queue_depth = depth
+
+            if self.status is not None:
+                self.status.update(self.stats, millis, values, depth)
+
+    def _idle(self, data, received):
+        # this function keeps the output outside of a session as messages and picks out
+        # the command acknowledgements, a partial line is kept for the next read
+        lines = (self.idle + data).split(b'\n')
+        self.idle = lines.pop()[-256:]
+        acks = []
+        for line in lines:
+            ack = frames.parse_ack(line)
+            if ack is not None:
+                acks.append(ack)
+            elif line.strip():
+                self.messages.append(line.strip().decode('utf-8', 'replace'))
+        del self.messages[:-100]
+        if acks:
+            self._acked(acks, received)
+
+    def _acked(self, acks, received):
+        # this function matches answers from the board to the commands waiting for them
+        for rid, func in acks:
+            answer = self.channel.ack(rid, func, received)
+            waiter = self.answers.pop(rid, None)
+            if waiter is not None:
+                if not waiter.done():
+                    waiter.set_result(answer[1] if answer is not None else None)
+            elif answer is not None:
+                self._emit('ack', *answer)
+
+    def _decode(self, data):
+        # this function decodes bytes into arrays of times and values
+        if isinstance(self.decoder, frames.FrameReader):
+            samples = self.decoder.feed(data)
+            return samples['millis'], samples['value']
+        return self.decoder.feed(data)
+
+    async def _writer(self, writer, queue, stats):
+        # this function writes batches until it gets None
+        # the file is written on a worker thread so the loop never waits on the disk
+        loop = asyncio.get_running_loop()
+        m = self.metrics
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+            start = time.perf_counter()
+            await loop.run_in_executor(None, writer.write, batch[0], batch[1])
+            stats.samples_out += len(batch[0])
+            if m is not None:
+                m.queue.add(start - batch[2])
+                m.write.add(time.perf_counter() - start)
+        await loop.run_in_executor(None, writer.close)
+
+    async def _monitor(self):
+        # this function runs the statistics on the batches read since it last woke up
+        # and posts the newest row ('stats') and every alarm that went on or off ('alarm')
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.monitor_interval)
+            if self.monitor_reset:
+                self.monitor_reset = False
+                await loop.run_in_executor(None, self.monitor.reset, self.monitor_counts)
+            if not self.monitor_batches:
+                continue
+            batches = self.monitor_batches
+            self.monitor_batches = []
+            millis = np.concatenate([b[0] for b in batches])
+            values = np.concatenate([b[1] for b in batches])
+            rows, events = await loop.run_in_executor(None, self.monitor.feed, millis, values)
+            for event in events:
+                self._emit('alarm', event)
+            self._emit('stats', self.monitor.latest())
+
+    async def _metrics(self):
+        # this function takes a snapshot of the metrics every interval, posts it ('metrics')
+        # and logs it while a session is open
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            row = self.metrics.snapshot()
+            if self.metrics_log is not None:
+                self.metrics_log.write(row)
+            self._emit('metrics', row)
+
+    def _plugged(self, port, present):
+        # this function is called by the hotplug monitor when the port comes or goes
+        loop = asyncio.get_running_loop()
+        if not present and self.connected:
+            loop.create_task(self._lost())
+        elif present and not self.connected and self.deadline is not None:
+            loop.create_task(self._reopen())
+
+    async def _lost(self):
+        # this function lets the reader take what is left on the port, it finds the port
+        # gone and disconnects, unless the read is stuck
+        if self.readable is not None:
+            self.readable.set()
+        await asyncio.sleep(0.05)
+        if self.connected and not hotplug.port_present(self.port):
+            await self._disconnected()
+
+    async def _disconnected(self):
+        # this function stops using the port when the board goes away, the session is kept
+        # open until the board comes back or reconnect_timeout runs out
+        if not self.connected:
+            return
+        self.connected = False
+        self._unwatch()
+        current = asyncio.current_task()
+        for task in self.io_tasks:
+            if task is not current:
+                task.cancel()
+        try:
+            self.ser.close()
+        except (OSError, serial.SerialException):
+            pass
+
+        # what was decoded is already queued for the writer, only a partial frame is lost
+        if self.decoder is not None:
+            self.decoder = frames.FrameReader() if self.fmt == frames.BINARY else frames.LineReader()
+        self.unplugged = time.perf_counter()
+        if not self.reconnect or self.closing:
+            await self._give_up()
+            return
+        loop = asyncio.get_running_loop()
+        self.deadline = loop.call_later(self.reconnect_timeout, lambda: loop.create_task(self._give_up()))
+        self._emit('unplugged')
+
+        # it may be back already
+        if hotplug.port_present(self.port):
+            await self._reopen()
+
+    async def _give_up(self):
+        # this function finishes the session of a board that did not come back
+        self.deadline = None
+        if self.connected:
+            return
+        self.engine.hotplug.unwatch(self.port, self._plugged)
+        await self.stop_logging(send=False)
+        self._emit('disconnected')
+
+    async def _reopen(self):
+        # this function opens the port again once it is back and carries on where it was
+        if self.connected or self.reopening or self.deadline is None:
+            return
+        self.reopening = True
+        loop = asyncio.get_running_loop()
+        try:
+            # a board that was unplugged has restarted at the safe rate
+            try:
+                self._connect(link.SAFE_BAUD)
+            except (OSError, serial.SerialException):
+                # not ready yet, e.g. no permissions, there may be no further event
+                loop.call_later(REOPEN_DELAY, self._plugged, self.port, hotplug.port_present(self.port))
+                return
+            self.deadline.cancel()
+            self.deadline = None
+            self.reconnects += 1
+            if self.clock is not None:
+                self.clock.unwrapper.restart()
+
+            # nothing is logged while the rate is negotiated again, the decoder is kept aside
+            # so the answers are read as lines
+            decoder = self.decoder
+            self.decoder = None
+            if self.link_args is not None:
+                async with self.link_lock:
+                    await self._negotiate(*self.link_args)
+
+            # start logging again into the session, unless it was stopped meanwhile
+            if self.write_task is not None:
+                self.decoder = decoder
+                self.commands.put_nowait(self.logging_command)
+            self._emit('reconnected', time.perf_counter() - self.unplugged)
+        finally:
+            self.reopening = False
+
+    async def _commands(self):
+        # this function sends queued commands with their ids as soon as they are queued, or
+        # spaced by the gap until the board has shown it answers, and sends again the ones
+        # not answered in time
+        loop = asyncio.get_running_loop()
+        last = 0.0
+        ser = self.ser
+
+        # before python 3.12 wait_for() drops a cancel that comes as the queue hands over a
+        # command, so the task also stops once the device closes, after the commands still
+        # queued, or the port is opened again
+        while self.ser is ser and not (self.closing and self.commands.empty()):
+            # wait for a command, or until the oldest unanswered one is due again
+            try:
+                command = await asyncio.wait_for(self.commands.get(), self.channel.due(time.perf_counter()))
+            except asyncio.TimeoutError:
+                command = None
+            if command is not None and not self.channel.acking:
+                wait = last + self.command_gap - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            # nothing goes out while the rate is changing
+            async with self.link_lock:
+                now = time.perf_counter()
+                resend, failed = self.channel.expired(now)
+                out = b''.join(resend)
+                if command is not None:
+                    out += self.channel.encode(command, now)[1]
+                try:
+                    if out:
+                        self.ser.write(out)
+                except (OSError, serial.SerialException):
+                    if command is not None:
+                        self.commands.task_done()
+                    await self._disconnected()
+                    return
+            if command is not None:
+                last = loop.time()
+                self.commands.task_done()
+            for command in failed:
+                self._emit('command_failed', command)
+
+    def send(self, command):
+        # this function queues a command from any thread
+        self.engine.loop.call_soon_threadsafe(self.commands.put_nowait, command)
+
+    async def request(self, command, timeout):
+        # this function sends a command straight away, ahead of the queue and without sending
+        # it again, and returns its round trip in ms or None if it was not answered in time
+        loop = asyncio.get_running_loop()
+        rid, data = self.channel.encode(command, time.perf_counter(), managed=False)
+        waiter = loop.create_future()
+        self.answers[rid] = waiter
+        try:
+            self.ser.write(data)
+            return await asyncio.wait_for(waiter, timeout)
+        except (asyncio.TimeoutError, OSError, serial.SerialException):
+            return None
+        finally:
+            self.answers.pop(rid, None)
+            self.channel.cancel(rid)
+
+    async def _probe(self, baud, max_error):
+        # this function has the board send test frames at the current rate and returns the
+        # LINK_DTYPE row of what arrived
+        count = link.probe_frames(baud)
+        self.probe = link.LinkProbe(baud, count, time.perf_counter())
+        try:
+            # the frames take count * 10 * 9 / baud seconds, leave as long again and more
+            await self.request("7," + str(count), 0.5 + 2 * count * 10 * frames.FRAME_SIZE / baud)
+            return self.probe.result(max_error=max_error)
+        finally:
+            self.probe = None
+
+    async def negotiate(self, rates=link.RATES, max_error=link.MAX_ERROR, timeout=0.5):
+        # this function moves the port and the board up through rates while the test frames
+        # arrive intact and returns the rate it settled on
+        # every rate probed is kept in self.link as a LINK_DTYPE row, and posted as 'link'
+        async with self.link_lock:
+            await self.stop_logging()
+            return await self._negotiate(rates, max_error, timeout)
+
+    async def _negotiate(self, rates, max_error, timeout):
+        # this function is negotiate() with the link lock held and no session logging
+        self.link_args = (rates, max_error, timeout)
+
+        # an ack would wait behind what the board still has to send, e.g. the end of a
+        # session at a slow rate
+        give_up = time.perf_counter() + 10.0
+        while time.perf_counter() - self.last_read < 0.1 and time.perf_counter() < give_up:
+            await asyncio.sleep(0.05)
+
+        rows = []
+        best = self.ser.baudrate
+        for baud in rates:
+            if baud <= best:
+                continue
+
+            # the ack comes at the old rate, the board switches once it has gone out
+            if await self.request("6," + str(baud), timeout) is None:
+                break
+            switched = time.perf_counter()
+            self.ser.baudrate = baud
+            row = await self._probe(baud, max_error)
+
+            # keep the rate, both the probe and this have to get through
+            if row['ok'] and await self.request("6," + str(baud), timeout) is None:
+                row['ok'] = False
+            rows.append(row)
+            if row['ok']:
+                best = baud
+                continue
+
+            # give up on it, the board goes back by itself
+            self.ser.baudrate = best
+            await asyncio.sleep(max(switched + link.CONFIRM + 0.2 - time.perf_counter(), 0.0))
+            self.ser.reset_input_buffer()
+            break
+
+        self.baud = best
+        self.link = np.array(rows, dtype=link.LINK_DTYPE)
+        self._emit('link', best, self.link)
+        return best
+
+    async def start_logging(self, interval="500", fmt=frames.ASCII, storage=session.CSV, base=None, echo=False):
+        # this function opens a session file and starts logging
+        await self.stop_logging()
+
+        # wait for a negotiation still going on
+        async with self.link_lock:
+            pass
+
+        # get the current date for the file name
+        if base is None:
+            base = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+        # binary frames carry raw ADC counts, ascii lines may carry voltages
+        self.writer = session.open_writer(base, storage, 'u2' if fmt == frames.BINARY else 'f4')
+        self.clock = timesync.TimeSync(timesync.clock_path(self.writer.path))
+        if self.metrics is not None:
+            self.metrics_log = metrics.MetricsLog(metrics.metrics_path(self.writer.path))
+        if self.buffer is not None:
+            self.buffer.spill_to(base + "_spill.bin")
+
+        self.stats = PipelineStats()
+        self.status = StatusLine() if echo else None
+        self.write_queue = asyncio.Queue(maxsize=self.max_batches)
+        self.write_task = asyncio.get_running_loop().create_task(
+            self._writer(self.writer, self.write_queue, self.stats))
+        self.decoder = frames.FrameReader() if fmt == frames.BINARY else frames.LineReader()
+        self.fmt = fmt
+
+        # the statistics are per session, binary frames are always ADC counts, ascii lines are
+        # counts or, in test mode, whole volts, so they are looked at again
+        self.monitor_batches = []
+        self.monitor_counts = True if fmt == frames.BINARY else None
+        self.monitor_reset = True
+
+        # "3," logs ascii lines and "5," logs binary frames
+        self.logging_command = ("5," if fmt == frames.BINARY else "3,") + str(interval)
+        self.commands.put_nowait(self.logging_command)
+        self._emit('logging', True)
+        return base
+
+    async def stop_logging(self, send=True):
+        # this function stops logging and waits until everything read has been written
+        # a session is open while its writer runs, the decoder is also away while the board
+        # is unplugged
+        if self.write_task is None:
+            return
+        write_task = self.write_task
+        self.write_task = None
+        if send:
+            self.commands.put_nowait("3,0")
+        self.decoder = None
+        await self.write_queue.put(None)
+        await write_task
+        self.clock.close()
+        if self.metrics_log is not None:
+            self.metrics_log.close()
+            self.metrics_log = None
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.status is not None:
+            self.status.out.write("\n")
+        self._emit('logging', False)
+
+
+class Engine:
+    # this class owns the asyncio loop and the devices on it
+
+    def __init__(self, hotplug_interval=hotplug.POLL_INTERVAL, use_inotify=True):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.devices = []
+
+        # one watch on the ports for every device
+        self.hotplug = hotplug.HotplugMonitor(hotplug_interval, use_inotify)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.hotplug.start)
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def call(self, coro):
+        # this function runs a coroutine on the loop from any thread, returns a future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def open_device(self, port, **kwargs):
+        # this function opens a device and waits until it is running
+        device = Device(self, port, **kwargs)
+        self.call(device.open()).result()
+        self.devices.append(device)
+        return device
+
+    def shutdown(self, timeout=10.0):
+        # this function closes every device in order and stops the loop
+        if not self.thread.is_alive():
+            return
+        futures = [self.call(device.close()) for device in self.devices]
+        concurrent.futures.wait(futures, timeout=timeout)
+        self.devices = []
+        concurrent.futures.wait([self.call(self.hotplug.close())], timeout=timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+class TkAdapter:
+    # this class runs callbacks posted from the engine on the tkinter mainloop
+
+    def __init__(self, window, interval=100):
+        self.window = window
+        self.interval = interval
+        self.queue = SimpleQueue()
+        self.window.after(self.interval, self._poll)
+
+    def post(self, fn, *args):
+        # this function can be called from any thread
+        self.queue.put((fn, args))
+
+    def _poll(self):
+        while not self.queue.empty():
+            fn, args = self.queue.get()
+            fn(*args)
+        self.window.after(self.interval, self._poll)
@@ -0,0 +1,285 @@
+# fastcsv.py
+# fast reader for "millis,value" csv logs
+#
+# the logs are not clean csv, so np.loadtxt can not read them
+# - old logs end every line with a comma ("359452,1.36,")
+# - the firmware prints debug lines on the same port ("Connected event", "LED on", "1234")
+# - unplugging the board mid-write leaves a partial line at the end
+# every line is checked and parsed at once with numpy, only the lines the fast path can not
+# read (debug output, signs, exponents) are tried one at a time in python, the ones that are
+# still not "millis,value" are skipped and counted, and the last line only counts if it
+# ended with a newline
+#
+# the parser works on 8 bytes at a time (SWAR)
+# - the file is viewed as overlapping little endian uint64s, one starting at every byte,
+#   so the first 8 bytes of the line (millis) and of the value are two gathers per line
+# - commas and dots are found with the zero byte trick, (y - 0x01..) & ~y & 0x80..
+# - "0" is taken off every byte and the field is shifted to the top of the word, a byte is
+#   a digit if neither it nor it + 0x76 has the top bit set
+# - up to 8 digits are turned into a number with three multiplications
+# the file is memory mapped and read in blocks cut at a newline, so memory stays flat
+#
+# the fast path reads millis of up to 16 digits and values of up to 8 digits either side of
+# the point, anything longer goes through float() like a debug line
+
+# import statements
+import mmap
+import numpy as np
+
+# bytes parsed at a time, small enough that the working arrays stay in the cpu cache
+BLOCK_SIZE = 2 ** 19
+
+# padding around every block so the 8 byte reads never leave the buffer, the reads
+# reach up to 16 bytes before a line and 33 bytes after its start
+PAD = 16
+TAIL = 48
+
+ONE = np.uint64(1)
+ALL = np.uint64(2 ** 64 - 1)
+ONES = np.uint64(0x0101010101010101)
+HIGHS = np.uint64(0x8080808080808080)
+ZEROS = np.uint64(0x3030303030303030)
+SEVENTIES = np.uint64(0x7676767676767676)
+COMMAS = np.uint64(0x2C2C2C2C2C2C2C2C)
+DOTS = np.uint64(0x2E2E2E2E2E2E2E2E)
+
+# a point once the "0" has been taken off every byte
+DIGIT_DOTS = DOTS ^ ZEROS
+
+# powers of ten for the decimal point
+POWERS = 10.0 ** np.arange(17)
+
+# SCALES[n] divides a right aligned field whose point was byte n, 8 is no point
+SCALES = 10.0 ** np.array([7, 6, 5, 4, 3, 2, 1, 0, 0])
+
+# bit masks for counting the bits of a word before numpy 2.0
+PAIRS = np.uint64(0x5555555555555555)
+NIBBLES = np.uint64(0x3333333333333333)
+BYTES = np.uint64(0x0F0F0F0F0F0F0F0F)
+
+
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    def _popcount(words):
+        # this function counts the set bits of every word as uint8, like np.bitwise_count,
+        # which numpy has from 2.0 on
+        x = words - ((words >> ONE) & PAIRS)
+        x = (x & NIBBLES) + ((x >> np.uint64(2)) & NIBBLES)
+        x = (x + (x >> np.uint64(4))) & BYTES
+        return ((x * ONES) >> np.uint64(56)).astype(np.uint8)
+
+
+def _words(buf):
+    # this function views a buffer as a little endian uint64 starting at every byte
+    return np.ndarray(shape=(len(buf) - 7,), dtype='<u8', buffer=buf, strides=(1,))
+
+
+def _below(words, char):
+    # this function returns a mask of the bytes before the first byte equal to char in
+    # each word, all of them if there is none
+    y = words ^ char
+    t = (y - ONES) & ~y & HIGHS
+    t &= np.uint64(0) - t
+    t >>= np.uint64(7)
+    t -= ONE
+    return t
+
+
+def _first(words, char):
+    # this function returns the index of the first byte equal to char in each word, 8 if none
+    return _popcount(_below(words, char)) >> 3
+
+
+def _shift(width):
+    # this function returns the shift that pushes the other 8 - width bytes out of a word
+    return ((8 - width) * 8).astype(np.uint64)
+
+
+def _swar(digits):
+    # this function turns 8 digits (one per byte, the first in the lowest byte) into a
+    # number, returns it and a mask of the words that were all digits
+    check = digits + SEVENTIES
+    check |= digits
+    check &= HIGHS
+    ok = check == 0
+
+    # the eight digits are combined in pairs, then fours, then the whole
+    np.right_shift(digits, np.uint64(8), out=check)
+    d = digits * np.uint64(10)
+    d += check
+    np.bitwise_and(d, np.uint64(0x000000FF000000FF), out=check)
+    check *= np.uint64(100 + (1000000 << 32))
+    d >>= np.uint64(16)
+    d &= np.uint64(0x000000FF000000FF)
+    d *= np.uint64(1 + (10000 << 32))
+    d += check
+    d >>= np.uint64(32)
+    return d, ok
+
+
+def _field(words, end, width):
+    # this function returns the digits of the width bytes before end, right aligned with
+    # the bytes before the field set to 0, width must be 0 to 8
+    shift = _shift(width)
+    digits = words[end - 8] ^ ZEROS
+    digits >>= shift
+    digits <<= shift
+    return digits
+
+
+def _number(words, end, width):
+    # this function parses a field of up to 16 digits ending before end
+    value, ok = _swar(_field(words, end, np.minimum(width, 8)))
+    wide = np.flatnonzero(width > 8)
+    if len(wide):
+        high, ok_high = _swar(_field(words, end[wide] - 8, np.minimum(width[wide] - 8, 8)))
+        value[wide] += high * np.uint64(100000000)
+        ok[wide] &= ok_high & (width[wide] <= 16)
+    return value, ok
+
+
+def _decimal(words, b, first, ends):
+    # this function parses values with up to 8 digits either side of an optional point
+    head = _first(words[first], DOTS)
+    more = _first(words[first + 8], DOTS)
+    dot = first + np.where(head < 8, head, 8 + more)
+    has_dot = (dot < ends) & (b[dot] == 46)
+    point = np.where(has_dot, dot, ends)
+    whole, ok = _number(words, point, point - first)
+    places = np.where(has_dot, ends - dot - 1, 0)
+    frac, ok_frac = _number(words, ends, places)
+    ok &= ok_frac & (point - first <= 8) & (places <= 8) & (ends - first > has_dot)
+
+    # more than 15 digits do not fit a float exactly, they are left to float()
+    ok &= ends - first - has_dot <= 15
+    scale = POWERS[np.minimum(places, 16)]
+    return (whole.astype(np.float64) * scale + frac.astype(np.float64)) / scale, ok
+
+
+def parse_block(data, final=True):
+    # this function parses a block of whole lines
+    # returns millis (int64), values (float64) and the number of malformed lines
+    # if final is False the block must end with a newline, otherwise a last line without
+    # one is counted as a partial line
+    src = np.frombuffer(data, dtype=np.uint8)
+    b = np.empty(PAD + len(src) + TAIL, dtype=np.uint8)
+    b[:PAD] = 10
+    b[PAD:PAD + len(src)] = src
+    b[PAD + len(src):] = 10
+    words = _words(b)
+
+    # line ends, taking the last newline of the front padding and the first of the tail
+    # a \r that is not followed by \n ends a line too, as it did for csv.reader
+    inner = b[PAD - 1:len(b) - TAIL + 1]
+    nl = np.flatnonzero(inner == 10) + (PAD - 1)
+    crlf = b[nl - 1] == 13
+    if np.count_nonzero(inner == 13) > np.count_nonzero(crlf):
+        cr = np.flatnonzero(inner == 13) + (PAD - 1)
+        nl = np.sort(np.concatenate((nl, cr[b[cr + 1] != 10])))
+        crlf = b[nl - 1] == 13
+    partial = int(final and len(src) > 0 and src[-1] != 10 and src[-1] != 13)
+    starts = nl[:-1] + 1
+    ends = nl[1:]
+
+    # leave out a \r and then a trailing comma, the byte before an empty line is a newline
+    ends = ends - crlf[1:]
+    ends -= b[ends - 1] == 44
+    if partial:
+        ends[-1] = starts[-1]
+
+    # the first comma, almost always in the first 8 bytes of the line
+    head = words[starts]
+    width = _first(head, COMMAS)
+    late = np.flatnonzero(width == 8)
+    if len(late):
+        width[late] += _first(words[starts[late] + 8], COMMAS)
+    comma = starts + width
+    ok = (comma < ends) & (width > 0) & (width < 16)
+
+    # millis, the digits before the comma are already in the first word
+    millis, ok_millis = _swar((head ^ ZEROS) << _shift(np.minimum(width, 8)))
+    wide = late[width[late] > 8]
+    if len(wide):
+        millis[wide], ok_millis[wide] = _number(words, comma[wide], width[wide])
+    ok &= ok_millis
+
+    # value, the usual case of at most 8 bytes is done in one word with the point taken
+    # out, the bytes below the point move up one byte to close the gap
+    first = comma + 1
+    width = ends - first
+    digits = (words[first] ^ ZEROS) << _shift(np.minimum(width, 8))
+    below = _below(digits, DIGIT_DOTS)
+    has_dot = below != ALL
+    packed = (digits & below) << np.uint64(8)
+    packed |= digits & ~((below << np.uint64(8)) | np.uint64(0xFF))
+    mantissa, ok_value = _swar(np.where(has_dot, packed, digits))
+    values = mantissa.astype(np.float64)
+    values /= SCALES[_popcount(below) >> 3]
+    wide = np.flatnonzero(ok & (width > 8))
+    ok &= ok_value & (width > has_dot) & (width <= 8)
+
+    # longer values take the slow way
+    if len(wide):
+        values[wide], ok[wide] = _decimal(words, b, first[wide], ends[wide])
+
+    millis = millis.view(np.int64)
+
+    # the few lines left over (signs, exponents, extra columns or debug output) are tried
+    # the slow way, so everything the csv module read before is still read
+    errors = partial
+    for i in np.flatnonzero(~ok & (ends > starts)):
+        try:
+            millis[i], values[i] = _parse_line(bytes(b[starts[i]:ends[i]]))
+            ok[i] = True
+        except (IndexError, ValueError, OverflowError):
+            errors += 1
+    return millis[ok], values[ok], errors
+
+
+def _parse_line(line):
+    # this function parses one line the way csv.reader did, returns millis and value
+    row = line.decode('utf-8', 'replace').split(',')
+    return int(float(row[0])), float(row[1])
+
+
+def block_ranges(mm, start=0, block_size=BLOCK_SIZE):
+    # this function yields the (start, end) byte ranges of blocks of whole lines
+    # blocks are cut after a newline so no line is split, only the last one may end without
+    pos = start
+    size = len(mm)
+    while pos < size:
+        end = min(pos + block_size, size)
+        if end < size:
+            cut = mm.rfind(b'\n', pos, end)
+            if cut >= pos:
+                end = cut + 1
+            else:
+                # a line longer than a block, look for its end
+                cut = mm.find(b'\n', end)
+                end = size if cut < 0 else cut + 1
+        yield pos, end
+        pos = end
+
+
+def iter_blocks(path, block_size=BLOCK_SIZE):
+    # this function memory maps a file and yields (millis, values, errors) for every block
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            return
+        with mm:
+            for start, end in block_ranges(mm, 0, block_size):
+                yield parse_block(mm[start:end], final=end == len(mm))
+
+
+def load(path, block_size=BLOCK_SIZE):
+    # this function reads a whole csv log, returns millis, values and the malformed line count
+    parts = list(iter_blocks(path, block_size))
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), 0
+    millis = np.concatenate([p[0] for p in parts])
+    values = np.concatenate([p[1] for p in parts])
+    return millis, values, sum(p[2] for p in parts)
@@ -0,0 +1,364 @@
+# frames.py
+# binary formats shared by the board and the python apps
+#
+# serial frames
+# each frame carries the same fields as the old btOut_type BLE notification
+# (uint32 millis + uint16 voltage) with a sync word in front and a checksum after
+#
+#   offset  size  field
+#   0       2     sync word 0xA55A (little endian, so the bytes are 5A A5)
+#   2       4     millis
+#   6       2     voltage (raw ADC counts)
+#   8       1     checksum, sum of bytes 2-7 modulo 256
+#
+# command acknowledgements
+# commands are "func,val,id" lines, the board answers every command that has an id with
+# an "ack,id,func" line, or in binary mode with a frame laid out as above with the sync
+# word 0xA55B (bytes 5B A5), the id in place of millis and func in place of the voltage
+#
+# BLE batches
+# each logsCharacteristic notification carries up to batchSamples samples, the host
+# sets batchSamples from the negotiated MTU through batchCharacteristic
+#
+#   offset  size  field
+#   0       2     sequence number, one more for every notification, wraps at 2^16
+#   2       1     number of samples
+#   3       4     millis of the first sample
+#   7       4*n   per sample, ms since the previous sample (2) and voltage (2)
+
+# import statements
+import numpy as np
+
+# sync word and its two bytes as they appear on the wire
+SYNC = 0xA55A
+SYNC_BYTES = bytes([SYNC & 0xFF, SYNC >> 8])
+
+# sync word of an acknowledgement frame, only the first byte differs
+ACK_SYNC = 0xA55B
+ACK_SYNC_BYTES = bytes([ACK_SYNC & 0xFF, ACK_SYNC >> 8])
+
+# layout of one frame, packed with no padding
+FRAME_DTYPE = np.dtype([('sync', '<u2'), ('millis', '<u4'), ('value', '<u2'), ('check', 'u1')])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+
+# layout of the decoded samples handed to the rest of the app
+SAMPLE_DTYPE = np.dtype([('millis', '<u4'), ('value', '<u2')])
+
+# UUIDs of the board's BLE service and characteristics, from board_main.ino
+SERVICE_UUID = "2b6a5170-b7f2-11ed-b9d9-0800200c9a66"
+SWITCH_UUID = "3aa9bf30-bcbc-11ed-a901-0800200c9a66"
+TESTING_UUID = "9e69c9c0-bcbc-11ed-a901-0800200c9a66"
+STIMULATION_UUID = "7db08f70-bcbc-11ed-a901-0800200c9a66"
+SENSOR_UUID = "925486c0-bcbc-11ed-a901-0800200c9a66"
+LOGGING_UUID = "997fda80-bcbc-11ed-a901-0800200c9a66"
+LOGS_UUID = "c78725f0-bcbc-11ed-a901-0800200c9a66"
+END_UUID = "493a8bb0-bccb-11ed-a901-0800200c9a66"
+BATCH_UUID = "b1f0e7a0-bcbc-11ed-a901-0800200c9a66"
+
+# btOut_type, the one sample notification the board sent before batches, kept to compare
+# the struct is padded to 8 bytes on the board
+BLE_DTYPE = np.dtype({'names': ['millis', 'value'], 'formats': ['<u4', '<u2'], 'offsets': [0, 4], 'itemsize': 8})
+
+# header and samples of a BLE batch, packed with no padding
+BATCH_HEADER_DTYPE = np.dtype([('seq', '<u2'), ('count', 'u1'), ('base', '<u4')])
+BATCH_SAMPLE_DTYPE = np.dtype([('delta', '<u2'), ('value', '<u2')])
+BATCH_HEADER_SIZE = BATCH_HEADER_DTYPE.itemsize
+BATCH_SAMPLE_SIZE = BATCH_SAMPLE_DTYPE.itemsize
+
+# samples per batch, the least fits the default 23 byte MTU and the most a 247 byte MTU
+# the ATT header takes 3 bytes of the MTU
+MIN_BATCH = 3
+MAX_BATCH = 59
+
+
+def batch_samples(mtu):
+    # this function returns how many samples fit in one notification for an MTU
+    n = (mtu - 3 - BATCH_HEADER_SIZE) // BATCH_SAMPLE_SIZE
+    return min(max(n, MIN_BATCH), MAX_BATCH)
+
+
+# serial output formats, the board logs ascii for "3,<interval>" and frames for "5,<interval>"
+ASCII = 0
+BINARY = 1
+
+
+def encode_frames(millis, values):
+    # this function packs arrays of times and voltages into a run of frames
+    # used by the simulator and the benchmarks to produce board output
+    millis = np.asarray(millis, dtype='<u4')
+    values = np.asarray(values, dtype='<u2')
+
+    out = np.empty(len(millis), dtype=FRAME_DTYPE)
+    out['sync'] = SYNC
+    out['millis'] = millis
+    out['value'] = values
+
+    # the checksum covers the 6 payload bytes
+    raw = out.view(np.uint8).reshape(-1, FRAME_SIZE)
+    out['check'] = raw[:, 2:8].sum(axis=1, dtype=np.uint32) & 0xFF
+
+    return out.tobytes()
+
+
+def encode_acks(ids, funcs):
+    # this function packs command acknowledgements into ack frames, for the simulator
+    out = np.frombuffer(encode_frames(ids, funcs), dtype=FRAME_DTYPE).copy()
+    out['sync'] = ACK_SYNC
+    return out.tobytes()
+
+
+def encode_command(command, rid):
+    # this function returns the bytes of a "func,val" command with its request id
+    return (command + "," + str(rid) + "\n").encode('utf-8')
+
+
+def parse_ack(line):
+    # this function returns (id, func) of an "ack,id,func" line, None for any other line
+    if not line.startswith(b'ack,'):
+        return None
+    parts = line.strip().split(b',')
+    try:
+        return int(parts[1]), int(parts[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def pack_ble(millis, values):
+    # this function packs samples into btOut_type notifications, one bytes object each
+    packets = np.zeros(len(millis), dtype=BLE_DTYPE)
+    packets['millis'] = millis
+    packets['value'] = values
+    raw = packets.tobytes()
+    size = BLE_DTYPE.itemsize
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def decode_ble(buf):
+    # this function decodes a run of btOut_type notifications in one go
+    count = len(buf) // BLE_DTYPE.itemsize
+    return np.frombuffer(buf, dtype=BLE_DTYPE, count=count)
+
+
+def pack_ble_batches(millis, values, samples=MIN_BATCH, seq=0):
+    # this function packs samples into batched notifications, one bytes object each
+    # used by the simulator and the benchmarks to produce board output
+    millis = np.asarray(millis, dtype=np.int64)
+    values = np.asarray(values, dtype='<u2')
+    packets = []
+    for start in range(0, len(millis), samples):
+        t = millis[start:start + samples]
+        header = np.zeros(1, dtype=BATCH_HEADER_DTYPE)
+        header['seq'] = seq & 0xFFFF
+        header['count'] = len(t)
+        header['base'] = t[0]
+        body = np.empty(len(t), dtype=BATCH_SAMPLE_DTYPE)
+        body['delta'] = np.diff(t, prepend=t[0])
+        body['value'] = values[start:start + samples]
+        packets.append(header.tobytes() + body.tobytes())
+        seq += 1
+    return packets
+
+
+def decode_ble_batches(buf, lengths):
+    # this function decodes a run of batched notifications in one go
+    # lengths is the size of each notification as it arrived, so nothing is walked in python
+    # returns the samples, then for the good notifications their sequence numbers and sample
+    # counts, and a mask of which notifications were good
+    data = np.frombuffer(buf, dtype=np.uint8)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+
+    # a notification is bad if it is shorter than its header or its count disagrees with its size
+    whole = lengths >= BATCH_HEADER_SIZE
+    counts = np.zeros(len(lengths), dtype=np.int64)
+    counts[whole] = data[starts[whole] + 2]
+    good = whole & (lengths == BATCH_HEADER_SIZE + counts * BATCH_SAMPLE_SIZE)
+    starts = starts[good]
+    counts = counts[good]
+
+    # headers, gathered byte by byte because the notifications are not aligned
+    seq = data[starts].astype(np.uint16) | (data[starts + 1].astype(np.uint16) << 8)
+    base = np.zeros(len(starts), dtype=np.int64)
+    for i in range(4):
+        base |= data[starts + 3 + i].astype(np.int64) << (8 * i)
+
+    # empty notifications only carry a sequence number
+    packet_counts = counts
+    starts = starts[counts > 0]
+    base = base[counts > 0]
+    counts = counts[counts > 0]
+
+    # byte offset of every sample
+    total = int(counts.sum())
+    first = np.cumsum(counts) - counts
+    packet = np.repeat(np.arange(len(counts)), counts)
+    pos = starts[packet] + BATCH_HEADER_SIZE + BATCH_SAMPLE_SIZE * (np.arange(total) - first[packet])
+
+    delta = data[pos].astype(np.int64) | (data[pos + 1].astype(np.int64) << 8)
+    out = np.empty(total, dtype=SAMPLE_DTYPE)
+    out['value'] = data[pos + 2].astype(np.uint16) | (data[pos + 3].astype(np.uint16) << 8)
+
+    # the time of a sample is the base plus the deltas so far within its notification
+    run = np.cumsum(delta)
+    millis = base[packet] + run - (run[first] - delta[first])[packet]
+    out['millis'] = millis & 0xFFFFFFFF
+    return out, seq, packet_counts, good
+
+
+def _find_sync(data, start):
+    # this function returns the index of the next sync word (sample or ack) at or after start, or -1
+    first = data[start:-1]
+    hits = np.flatnonzero(((first == SYNC_BYTES[0]) | (first == ACK_SYNC_BYTES[0])) & (data[start + 1:] == SYNC_BYTES[1]))
+    if len(hits) == 0:
+        return -1
+    return start + int(hits[0])
+
+
+def decode_frames(buf, acks=None):
+    # this function decodes as many whole frames as possible from a byte buffer
+    # returns the samples, the number of bytes consumed and the number of bad frames
+    # ack frames are added to acks as (id, func), or dropped if acks is None
+    data = np.frombuffer(buf, dtype=np.uint8)
+    chunks = []
+    errors = 0
+    pos = 0
+
+    while len(data) - pos >= FRAME_SIZE:
+
+        # the fast path assumes the rest of the buffer is aligned on frames
+        count = (len(data) - pos) // FRAME_SIZE
+        raw = data[pos:pos + count * FRAME_SIZE].reshape(count, FRAME_SIZE)
+
+        # find the first frame that lost the sync word
+        synced = ((raw[:, 0] == SYNC_BYTES[0]) | (raw[:, 0] == ACK_SYNC_BYTES[0])) & (raw[:, 1] == SYNC_BYTES[1])
+        bad = np.flatnonzero(~synced)
+        good = count if len(bad) == 0 else int(bad[0])
+
+        if good > 0:
+            # drop frames whose checksum does not match
+            block = raw[:good]
+            check = block[:, 2:8].sum(axis=1, dtype=np.uint32) & 0xFF
+            ok = check == block[:, 8]
+            errors += int(good - np.count_nonzero(ok))
+
+            frames = block.copy().view(FRAME_DTYPE).reshape(-1)[ok]
+
+            # acknowledgements are rare, take them out of the samples
+            ack = frames['sync'] == ACK_SYNC
+            if ack.any():
+                if acks is not None:
+                    acks.extend(zip(frames['millis'][ack].tolist(), frames['value'][ack].tolist()))
+                frames = frames[~ack]
+            samples = np.empty(len(frames), dtype=SAMPLE_DTYPE)
+            samples['millis'] = frames['millis']
+            samples['value'] = frames['value']
+            chunks.append(samples)
+
+            pos += good * FRAME_SIZE
+
+        if good == count:
+            break
+
+        # out of sync, skip ahead to the next sync word
+        errors += 1
+        nxt = _find_sync(data, pos + 1)
+        if nxt < 0:
+            # keep a trailing half sync word in case the rest is still coming
+            pos = len(data) - 1 if data[-1] in (SYNC_BYTES[0], ACK_SYNC_BYTES[0]) else len(data)
+            break
+        pos = nxt
+
+    if chunks:
+        samples = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+    else:
+        samples = np.empty(0, dtype=SAMPLE_DTYPE)
+
+    return samples, pos, errors
+
+
+class FrameReader:
+    # this class reads binary frames from a serial port in bulk
+    # it keeps any partial frame between reads
+    # command acknowledgements are kept in acks as (id, func)
+
+    def __init__(self, ser=None, chunk=4096):
+        self.ser = ser
+        self.chunk = chunk
+        self.buf = bytearray()
+        self.frames = 0
+        self.errors = 0
+        self.acks = []
+
+    def read(self):
+        # read everything waiting on the port, or block for up to one chunk
+        waiting = self.ser.in_waiting
+        return self.feed(self.ser.read(waiting if waiting > 0 else self.chunk))
+
+    def feed(self, data):
+        # this function decodes bytes that were read elsewhere
+        self.buf += data
+
+        # decode the whole buffer in one go
+        samples, used, errors = decode_frames(bytes(self.buf), self.acks)
+        del self.buf[:used]
+
+        # update the statistics
+        self.frames += len(samples)
+        self.errors += errors
+
+        return samples
+
+
+class LineReader:
+    # this class reads ascii "millis,value" lines from a serial port in bulk
+    # lines without a comma (debug messages from the board, and the voltage the firmware
+    # prints before every sample) are kept in messages, the last 100 of them, and command
+    # acknowledgements in acks as (id, func)
+
+    def __init__(self, ser=None, chunk=4096):
+        self.ser = ser
+        self.chunk = chunk
+        self.buf = b''
+        self.lines = 0
+        self.errors = 0
+        self.messages = []
+        self.acks = []
+
+    def read(self):
+        # read everything waiting on the port, or block for up to one chunk
+        waiting = self.ser.in_waiting
+        return self.feed(self.ser.read(waiting if waiting > 0 else self.chunk))
+
+    def feed(self, data):
+        # this function decodes bytes that were read elsewhere
+        self.buf += data
+
+        # split off the complete lines and keep the partial one
+        lines = self.buf.split(b'\n')
+        self.buf = lines.pop()
+
+        millis = []
+        values = []
+        for line in lines:
+            if line.startswith(b'ack,'):
+                ack = parse_ack(line)
+                if ack is not None:
+                    self.acks.append(ack)
+                    continue
+            txt = line.strip().decode('utf-8', 'replace').split(',')
+            if len(txt) < 2:
+                if txt[0]:
+                    self.messages.append(txt[0])
+                continue
+            try:
+                t = int(float(txt[0]))
+                v = float(txt[1])
+            except ValueError:
+                self.errors += 1
+                continue
+            millis.append(t)
+            values.append(v)
+        del self.messages[:-100]
+
+        self.lines += len(millis)
+        return np.array(millis, dtype=np.int64), np.array(values, dtype=np.float64)
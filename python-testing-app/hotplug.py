@@ -0,0 +1,182 @@
+# hotplug.py
+# event driven detection of serial ports coming and going
+#
+# HotplugMonitor tells the engine when a watched port appears or disappears
+# - on linux it watches the directories of the ports with inotify, udev creates and removes
+#   the nodes in /dev (and the /dev/serial/by-id links) when a board is plugged or
+#   unplugged, and a pty from simulator.py appears and disappears in /dev/pts the same way,
+#   so nothing runs until something changes there and a change is seen within milliseconds
+# - a port given as a link is watched where the link is and where it points
+# - elsewhere, or if inotify can not be used, the ports are checked every interval seconds,
+#   the list of ports is only asked for when a port is not a path (COM ports on windows)
+# callbacks run on the asyncio loop as callback(port, present), once for every change
+
+# import statements
+import os
+import sys
+import struct
+import asyncio
+import ctypes
+import ctypes.util
+import serial.tools.list_ports
+
+# seconds between checks without inotify
+POLL_INTERVAL = 1.0
+
+# inotify events that can mean a port came or went (IN_ATTRIB for udev setting permissions
+# after creating a node, IN_DELETE_SELF / IN_MOVE_SELF for a directory going away)
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# header of an inotify event, wd, mask, cookie and the length of the name after it
+EVENT = struct.Struct("iIII")
+
+
+def _inotify():
+    # this function returns libc if it has inotify, None otherwise
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _existing(path):
+    # this function returns the closest directory above path that exists
+    path = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def port_present(port, listed=None):
+    # this function checks if a port is there, by its path or in the list of ports
+    if os.path.exists(port):
+        return True
+    if listed is None:
+        listed = [p.device for p in serial.tools.list_ports.comports()]
+    return port in listed
+
+
+class HotplugMonitor:
+    # this class watches ports on an asyncio loop, start() it on the loop
+
+    def __init__(self, interval=POLL_INTERVAL, use_inotify=True):
+        self.interval = interval
+        self.loop = None
+
+        # port -> callbacks and whether it was there at the last check
+        self.callbacks = {}
+        self.present = {}
+
+        # inotify file descriptor, and the directories watched by watch descriptor
+        self.libc = _inotify() if use_inotify else None
+        self.fd = None
+        self.dirs = {}
+        self.task = None
+
+        # statistics
+        self.events = 0
+        self.checks = 0
+
+    def start(self):
+        # this function starts watching, on the loop thread
+        self.loop = asyncio.get_running_loop()
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                self.loop.add_reader(self.fd, self._read)
+        if self.fd is None:
+            self.task = self.loop.create_task(self._poll())
+        return self
+
+    def watch(self, port, callback):
+        # this function calls callback(port, present) whenever the port comes or goes
+        self.callbacks.setdefault(port, []).append(callback)
+        if port not in self.present:
+            self.present[port] = port_present(port)
+        self._add_watches()
+
+    def unwatch(self, port, callback):
+        callbacks = self.callbacks.get(port, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.callbacks.pop(port, None)
+            self.present.pop(port, None)
+
+    def _add_watches(self):
+        # this function watches the directories of the ports and of whatever they link to
+        if self.fd is None:
+            return
+        wanted = set()
+        for port in self.callbacks:
+            if os.path.isabs(port) or os.path.exists(port):
+                wanted.add(_existing(port))
+                wanted.add(_existing(os.path.realpath(port)))
+        for directory in wanted - set(self.dirs.values()):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_MASK)
+            if wd >= 0:
+                self.dirs[wd] = directory
+
+    def _read(self):
+        # this function takes the inotify events and checks the ports again
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size + length
+            self.events += 1
+
+            # a watched directory that is gone has to be watched again from further up
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.dirs.pop(wd, None)
+        self._add_watches()
+        self._check()
+
+    async def _poll(self):
+        # this function checks the ports every interval without inotify
+        while True:
+            await asyncio.sleep(self.interval)
+            self._check(poll=True)
+
+    def _check(self, poll=False):
+        # this function calls the callbacks of every port that came or went
+        self.checks += 1
+        listed = None
+        for port in list(self.callbacks):
+            if poll and listed is None and not os.path.exists(port):
+                listed = [p.device for p in serial.tools.list_ports.comports()]
+            present = port_present(port, listed if listed is not None else [])
+            if present == self.present.get(port):
+                continue
+            self.present[port] = present
+            for callback in list(self.callbacks.get(port, [])):
+                callback(port, present)
+
+    async def close(self):
+        # this function stops watching, on the loop thread
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            self.dirs = {}
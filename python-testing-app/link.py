@@ -0,0 +1,110 @@
+# link.py
+# serial link rate negotiation
+#
+# the board and the host start at SAFE_BAUD, where a "359452,1.36\r\n" line takes about
+# 14 ms, and engine.Device.negotiate() moves them to the fastest rate that carries the data
+# intact, one rate of RATES at a time
+# - "6,<baud>" is acknowledged at the old rate, then both sides switch
+# - "7,<n>" has the board send n test frames and an ack frame (see board_main.ino), the
+#   frames that arrive intact give the throughput and the error rate of the rate
+# - a good rate is kept by sending "6,<baud>" again at that rate, the board goes back to the
+#   rate before by itself CONFIRM seconds after a switch that is not kept, so a rate too
+#   fast for the link only has to be given up on the host
+# the first rate that fails ends the search, faster ones would only be worse
+# firmware that does not answer "6," stays at SAFE_BAUD
+#
+# the rate only matters on a UART (an external USB serial adapter, a radio module), the
+# native USB port of the board runs at full speed whatever the rate
+
+# import statements
+import time
+import numpy as np
+import frames
+
+# the rate both sides start at and the rates tried above it
+SAFE_BAUD = 9600
+RATES = (19200, 38400, 57600, 115200, 230400, 460800, 921600, 1000000, 2000000)
+
+# seconds of test frames sent at each rate, and the most the board sends at once
+PROBE_SECONDS = 0.2
+MIN_PROBE_FRAMES = 16
+MAX_PROBE_FRAMES = 4096
+
+# a rate is kept if no more than this fraction of the test frames is lost or wrong
+MAX_ERROR = 0.001
+
+# seconds after a switch the board goes back to the rate before if it is not kept
+CONFIRM = 2.0
+
+# the result of probing one rate
+# throughput is the bytes of intact test frames per second, capacity what the rate can
+# carry at 10 bits per byte
+LINK_DTYPE = np.dtype([('baud', '<i8'), ('frames', '<i8'), ('good', '<i8'), ('error_rate', '<f8'),
+                       ('seconds', '<f8'), ('throughput', '<f8'), ('capacity', '<f8'), ('ok', '?')])
+
+
+def test_values(index):
+    # this function returns the voltage of test frames by index, as testValue() on the board
+    return ((np.asarray(index, dtype=np.uint64) * 0x9E37) & 0xFFFF).astype(np.uint16)
+
+
+def probe_frames(baud, seconds=PROBE_SECONDS):
+    # this function returns how many test frames fill about seconds at a rate
+    n = int(baud / 10.0 * seconds / frames.FRAME_SIZE)
+    return min(max(n, MIN_PROBE_FRAMES), MAX_PROBE_FRAMES)
+
+
+class LinkProbe:
+    # this class counts the test frames of one probe as they arrive
+    # times are time.perf_counter() seconds
+
+    def __init__(self, baud, count, start):
+        self.baud = baud
+        self.count = count
+        self.start = start
+        self.end = None
+        self.buf = bytearray()
+        self.seen = np.zeros(count, dtype=bool)
+        self.acks = []
+
+    def feed(self, data, received):
+        # this function decodes the bytes that arrived and returns the acknowledgements in them
+        self.buf += data
+        samples, used, errors = frames.decode_frames(bytes(self.buf), self.acks)
+        del self.buf[:used]
+
+        # a frame is intact if its checksum, its index and its voltage are right
+        index = samples['millis'].astype(np.int64)
+        inside = index < self.count
+        index = index[inside]
+        ok = samples['value'][inside] == test_values(index)
+        self.seen[index[ok]] = True
+
+        acks = self.acks
+        self.acks = []
+        if acks:
+            self.end = received
+        return acks
+
+    def result(self, now=None, max_error=MAX_ERROR):
+        # this function returns the LINK_DTYPE row of the probe, now is when it was given up
+        # on if the ack never came
+        end = self.end if self.end is not None else (time.perf_counter() if now is None else now)
+        good = int(self.seen.sum())
+        row = np.zeros(1, dtype=LINK_DTYPE)[0]
+        row['baud'] = self.baud
+        row['frames'] = self.count
+        row['good'] = good
+        row['error_rate'] = 1.0 - good / float(self.count)
+        row['seconds'] = end - self.start
+        row['throughput'] = good * frames.FRAME_SIZE / max(end - self.start, 1e-9)
+        row['capacity'] = self.baud / 10.0
+        row['ok'] = self.end is not None and row['error_rate'] <= max_error
+        return row
+
+
+def describe(rows):
+    # this function returns one line per probed rate, for printing
+    return "\n".join("%8d baud  %s  %5d/%5d frames  error %.4f  %9.0f of %9.0f bytes/s"
+                     % (r['baud'], "ok  " if r['ok'] else "fail", r['good'], r['frames'], r['error_rate'],
+                        r['throughput'], r['capacity']) for r in rows)
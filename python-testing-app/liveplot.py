@@ -0,0 +1,404 @@
+# liveplot.py
+# live updating plot of the logged samples
+#
+# the plot keeps a fixed number of min/max buckets for the whole session, about two per
+# pixel of plot width, and folds new samples into them as they arrive
+# when the buckets fill up, neighbouring pairs are merged and each bucket covers twice
+# as many samples, so the cost of a redraw does not grow with the length of the session
+# the buckets are drawn as a filled band between the min and max, stroking the same
+# points as a zig-zag line is an order of magnitude slower in agg
+# redraws run on a timer at a fixed rate and use blitting, the axes are only fully
+# redrawn when the data leaves the current limits, and stop following the data once the
+# toolbar zooms or pans, given the device's metrics every redraw is timed as its plot
+# stage (metrics.py)
+#
+# recorded sessions are drawn by SessionPlot every time the toolbar zooms or pans, from the
+# level of the session's pyramid (pyramid.py) that has about two buckets per pixel in view,
+# zoomed in closer than level 0 it reads the samples in view (session.SessionReader)
+
+# import statements
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
+from tkinter import Toplevel
+import os
+import time
+import session
+import pyramid
+import analysis
+
+
+class MinMaxDecimator:
+    # this class reduces a growing series to at most 2 * width min/max buckets
+
+    def __init__(self, width):
+        self.width = max(int(width), 1)
+        self.bucket_size = 1
+
+        # finished buckets, the x value is the time of the first sample in the bucket
+        self.x = np.empty(2 * self.width)
+        self.lo = np.empty(2 * self.width)
+        self.hi = np.empty(2 * self.width)
+        self.count = 0
+
+        # samples that do not fill a whole bucket yet
+        self.pending_x = np.empty(0)
+        self.pending_y = np.empty(0)
+
+    def add(self, times, values):
+        # this function folds a batch of samples into the buckets
+        times = np.concatenate((self.pending_x, np.asarray(times, dtype=np.float64)))
+        values = np.concatenate((self.pending_y, np.asarray(values, dtype=np.float64)))
+
+        while True:
+            # fill as many whole buckets as there is room for
+            room = 2 * self.width - self.count
+            full = min(len(values) // self.bucket_size, room)
+            used = full * self.bucket_size
+
+            if full > 0:
+                block = values[:used].reshape(full, self.bucket_size)
+                self.x[self.count:self.count + full] = times[:used:self.bucket_size]
+                self.lo[self.count:self.count + full] = block.min(axis=1)
+                self.hi[self.count:self.count + full] = block.max(axis=1)
+                self.count += full
+                times = times[used:]
+                values = values[used:]
+
+            # stop once the rest fits in a partial bucket
+            if len(values) < self.bucket_size:
+                break
+
+            # out of buckets, halve the resolution and try again
+            self._merge()
+
+        self.pending_x = times
+        self.pending_y = values
+
+    def _merge(self):
+        # this function merges neighbouring buckets so each covers twice the samples
+        pairs = self.count // 2
+        self.x[:pairs] = self.x[:2 * pairs:2]
+        self.lo[:pairs] = np.minimum(self.lo[:2 * pairs:2], self.lo[1:2 * pairs:2])
+        self.hi[:pairs] = np.maximum(self.hi[:2 * pairs:2], self.hi[1:2 * pairs:2])
+
+        # an odd bucket at the end is kept on its own, it covers fewer samples
+        # but its range is still correct
+        if self.count % 2:
+            self.x[pairs] = self.x[self.count - 1]
+            self.lo[pairs] = self.lo[self.count - 1]
+            self.hi[pairs] = self.hi[self.count - 1]
+            pairs += 1
+
+        self.count = pairs
+        self.bucket_size *= 2
+
+    def envelope(self):
+        # this function returns the time, min and max of each bucket
+        n = self.count
+        if len(self.pending_y) == 0:
+            return self.x[:n], self.lo[:n], self.hi[:n]
+
+        # the partial bucket is added as one more bucket
+        x = np.append(self.x[:n], self.pending_x[0])
+        lo = np.append(self.lo[:n], self.pending_y.min())
+        hi = np.append(self.hi[:n], self.pending_y.max())
+        return x, lo, hi
+
+
+class LivePlot:
+    # this class draws the samples in a ring buffer onto a matplotlib canvas
+
+    def __init__(self, fig, ax, canvas, buffer, width=None, metrics=None):
+        self.fig = fig
+        self.ax = ax
+        self.canvas = canvas
+        self.buffer = buffer
+        self.metrics = metrics
+
+        # one min and one max per pixel of the axes
+        if width is None:
+            width = ax.get_window_extent().width
+        self.decimator = MinMaxDecimator(width)
+
+        # samples already handed to the decimator
+        self.seen = 0
+
+        # the band is animated so it is left out of the cached background
+        self.band = Polygon(np.zeros((1, 2)), closed=True, animated=True, linewidth=1,
+                            facecolor='C0', edgecolor='C0')
+        ax.add_patch(self.band)
+        self.background = None
+        self.job = None
+
+        # the limits _fit last set, the plot stops following the data once the toolbar changes them
+        self.limits = None
+
+        # recapture the background whenever the whole figure is redrawn
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # this function caches the axes without the band and draws the band on top
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.ax.draw_artist(self.band)
+
+    def _fit(self, x, lo, hi):
+        # this function grows the axes limits when the data leaves them
+        # limits grow by doubling so full redraws stay rare
+        x0, x1 = self.ax.get_xlim()
+        y0, y1 = self.ax.get_ylim()
+        if self.limits is not None and self.limits != (x0, x1, y0, y1):
+            # zoomed or panned with the toolbar
+            return False
+        grow = False
+
+        if x[-1] > x1 or x[0] < x0:
+            x0 = x[0]
+            x1 = x[0] + max(2 * (x[-1] - x[0]), 1.0)
+            grow = True
+
+        lo = lo.min()
+        hi = hi.max()
+        if lo < y0 or hi > y1:
+            pad = max(0.1 * (hi - lo), 0.1)
+            y0 = min(y0, lo - pad)
+            y1 = max(y1, hi + pad)
+            grow = True
+
+        if grow:
+            self.ax.set_xlim(x0, x1)
+            self.ax.set_ylim(y0, y1)
+            self.limits = self.ax.get_xlim() + self.ax.get_ylim()
+        return grow
+
+    def update(self):
+        # this function draws one frame with whatever arrived since the last one
+        total = self.buffer.total
+        new = min(total - self.seen, len(self.buffer))
+        self.seen = total
+
+        if new > 0:
+            # views of the new samples, no copy
+            x_time, y_val = self.buffer.view(new)
+            self.decimator.add(x_time / 1000 / 60, y_val)
+
+        x, lo, hi = self.decimator.envelope()
+        if len(x) == 0:
+            return
+
+        # outline along the minimums and back along the maximums
+        self.band.set_xy(np.column_stack((np.concatenate((x, x[::-1])), np.concatenate((lo, hi[::-1])))))
+
+        # a full redraw recaptures the background through the draw event
+        if self._fit(x, lo, hi) or self.background is None:
+            self.canvas.draw()
+            return
+
+        # otherwise only the band is redrawn on top of the cached background
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.band)
+        self.canvas.blit(self.fig.bbox)
+
+    def start(self, widget, fps=30):
+        # this function redraws at a fixed rate on the tkinter mainloop
+        # the rate does not depend on how fast samples arrive
+        period = int(1000 / fps)
+
+        def tick():
+            if self.metrics is None:
+                self.update()
+            else:
+                start = time.perf_counter()
+                self.update()
+                self.metrics.plot.add(time.perf_counter() - start)
+            self.job = widget.after(period, tick)
+
+        self.job = widget.after(period, tick)
+
+    def stop(self, widget):
+        # this function cancels the redraw timer
+        if self.job is not None:
+            widget.after_cancel(self.job)
+            self.job = None
+
+
+def bucket_envelope(x, y, buckets):
+    # this function reduces samples to at most buckets min/max pairs
+    # the x value is the time of the first sample in the bucket
+    n = len(y)
+    size = max(-(-n // max(int(buckets), 1)), 1)
+    count = -(-n // size)
+    padded = np.concatenate((y, np.full(count * size - n, y[-1]))).reshape(count, size)
+    return x[::size], padded.min(axis=1), padded.max(axis=1)
+
+
+class SessionPlot:
+    # this class draws a recorded session, reading only what is needed for the part in view
+
+    def __init__(self, fig, ax, canvas, reader, levels=None, width=None):
+        self.fig = fig
+        self.ax = ax
+        self.canvas = canvas
+        self.reader = reader
+        self.levels = levels
+
+        # one min and one max per pixel of the axes
+        self.width = ax.get_window_extent().width if width is None else width
+        self.band = Polygon(np.zeros((1, 2)), closed=True, linewidth=1, facecolor='C0', edgecolor='C0')
+        ax.add_patch(self.band)
+
+        # the range drawn last, so a redraw with the same limits reads nothing
+        self.shown = None
+        self.ax.callbacks.connect('xlim_changed', self._on_xlim)
+
+    def _on_xlim(self, ax):
+        # this function runs whenever the toolbar zooms or pans
+        x0, x1 = ax.get_xlim()
+        self.show(x0, x1)
+        self.canvas.draw_idle()
+
+    def envelope(self, t0, t1):
+        # this function returns the time (minutes), min and max of the buckets between t0
+        # and t1 (millis), about two per pixel
+        rows = np.empty(0, dtype=pyramid.LEVEL_DTYPE)
+        if self.levels is not None:
+            rows, k = self.levels.view(t0, t1, 2 * self.width)
+
+        # closer in than level 0 has a bucket per two pixels, the samples are read instead
+        if len(rows) < self.width / 2:
+            millis, values = self.reader.read_range(t0, t1)
+            if len(values) == 0:
+                return np.empty(0), np.empty(0), np.empty(0)
+            return bucket_envelope(np.asarray(millis, dtype=np.float64) / 1000 / 60, values, 2 * self.width)
+
+        x = rows['first'] / 1000 / 60
+        lo = rows['min']
+        hi = rows['max']
+
+        # samples after the end of the pyramid, e.g. still being logged, are read from the file
+        end = int(rows['last'][-1])
+        if end < t1:
+            millis, values = self.reader.read_range(end + 1, t1)
+            if len(values):
+                tail = bucket_envelope(np.asarray(millis, dtype=np.float64) / 1000 / 60, values, self.width)
+                x = np.concatenate((x, tail[0]))
+                lo = np.concatenate((lo, tail[1]))
+                hi = np.concatenate((hi, tail[2]))
+        return x, lo, hi
+
+    def show(self, x0, x1):
+        # this function draws the part of the session between x0 and x1 (minutes)
+        if self.shown == (x0, x1):
+            return
+        self.shown = (x0, x1)
+        x, lo, hi = self.envelope(x0 * 60000, x1 * 60000)
+        if len(x) == 0:
+            self.band.set_xy(np.zeros((1, 2)))
+            return
+        self.band.set_xy(np.column_stack((np.concatenate((x, x[::-1])), np.concatenate((lo, hi[::-1])))))
+
+    def show_all(self):
+        # this function fits the axes to the whole session
+        first, last = self.reader.time_range()
+        if first is None:
+            return
+        x0 = first / 1000 / 60
+        x1 = max(last / 1000 / 60, x0 + 1e-3)
+        self.show(x0, x1)
+        x, y = self.band.get_xy().T
+        pad = max(0.1 * (y.max() - y.min()), 0.1)
+        self.ax.set_ylim(y.min() - pad, y.max() + pad)
+        self.ax.set_xlim(x0, x1)
+
+
+def open_pyramid(path):
+    # this function opens the pyramid of a session, sessions logged before there were
+    # pyramids get one built the first time they are opened
+    lod = pyramid.lod_path(path)
+    if not os.path.exists(lod):
+        pyramid.build(path, analysis.iter_session(path))
+    return pyramid.Pyramid(lod)
+
+
+def open_session_plot(master, path):
+    # this function creates a new window with a zoomable plot of a recorded session
+    plot_window = Toplevel(master)
+    plot_window.title(path)
+    plot_window.geometry("500x600")
+
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.set_xlabel("Time (min)")
+    ax.set_ylabel("Voltage (V)")
+    ax.set_title("Electrode Voltage")
+    fig.set_size_inches(5, 5)
+
+    canvas = FigureCanvasTkAgg(fig, master=plot_window)
+    canvas.get_tk_widget().pack()
+    toolbar = NavigationToolbar2Tk(canvas, plot_window)
+    toolbar.update()
+
+    reader = session.SessionReader(path)
+    levels = open_pyramid(path)
+    plot = SessionPlot(fig, ax, canvas, reader, levels)
+    plot.show_all()
+    canvas.draw()
+
+    def on_closing():
+        # unmap the files with the window
+        reader.close()
+        levels.close()
+        plot_window.destroy()
+
+    plot_window.protocol("WM_DELETE_WINDOW", on_closing)
+    return plot
+
+
+def open_live_plot(master, buffer, fps=30, metrics=None):
+    # this function creates a new window with a live plot of the buffer
+    # Toplevel object which will be treated as a new window
+    plot_window = Toplevel(master)
+
+    # set title
+    plot_window.title("Plotting")
+
+    # sets the geometry
+    plot_window.geometry("500x600")
+
+    # begin plotting
+    # a bare figure is used instead of pyplot so nothing is left running after close
+    fig = Figure()
+    ax = fig.add_subplot()
+
+    # format the plot
+    ax.set_xlabel("Time (min)")
+    ax.set_ylabel("Voltage (V)")
+    ax.set_title("Electrode Voltage")
+
+    fig.set_size_inches(5, 5)
+
+    # create the tkinter canvas for the figure
+    canvas = FigureCanvasTkAgg(fig, master=plot_window)
+
+    # place the canvas in the window
+    canvas.get_tk_widget().pack()
+
+    # create the toolbar
+    toolbar = NavigationToolbar2Tk(canvas, plot_window)
+    toolbar.update()
+
+    # start the live updates
+    live = LivePlot(fig, ax, canvas, buffer, metrics=metrics)
+    canvas.draw()
+    live.start(plot_window, fps)
+
+    def on_closing():
+        # stop the updates so the plot doesn't run in the background
+        live.stop(plot_window)
+        plot_window.destroy()
+
+    # define a window closing protocol
+    plot_window.protocol("WM_DELETE_WINDOW", on_closing)
+
+    return live
@@ -1,324 +1,262 @@
 # logger.py
 # https://bleak.readthedocs.io/en/latest/api/index.html
 # https://medium.com/analytics-vidhya/using-numpy-efficiently-between-processes-1bee17dcb01
+#
+# the tkinter shell around the headless acquisition core (core.py)
+# importing this module only imports tkinter, main() opens the window and then imports the
+# core (numpy, the engine), matplotlib is only imported when the first plot window opens
+# "python benchmark.py startup" holds these to a time budget
 
 # import statements
 import sys
-import serial
-import serial.tools.list_ports
-from datetime import datetime
-import time
-import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
-import csv
 from tkinter import *
-from threading import Thread
-from queue import Queue
+from tkinter import filedialog
 
-# from matplotlib.animation import FuncAnimation
-# from functools import partial
+# global tkinter window for the buttons, made by main()
+window = None
 
-# plotting in tkinter
-matplotlib.use("tkAgg")
+# global acquisition core, the buffer, the engine thread and the board commands
+acq = None
 
-# global stop variable
-stop = 0
+# latest running statistics of the session, shown under the buttons
+stats_var = None
 
-# global queue
-time_q = Queue()
-val_q = Queue()
+# round trip of the commands, shown under the statistics
+command_var = None
 
-# global tkinter window for the buttons
-window = Tk()
+# the latest metrics of the reader, shown in the metrics panel
+metrics_var = None
 
 
-def log_start(btn, ser, val="500"):
+def log_start(btn, acq, val="500", fmt=0, storage="csv"):
     # this function starts logging
+    # fmt and storage default to frames.ASCII and session.CSV, they are not imported here
     # set a default interval if none is given
     if val == '' or val is None:
         val = "500"
 
-    # send message to arduino
-    ser.write(("3," + val).encode('utf-8'))
-
-    # update stop variable for the new logging thread
-    global stop
-    stop = 0
-
-    # create new logging thread
-    t = Thread(target=logging, args=(ser,))
-    t.start()
+    # open the session and send message to arduino
+    # "3," logs ascii lines and "5," logs binary frames
+    acq.start_logging(val, fmt, storage, echo=True)
 
     # output and set button colour
     print("Logging started.")
     btn.config(bg='green')
 
 
-def stim_start(btn, ser, val="3.3"):
+def stim_start(btn, acq, val="3.3"):
     # this function starts stimulating the skin
     # set a default stimulation voltage if none is given
     if val == '' or val is None:
         val = "3.3"
 
     # send message to arduino
-    ser.write(("2," + val).encode('utf-8'))
+    acq.stimulate(val)
 
     # output and set button colour
     print("Stimulation started.")
     btn.config(bg='green')
 
 
-def sens_start(btn, ser, val="0.6"):
+def sens_start(btn, acq, val="0.6"):
     # this function starts supplying the electrode with power
     # set a default electrode voltage if none is given
     if val == '' or val is None:
         val = "0.6"
 
     # send message to arduino
-    ser.write(("4," + val).encode('utf-8'))
+    acq.power_electrode(val)
 
     # output and set button colour
     print("Electrode powered.")
     btn.config(bg='green')
 
 
-def test_start(btn, ser, val="1"):
+def test_start(btn, acq, val="1"):
     # this function sets the arduino to testing mode
     # the arduino will generate random output data
     # send message to arduino
-    ser.write(("0," + val).encode('utf-8'))
+    acq.test_mode(val)
 
     # output and set button colour
     print("Testing mode.")
     btn.config(bg='green')
 
 
-def log_stop(btn, ser, val="0"):
+def log_stop(btn, acq, val="0"):
     # this function stops the logging function
-    # send message to arduino
-    ser.write(("3," + val).encode('utf-8'))
-
-    # assign global variable and set value to stop
-    global stop
-    stop = 1
+    # send message to arduino and finish writing the session
+    acq.stop_logging()
 
     # output and reset button colour
     print("Logging stopped.")
     btn.config(bg='SystemButtonFace')
 
 
-def stim_stop(btn, ser, val="0"):
+def stim_stop(btn, acq, val="0"):
     # this function stops the stimulation function
     # send message to arduino
-    ser.write(("2," + val).encode('utf-8'))
+    acq.stimulate(val)
 
     # output and reset button colour
     print("Stimulation stopped.")
     btn.config(bg='SystemButtonFace')
 
 
-def sens_stop(btn, ser, val="0"):
+def sens_stop(btn, acq, val="0"):
     # this function stops powering the electrode function
     # send message to arduino
-    ser.write(("4," + val).encode('utf-8'))
+    acq.power_electrode(val)
 
     # output and reset button colour
     print("Electrode unpowered.")
     btn.config(bg='SystemButtonFace')
 
 
-def test_stop(btn, ser, val="0"):
+def test_stop(btn, acq, val="0"):
     # this function returns the arduino to normal operations
     # send message to arduino
-    ser.write(("0," + val).encode('utf-8'))
+    acq.test_mode(val)
 
     # output and reset button colour
     print("Normal mode.")
     btn.config(bg='SystemButtonFace')
 
 
-def logging(ser):
-    # this function writes the data received to a file
-    # get the current date for the file name
-    now = datetime.now()
-    dt_string = now.strftime("%Y-%m-%d-%H-%M-%S")
-
-    # open the file to write to and create the writer
-    f = open(dt_string + ".csv", "a", newline='', encoding='utf-8')
-    writer = csv.writer(f, delimiter=",")
-
-    # loop while the stop condition is not met
-    while stop == 0:
-
-        # read in the next line from serial
-        ser_bytes = ser.readline()
-
-        # decode the input and convert it to a string
-        decoded_bytes = str(ser_bytes[0:len(ser_bytes) - 2].decode("utf-8"))
-
-        # print data
-        print(decoded_bytes)
-
-        # check if there is a comma separator
-        # process if there is, pass if there is not
-        if ',' in decoded_bytes:
-
-            # convert data a list
-            txt = decoded_bytes.split(',')
-
-            # write times to a queue as a float
-            global time_q
-            time_q.put(float(txt[0]))
-
-            # write voltages to a queue as a float
-            global val_q
-            val_q.put(float(txt[1]))
-
-            # write the data
-            writer.writerow(txt)
-
-    # close the file once the loop is done
-    f.close()
-
-
 def plot():
-    # this function creates a new window that plots the data just logged
-    # Toplevel object which will be treated as a new window
-    plot_window = Toplevel(window)
-
-    # set title
-    plot_window.title("Plotting")
-
-    # sets the geometry
-    plot_window.geometry("500x600")
-
-    # define a window closing protocol
-    plot_window.protocol("WM_DELETE_WINDOW", lambda: on_closing(plot_window))
-
-    # begin plotting
-    fig, ax = plt.subplots()
-
-    # create the x and y data from the collected data in the queue
-    x_time = np.array(list(time_q.queue))
-    y_val = np.array(list(val_q.queue))
-
-    # print(x, y)
-
-    # plot the data
-    ax.plot(x_time/1000/60, y_val)
-
-    # the below code is for animations, but it is not necessary
-    # line1, = ax.plot([], [], 'ro')
-    #
-    # def init():
-    #     # ax.set_xlim(0, 2 * np.pi)
-    #     # ax.set_ylim(-1, 1)
-    #     ax.set_xlim(2.3, 2.5)
-    #     ax.set_ylim(0, 3.3)
-    #     return line1,
-    #
-    # def update(frame, ln, x, y):
-    #     x.append(frame[0]/10000000)
-    #     y.append(frame[1])
-    #     # x.append(frame)
-    #     # y.append(np.sin(frame))
-    #     ln.set_data(x, y)
-    #     return ln,
-    #
-    # ani = FuncAnimation(
-    #     fig, partial(update, ln=line1, x=[], y=[]),
-    #     # frames=np.linspace(0, 2 * np.pi, 128),
-    #     frames=zip(x_time, y_val),
-    #     init_func=init,
-    #     blit=True)
-
-    # this will autoscale the plot to have the correct axes limits
-    plt.autoscale()
-
-    # format the plot
-    ax.set_xlabel("Time (min)")
-    ax.set_ylabel("Voltage (V)")
-    ax.set_title("Electrode Voltage")
-
-    fig.set_size_inches(5, 5)
-
-    # create the tkinter canvas for the figure
-    canvas = FigureCanvasTkAgg(fig, master=plot_window)
-    canvas.draw()
-
-    # place the canvas in the window
-    canvas.get_tk_widget().pack()
-
-    # create the toolbar
-    toolbar = NavigationToolbar2Tk(canvas, plot_window)
-    toolbar.update()
-
-    # place the toolbar in the window
-    canvas.get_tk_widget().pack()
-
-    # this will produce a separate plot
-    # plt.show()
-
-
-def on_closing(box):
-    # this function defines what happens when the plotting window is closed
-    # close the plot so it doesn't run in the background
-    plt.close('all')
-
-    # close the window
-    box.destroy()
+    # this function creates a new window that plots the data as it is logged
+    # the plot redraws itself from the buffer until the window is closed
+    # matplotlib is imported with the first plot window, later ones find it loaded
+    from liveplot import open_live_plot
+    open_live_plot(window, acq.buffer, metrics=acq.dev.metrics if acq.dev is not None else None)
+
+
+def open_session():
+    # this function asks for a recorded session and plots it, only the part in view is read
+    path = filedialog.askopenfilename(parent=window, title="Open session", filetypes=[
+        ("Sessions", "*.csv *.swt *_spill.bin"), ("All files", "*")])
+    if path:
+        from liveplot import open_session_plot
+        open_session_plot(window, path)
+
+
+def open_metrics():
+    # this function opens a panel with the rates, queues and stage latencies of the reader,
+    # refreshed with every snapshot, and a button to profile the engine thread
+    import metrics
+    panel = Toplevel(window)
+    panel.title("Metrics")
+    label = Label(panel, textvariable=metrics_var, justify="left", anchor="w", font=("Courier", 10))
+    label.pack(fill="both", expand=True)
+    profile_btn = Button(panel, text='Profile %d s' % metrics.PROFILE_SECONDS,
+                         command=lambda: metrics.profile(acq.engine.thread.ident))
+    profile_btn.pack(fill="x")
 
 
 def force_closing(box):
     # stop the program
+    acq.shutdown()
     box.destroy()
     sys.exit("No Arduino connected!")
 
 
-def check_presence(correct_port, interval=0.1):
-    # this function checks if the arduino is connected and terminated the program if it is diconnected
-    # while loop to check
-    while True:
-
-        # get the available ports
-        myports = [tuple(p) for p in list(serial.tools.list_ports.comports())]
-
-        # if the desired port is not present
-        if correct_port not in myports:
+def on_closing(box):
+    # this function closes the session and the port before the window goes
+    acq.shutdown()
+    box.destroy()
 
-            # output
-            print("Arduino has been disconnected!")
 
-            # create popup window
-            top = Toplevel(window)
-            top.geometry("250x50")
-            top.title("Error")
-            label = Label(top, text="Arduino disconnected!", font=("Times New Roman", 18, "bold"))
-            label.pack()
+def device_event(dev, event, *args):
+    # this function handles events from the engine, it runs on the tkinter mainloop
+    # the engine notices a disconnect by a read error or the port going away, and waits a
+    # while for the board to come back before it gives up with 'disconnected'
+    if event == 'unplugged':
+        print("Arduino unplugged, waiting for it to come back.")
+        command_var.set("Arduino unplugged, the session carries on when it is back")
 
-            # set window exit protocol
-            top.protocol("WM_DELETE_WINDOW", lambda: force_closing(window))
+    elif event == 'reconnected':
+        print("Arduino back after %.1f s." % args[0])
+        command_var.set("Arduino back after %.1f s" % args[0])
 
-            break
-        # wait 0.1s between checking
-        time.sleep(interval)
+    elif event == 'disconnected':
 
+        # output
+        print("Arduino has been disconnected!")
 
-def main():
+        # create popup window
+        top = Toplevel(window)
+        top.geometry("250x50")
+        top.title("Error")
+        label = Label(top, text="Arduino disconnected!", font=("Times New Roman", 18, "bold"))
+        label.pack()
 
-    # this starts and gets the list of ports
-    myports = [tuple(p) for p in list(serial.tools.list_ports.comports())]
+        # set window exit protocol
+        top.protocol("WM_DELETE_WINDOW", lambda: force_closing(window))
+
+    elif event == 'stats' and args[0] is not None:
+        # a few times a second while logging
+        row = args[0]
+        stats_var.set("%.3f V  mean %.3f  std %.3f  slope %+.4f V/s  min %.3f  max %.3f" %
+                      (row['value'], row['mean'], row['std'], row['slope'], row['min'], row['max']))
+
+    elif event == 'ack':
+        # the board ran a command
+        command, ms = args
+        p50, p90, p99 = dev.channel.latency.percentiles()
+        command_var.set("%s answered in %.1f ms  (p50 %.1f  p99 %.1f ms over %d commands)" %
+                        (command, ms, p50, p99, dev.channel.acked))
+
+    elif event == 'command_failed':
+        # the board never answered, even after sending the command again
+        print("Arduino did not answer " + args[0] + "!")
+        command_var.set(args[0] + " not answered")
+
+    elif event == 'link':
+        # the rate negotiated when the port was opened
+        import link
+        baud, rows = args
+        print(link.describe(rows))
+        print("Serial link at %d baud." % baud)
+
+    elif event == 'metrics':
+        # once a second, the panel shows it if it is open
+        import metrics
+        metrics_var.set(metrics.describe(args[0]))
+
+    elif event == 'alarm':
+        # an alarm went on or off
+        alarm = args[0]
+        print("Alarm %s %s at %d ms (%.3f)." % (alarm['name'], "on" if alarm['active'] else "off",
+                                                 alarm['millis'], alarm['value']))
+
+
+def main(port='COM4'):
+    global window, acq, stats_var, command_var, metrics_var
+
+    # the window first, then the acquisition core
+    window = Tk()
+    stats_var = StringVar(window, value="")
+    command_var = StringVar(window, value="")
+    metrics_var = StringVar(window, value="no metrics yet")
+    import frames
+    import session
+    import core
+    from engine import TkAdapter
+    acq = core.Acquisition()
 
     # see if arduino is connected
     try:
-        arduino_port = [port for port in myports if 'COM4' in port][0]
-
-        # start checking thread if it is
-        port_controller = Thread(target=check_presence, args=(arduino_port, 0.1,))
-        port_controller.setDaemon(True)
-        port_controller.start()
+        # define serial port and baud rate
+        # find the 'COM#' in the Windows Device Manager, a pty from simulator.py works as well
+        # the engine watches the port and reports a disconnect through the adapter
+        # the port opens at the safe rate and moves up to the fastest one the link carries,
+        # buttons pressed meanwhile wait for it
+        adapter = TkAdapter(window)
+        acq.connect(port, notify=lambda d, event, *args: adapter.post(device_event, d, event, *args))
+
+        # "kill -USR1 <pid>" profiles the engine thread as the Profile button does
+        import metrics
+        metrics.profile_on_signal(acq.engine.thread.ident)
 
     # otherwise raise an error and stop the program
     except:
@@ -334,46 +272,39 @@ def main():
         # start loop
         window.mainloop()
 
-    # define serial port and baud rate
-    # find the 'COM#' in the Windows Device Manager
-    ser = serial.Serial('COM4', 9600, timeout=1)
-
-    # flush the input
-    ser.flushInput()
-
     # create a frame to hold the grid of buttons
     top_frame = Frame(window)
 
     # logging start button
-    log_start_btn = Button(top_frame, text='Start Logging', command=lambda: log_start(log_start_btn, ser, val_entry.get()))
+    log_start_btn = Button(top_frame, text='Start Logging', command=lambda: log_start(log_start_btn, acq, val_entry.get(), fmt_var.get(), storage_var.get()))
     log_start_btn.bind('<Button-1>')
 
     # stimulation start button
-    stim_start_btn = Button(top_frame, text='Start Stimulation', command=lambda: stim_start(stim_start_btn, ser, val_entry.get()))
+    stim_start_btn = Button(top_frame, text='Start Stimulation', command=lambda: stim_start(stim_start_btn, acq, val_entry.get()))
     stim_start_btn.bind('<Button-1>')
 
     # electrode start button
-    sens_start_btn = Button(top_frame, text='Power Electrode', command=lambda: sens_start(sens_start_btn, ser, val_entry.get()))
+    sens_start_btn = Button(top_frame, text='Power Electrode', command=lambda: sens_start(sens_start_btn, acq, val_entry.get()))
     sens_start_btn.bind('<Button-1>')
 
     # testing mode button
-    test_start_btn = Button(top_frame, text='Testing Mode', command=lambda: test_start(test_start_btn, ser))
+    test_start_btn = Button(top_frame, text='Testing Mode', command=lambda: test_start(test_start_btn, acq))
     test_start_btn.bind('<Button-1>')
 
     # logging stop button
-    log_stop_btn = Button(top_frame, text='Stop Logging', command=lambda: log_stop(log_start_btn, ser), bg='red')
+    log_stop_btn = Button(top_frame, text='Stop Logging', command=lambda: log_stop(log_start_btn, acq), bg='red')
     log_stop_btn.bind('<Button-1>')
 
     # stimulation stop button
-    stim_stop_btn = Button(top_frame, text='Stop Stimulation', command=lambda: stim_stop(stim_start_btn, ser), bg='red')
+    stim_stop_btn = Button(top_frame, text='Stop Stimulation', command=lambda: stim_stop(stim_start_btn, acq), bg='red')
     stim_stop_btn.bind('<Button-1>')
 
     # electrode stop button
-    sens_stop_btn = Button(top_frame, text='Stop Electrode', command=lambda: sens_stop(sens_start_btn, ser), bg='red')
+    sens_stop_btn = Button(top_frame, text='Stop Electrode', command=lambda: sens_stop(sens_start_btn, acq), bg='red')
     sens_stop_btn.bind('<Button-1>')
 
     # exit testing mode button
-    test_stop_btn = Button(top_frame, text='Normal Mode', command=lambda: test_stop(test_start_btn, ser), bg='red')
+    test_stop_btn = Button(top_frame, text='Normal Mode', command=lambda: test_stop(test_start_btn, acq), bg='red')
     test_stop_btn.bind('<Button-1>')
 
     # create a field for text entry for potential values to pass to arduino
@@ -381,10 +312,28 @@ def main():
     val_entry = Entry(bottom_frame)
     val_label = Label(bottom_frame, text="Type values here:")
 
+    # checkbox to log binary frames instead of ascii lines
+    fmt_var = IntVar(value=frames.ASCII)
+    fmt_check = Checkbutton(bottom_frame, text="Binary frames", variable=fmt_var, onvalue=frames.BINARY, offvalue=frames.ASCII)
+
+    # checkbox to save compressed chunk files instead of csv
+    storage_var = StringVar(value=session.CSV)
+    storage_check = Checkbutton(bottom_frame, text="Compressed session", variable=storage_var, onvalue=session.CHUNK, offvalue=session.CSV)
+
     # plot button
     plot_btn = Button(window, text='Plot', command=plot)
     plot_btn.bind('<Button-1>')
 
+    # button to look through a recorded session
+    open_btn = Button(window, text='Open Session', command=open_session)
+
+    # panel with the metrics of the reader
+    metrics_btn = Button(window, text='Metrics', command=open_metrics)
+
+    # running statistics of the session being logged
+    stats_label = Label(window, textvariable=stats_var, anchor="w")
+    command_label = Label(window, textvariable=command_var, anchor="w")
+
     # set the window title
     window.title('logger')
 
@@ -402,16 +351,25 @@ def main():
     # add the entry field and label to the frame
     val_label.grid(row=0, column=0, sticky="ew")
     val_entry.grid(row=0, column=1, sticky="ew")
+    fmt_check.grid(row=1, column=0, columnspan=2, sticky="w")
+    storage_check.grid(row=2, column=0, columnspan=2, sticky="w")
 
     # add the frame and the entry field to the window
     top_frame.grid(row=0, column=0)
     bottom_frame.grid(row=1, column=0, sticky="ew")
     plot_btn.grid(row=2, column=0, sticky="ew")
+    open_btn.grid(row=3, column=0, sticky="ew")
+    metrics_btn.grid(row=4, column=0, sticky="ew")
+    stats_label.grid(row=5, column=0, sticky="ew")
+    command_label.grid(row=6, column=0, sticky="ew")
+
+    # close the session and the port with the window
+    window.protocol("WM_DELETE_WINDOW", lambda: on_closing(window))
 
     # window.geometry("300x200+10+20")
     window.mainloop()
 
 
 if __name__ == "__main__":
-    # main function
-    main()
+    # main function, the port can be given on the command line
+    main(*sys.argv[1:2])
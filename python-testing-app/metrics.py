@@ -0,0 +1,242 @@
+# metrics.py
+# counters, latency histograms and a sampling profiler for the acquisition hot path
+#
+# Metrics is filled in by engine.Device as the data moves through it
+# - stages, the time taken by each step: read (the read call on the port), decode (bytes to
+#   arrays and the clock fit), queue (a batch waiting for the writer), write (the session
+#   file) and plot (a redraw of liveplot.LivePlot, in the GUI)
+# - counters, bytes and samples read, reads, batches and parse errors
+# - gauges, the depth of the write queue and the bytes waiting in the OS serial buffer when
+#   the port is read, the last value and the highest since the last snapshot
+# the hot path only appends a duration to a list and adds to counters, snapshot() bins the
+# durations into commands.LatencyHistogram once per interval, so the cost is a few
+# perf_counter() calls per read ("python benchmark.py metrics" measures it)
+# snapshot() returns one flat dict, the device emits it as 'metrics' for the GUI panel and
+# the daemon, and while logging it is appended to "<session>.metrics" as a JSON line
+#
+# SamplingProfiler is the on demand profiler, it looks at the stack of a thread every few ms
+# and counts the stacks in the collapsed format read by flamegraph.pl and speedscope, it is
+# started by the daemon's "profile" command, by SIGUSR1, or by the Profile button of the GUI
+
+# import statements
+import os
+import sys
+import json
+import time
+import signal
+import threading
+from collections import Counter
+import numpy as np
+from commands import LatencyHistogram
+
+# seconds between snapshots
+METRICS_INTERVAL = 1.0
+
+# the stages of a batch, in order
+STAGES = ('read', 'decode', 'queue', 'write', 'plot')
+
+# seconds between stack samples of the profiler, and how long it runs when not told
+PROFILE_INTERVAL = 0.005
+PROFILE_SECONDS = 10.0
+
+
+def metrics_path(path):
+    # this function returns the file holding the metrics log of a session file
+    return path + ".metrics"
+
+
+class Stage:
+    # this class collects the durations (s) of one stage
+    # add() may be called from another thread (the plot), a duration that lands while a
+    # snapshot swaps the list is lost
+
+    def __init__(self):
+        self.pending = []
+        self.add = self.pending.append
+        self.histogram = LatencyHistogram()
+        self.count = 0
+
+    def flush(self):
+        # this function bins what was added since the last flush, returns the histogram of
+        # this interval
+        pending = self.pending
+        self.pending = []
+        self.add = self.pending.append
+        interval = LatencyHistogram()
+        if pending:
+            ms = np.array(pending) * 1000.0
+            interval.add(ms)
+            self.histogram.add(ms)
+            self.count += len(ms)
+        return interval
+
+
+class Metrics:
+    # this class holds the instrumentation of one device
+
+    def __init__(self):
+        self.stages = {name: Stage() for name in STAGES}
+        self.read = self.stages['read']
+        self.decode = self.stages['decode']
+        self.queue = self.stages['queue']
+        self.write = self.stages['write']
+        self.plot = self.stages['plot']
+
+        # counters
+        self.bytes_in = 0
+        self.samples_in = 0
+        self.reads = 0
+        self.batches = 0
+        self.parse_errors = 0
+
+        # gauges, the highest is reset by every snapshot
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.serial_fill = 0
+        self.max_serial_fill = 0
+
+        # the counters at the last snapshot, and the last snapshot
+        self.last = (time.perf_counter(), 0, 0, 0, 0, 0)
+        self.latest = None
+
+    def snapshot(self, now=None):
+        # this function returns the rates since the last snapshot and the latencies of every
+        # stage as a dict
+        now = time.perf_counter() if now is None else now
+        counters = (now, self.bytes_in, self.samples_in, self.reads, self.batches, self.parse_errors)
+        last = self.last
+        elapsed = max(now - last[0], 1e-9)
+        self.last = counters
+
+        row = {
+            'time': time.time(),
+            'bytes_per_s': (self.bytes_in - last[1]) / elapsed,
+            'samples_per_s': (self.samples_in - last[2]) / elapsed,
+            'reads_per_s': (self.reads - last[3]) / elapsed,
+            'batches_per_s': (self.batches - last[4]) / elapsed,
+            'parse_errors': self.parse_errors,
+            'new_parse_errors': self.parse_errors - last[5],
+            'bytes_in': self.bytes_in,
+            'samples_in': self.samples_in,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'serial_fill': self.serial_fill,
+            'max_serial_fill': self.max_serial_fill,
+        }
+        self.max_queue_depth = self.queue_depth
+        self.max_serial_fill = self.serial_fill
+
+        for name, stage in self.stages.items():
+            interval = stage.flush()
+            p50, p99 = interval.percentiles((50, 99))
+            row[name + '_count'] = interval.count
+            row[name + '_p50_ms'] = p50
+            row[name + '_p99_ms'] = p99
+            row[name + '_max_ms'] = interval.max
+        self.latest = row
+        return row
+
+
+def describe(row):
+    # this function returns a snapshot as a few lines of text, for the GUI panel
+    if row is None:
+        return "no metrics yet"
+    lines = ["%.0f bytes/s  %.0f samples/s  %.0f reads/s  parse errors %d" %
+             (row['bytes_per_s'], row['samples_per_s'], row['reads_per_s'], row['parse_errors']),
+             "write queue %d (max %d)  serial buffer %d bytes (max %d)" %
+             (row['queue_depth'], row['max_queue_depth'], row['serial_fill'], row['max_serial_fill'])]
+    for name in STAGES:
+        if row[name + '_count']:
+            lines.append("%-6s %6d  p50 %7.3f  p99 %7.3f  max %7.3f ms" %
+                         (name, row[name + '_count'], row[name + '_p50_ms'], row[name + '_p99_ms'],
+                          row[name + '_max_ms']))
+    return "\n".join(lines)
+
+
+class MetricsLog:
+    # this class appends snapshots to a file, one JSON object per line
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "a")
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + "\n")
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class SamplingProfiler:
+    # this class counts the stacks of one thread (every thread but itself if thread_id is
+    # None) from a thread of its own
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self, seconds=PROFILE_SECONDS):
+        # this function samples for seconds and returns the stacks seen
+        me = threading.get_ident()
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (self.thread_id is not None and ident != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self.stacks
+
+    def write(self, path):
+        # this function writes the stacks as "outer;...;inner count" lines
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("%s %d\n" % (stack, count))
+        return path
+
+    def top(self, n=10):
+        # this function returns the functions most often on top of the stack, with the
+        # fraction of the samples
+        own = Counter()
+        for stack, count in self.stacks.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        total = max(sum(own.values()), 1)
+        return [(name, count / total) for name, count in own.most_common(n)]
+
+
+def profile(thread_id=None, seconds=PROFILE_SECONDS, path=None):
+    # this function profiles a thread in the background and writes the stacks to path
+    # ("profile-<time>.txt" if not given), returns the thread doing it and the path
+    if path is None:
+        path = time.strftime("profile-%Y-%m-%d-%H-%M-%S.txt")
+    profiler = SamplingProfiler(thread_id)
+
+    def run():
+        profiler.run(seconds)
+        profiler.write(path)
+        print("Profile written to " + path)
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t, path
+
+
+def profile_on_signal(thread_id=None, seconds=PROFILE_SECONDS, signum=getattr(signal, 'SIGUSR1', None)):
+    # this function has "kill -USR1 <pid>" profile the process, posix only, call it from the
+    # main thread
+    if signum is None:
+        return False
+    signal.signal(signum, lambda s, frame: profile(thread_id, seconds))
+    return True
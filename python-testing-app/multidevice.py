@@ -0,0 +1,102 @@
+# multidevice.py
+# log from every SWEATsens board connected to this computer at once
+#
+# each board gets its own Device (reader, writer and command tasks) on one shared engine,
+# so the boards are scheduled by a single asyncio loop instead of a thread each
+# every board writes its own session named <timestamp>_<port>
+#
+# run "python multidevice.py" to log from all boards found until Ctrl-C
+# or "python multidevice.py --ports /dev/ttyACM0 /dev/ttyACM1" for a given list
+
+# import statements
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+import serial.tools.list_ports
+import frames
+import session
+from engine import Engine
+
+# USB vendor id of the Arduino boards
+ARDUINO_VID = 0x2341
+
+
+def discover_boards():
+    # this function returns the ports that look like a SWEATsens board
+    ports = []
+    for p in serial.tools.list_ports.comports():
+        description = (p.description or '') + ' ' + (p.manufacturer or '')
+        if p.vid == ARDUINO_VID or 'Arduino' in description:
+            ports.append(p.device)
+    return ports
+
+
+class MultiLogger:
+    # this class logs from a list of ports on one engine
+
+    def __init__(self, ports, out_dir=".", **device_args):
+        self.ports = ports
+        self.out_dir = out_dir
+        self.engine = Engine().start()
+        self.devices = [self.engine.open_device(port, **device_args) for port in ports]
+        self.start_time = None
+
+    def start(self, interval="500", fmt=frames.ASCII, storage=session.CSV):
+        # this function starts a session on every board
+        stamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        futures = []
+        for dev in self.devices:
+            name = os.path.basename(dev.port)
+            base = os.path.join(self.out_dir, stamp + "_" + name)
+            futures.append(self.engine.call(dev.start_logging(interval, fmt, storage, base)))
+        for f in futures:
+            f.result()
+        self.start_time = time.perf_counter()
+
+    def report(self):
+        # this function returns the samples per second of each board and the total
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        rates = [dev.stats.samples_in / elapsed if dev.stats else 0.0 for dev in self.devices]
+        return rates, sum(rates)
+
+    def stop(self):
+        # this function ends every session and closes the ports
+        self.engine.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="log from several SWEATsens boards")
+    parser.add_argument("--ports", nargs="*", help="ports to use instead of the ones found")
+    parser.add_argument("--interval", default="500", help="ms between samples")
+    parser.add_argument("--binary", action="store_true", help="use binary frames")
+    parser.add_argument("--chunk", action="store_true", help="write compressed chunk sessions")
+    parser.add_argument("--out", default=".", help="directory for the session files")
+    parser.add_argument("--seconds", type=float, default=None, help="stop after this long")
+    args = parser.parse_args()
+
+    ports = args.ports or discover_boards()
+    if not ports:
+        print("No boards found!")
+        return 1
+
+    logger = MultiLogger(ports, args.out)
+    logger.start(args.interval, frames.BINARY if args.binary else frames.ASCII,
+                 session.CHUNK if args.chunk else session.CSV)
+    print("Logging from " + ", ".join(ports))
+
+    # print the throughput every few seconds
+    try:
+        while args.seconds is None or time.perf_counter() - logger.start_time < args.seconds:
+            time.sleep(min(5, args.seconds or 5))
+            rates, total = logger.report()
+            print("total %.0f samples/s  (%s)" % (total, ", ".join("%.0f" % r for r in rates)))
+    except KeyboardInterrupt:
+        pass
+    logger.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
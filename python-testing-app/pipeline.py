@@ -0,0 +1,175 @@
+# pipeline.py
+# producer/consumer pipeline between the serial port and the session file
+#
+# the ingest thread only drains the port, decodes whole batches and hands them on
+# the writer thread takes batches off a bounded queue and writes them to the session
+# when the writer falls behind, ingest keeps reading and merges the new samples into
+# one pending batch, it only waits once that batch reaches max_pending samples, so a
+# slow disk or terminal is absorbed without the OS serial buffer overrunning
+# if the port fails (e.g. the board is unplugged) ingest stops and keeps the error, what was
+# read is still written and stop() returns as usual
+
+# import statements
+import sys
+import time
+from queue import Queue, Full
+from threading import Thread
+import numpy as np
+import frames
+
+
+class PipelineStats:
+    # this class holds the counters reported by the pipeline
+
+    def __init__(self):
+        self.samples_in = 0
+        self.samples_out = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.max_pending = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.start = time.perf_counter()
+
+    def rate(self):
+        return self.samples_in / max(time.perf_counter() - self.start, 1e-9)
+
+
+class StatusLine:
+    # this class prints a single status line at most once per interval
+    # it replaces printing every sample
+
+    def __init__(self, interval=1.0, out=sys.stdout):
+        self.interval = interval
+        self.out = out
+        self.last = 0.0
+
+    def update(self, stats, millis, values, depth):
+        now = time.perf_counter()
+        if now - self.last < self.interval or len(millis) == 0:
+            return
+        self.last = now
+        self.out.write("\rsamples: %d  rate: %.0f/s  last: %d,%g  queue: %d  " %
+                       (stats.samples_in, stats.rate(), millis[-1], values[-1], depth))
+        self.out.flush()
+
+
+class Pipeline:
+    # this class runs the ingest and writer threads for one logging session
+
+    def __init__(self, ser, writer, buffer=None, fmt=frames.ASCII, max_batches=64,
+                 max_pending=2 ** 20, status=None):
+        self.ser = ser
+        self.writer = writer
+        self.buffer = buffer
+        self.max_pending = max_pending
+        self.status = status
+        self.stats = PipelineStats()
+
+        # bounded queue of batches between the two threads
+        self.queue = Queue(maxsize=max_batches)
+
+        # bulk reader for the selected serial format
+        if fmt == frames.BINARY:
+            self.reader = frames.FrameReader(ser)
+        else:
+            self.reader = frames.LineReader(ser)
+
+        # the error that stopped ingest, None if it was stopped
+        self.error = None
+
+        self.running = False
+        self.ingest_thread = Thread(target=self._ingest, daemon=True)
+        self.writer_thread = Thread(target=self._write, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.writer_thread.start()
+        self.ingest_thread.start()
+
+    def stop(self):
+        # stop reading, then let the writer drain everything that was read
+        self.running = False
+        self.ingest_thread.join()
+        self.writer_thread.join()
+        if self.status is not None:
+            self.status.out.write("\n")
+
+    def _read(self):
+        # this function returns the next batch as arrays of times and values
+        if isinstance(self.reader, frames.FrameReader):
+            samples = self.reader.read()
+            return samples['millis'], samples['value']
+        return self.reader.read()
+
+    def _ingest(self):
+        # this function drains the port into batches
+        pending = []
+        pending_n = 0
+
+        try:
+            while self.running:
+                millis, values = self._read()
+                if len(millis) == 0:
+                    continue
+
+                # the buffer feeds the plot, keep it current even if the disk is slow
+                if self.buffer is not None:
+                    self.buffer.append(millis, values)
+
+                self.stats.samples_in += len(millis)
+                pending.append((millis, values))
+                pending_n += len(millis)
+                self.stats.max_pending = max(self.stats.max_pending, pending_n)
+
+                # hand the pending samples on, merged into one batch
+                # wait for room only when too much is pending
+                block = pending_n >= self.max_pending
+                if self._put(pending, block):
+                    pending = []
+                    pending_n = 0
+
+                if self.status is not None:
+                    self.status.update(self.stats, millis, values, self.queue.qsize())
+        except OSError as e:
+            # serial.SerialException is an OSError too, the port is gone
+            self.error = e
+            self.running = False
+        finally:
+            # push out what is left and tell the writer to finish, whatever stopped ingest
+            if pending:
+                self._put(pending, True)
+            self.queue.put(None)
+
+    def _put(self, pending, block):
+        # this function merges the pending batches and queues them
+        # returns False if the queue was full and block is False
+        if len(pending) == 1:
+            batch = pending[0]
+        else:
+            batch = (np.concatenate([p[0] for p in pending]), np.concatenate([p[1] for p in pending]))
+
+        try:
+            self.queue.put_nowait(batch)
+        except Full:
+            if not block:
+                # keep the merged batch so it is not concatenated again
+                pending[:] = [batch]
+                return False
+            start = time.perf_counter()
+            self.queue.put(batch)
+            self.stats.waits += 1
+            self.stats.wait_time += time.perf_counter() - start
+
+        self.stats.batches += 1
+        self.stats.max_depth = max(self.stats.max_depth, self.queue.qsize())
+        return True
+
+    def _write(self):
+        # this function writes batches to the session until told to stop
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            self.writer.write(batch[0], batch[1])
+            self.stats.samples_out += len(batch[0])
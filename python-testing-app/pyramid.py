@@ -0,0 +1,280 @@
+# pyramid.py
+# multi resolution min/max/mean summary of a session, for drawing long recordings
+#
+# level 0 has one bucket per BASE samples and every level above has one bucket per pair of
+# buckets of the level below, so a bucket of level k covers BASE * 2 ** k samples
+# a bucket is one LEVEL_DTYPE row, first and last millis, min, max, mean and sample count,
+# all the levels together take about a quarter of a byte per sample
+#
+# the pyramid is built while logging() writes the session (PyramidWriter) and kept next to it
+#   "<file>.lod/<k>.bin"   the buckets of level k, appended as they fill up
+# drawing any part of the session reads a single level, the finest with no more buckets in
+# view than the plot has room for, so a redraw costs the same for a minute or for a day
+# buckets still waiting for their pair when the session is closed are written as smaller
+# buckets, after a crash the end of a level is filled in from the levels below it
+#
+# run "python pyramid.py <session files>" to build the pyramid of older sessions
+
+# import statements
+import os
+import sys
+import shutil
+import numpy as np
+
+# samples in a bucket of level 0
+BASE = 256
+
+# one bucket of a level
+LEVEL_DTYPE = np.dtype([('first', '<i8'), ('last', '<i8'), ('min', '<f4'), ('max', '<f4'),
+                        ('mean', '<f4'), ('count', '<u4')])
+
+# every INDEX_ROWS-th start time of a level is kept in memory to find a time in it
+INDEX_ROWS = 4096
+
+
+def lod_path(path):
+    # this function returns the directory holding the pyramid of a session file
+    return path + ".lod"
+
+
+def _buckets(millis, values, size):
+    # this function summarises every size samples as one bucket
+    n = len(values) // size
+    used = n * size
+    block = values[:used].reshape(n, size)
+    rows = np.empty(n, dtype=LEVEL_DTYPE)
+    rows['first'] = millis[:used:size]
+    rows['last'] = millis[size - 1:used:size]
+    rows['min'] = block.min(axis=1)
+    rows['max'] = block.max(axis=1)
+    rows['mean'] = block.mean(axis=1)
+    rows['count'] = size
+    return rows
+
+
+def _merge(a, b):
+    # this function merges the buckets in a with the ones in b, pair by pair
+    rows = np.empty(len(a), dtype=LEVEL_DTYPE)
+    rows['first'] = a['first']
+    rows['last'] = b['last']
+    rows['min'] = np.minimum(a['min'], b['min'])
+    rows['max'] = np.maximum(a['max'], b['max'])
+    count = a['count'].astype(np.float64) + b['count']
+    rows['mean'] = (a['mean'] * a['count'] + b['mean'] * b['count']) / count
+    rows['count'] = count
+    return rows
+
+
+class PyramidBuilder:
+    # this class folds samples into the levels as they arrive and appends the buckets that
+    # fill up to the level files
+
+    def __init__(self, path, base=BASE):
+        self.path = path
+        self.base = base
+        os.makedirs(path, exist_ok=True)
+
+        # samples that do not fill a bucket of level 0 yet
+        self.millis = np.empty(0, dtype=np.int64)
+        self.values = np.empty(0, dtype=np.float64)
+
+        # the level files and the bucket of each level still waiting for its pair
+        self.files = []
+        self.pending = []
+
+    def _level(self, k):
+        # this function opens the file of level k the first time a bucket reaches it
+        while len(self.files) <= k:
+            self.files.append(open(os.path.join(self.path, "%d.bin" % len(self.files)), "ab"))
+            self.pending.append(np.empty(0, dtype=LEVEL_DTYPE))
+        return self.files[k]
+
+    def _add(self, rows):
+        # this function appends buckets to level 0 and carries the pairs up the levels
+        k = 0
+        while len(rows):
+            rows.tofile(self._level(k))
+            rows = np.concatenate((self.pending[k], rows))
+            pairs = len(rows) // 2
+            self.pending[k] = rows[2 * pairs:]
+            rows = _merge(rows[:2 * pairs:2], rows[1:2 * pairs:2])
+            k += 1
+
+    def write(self, millis, values):
+        # this function adds a batch of samples
+        millis = np.concatenate((self.millis, np.asarray(millis, dtype=np.int64)))
+        values = np.concatenate((self.values, np.asarray(values, dtype=np.float64)))
+        used = len(values) // self.base * self.base
+        self.millis = millis[used:]
+        self.values = values[used:]
+        if used:
+            self._add(_buckets(millis[:used], values[:used], self.base))
+
+            # a level is never more than one bucket behind the session, even after a crash
+            for f in self.files:
+                f.flush()
+
+    def close(self):
+        # this function writes what is left as smaller buckets, so every level reaches the end
+        # of the session, then closes the level files
+        rows = np.empty(0, dtype=LEVEL_DTYPE)
+        if len(self.values):
+            rows = _buckets(self.millis, self.values, len(self.values))
+        k = 0
+        while len(rows) or k < len(self.files):
+            if len(rows):
+                rows.tofile(self._level(k))
+
+            # the top level with nothing waiting already ends with the whole session
+            if k == len(self.files) - 1 and len(self.pending[k]) == 0:
+                break
+
+            # the bucket waiting at this level and the one just written go up as one
+            rows = np.concatenate((self.pending[k], rows))
+            if len(rows) == 2:
+                rows = _merge(rows[:1], rows[1:])
+            k += 1
+        for f in self.files:
+            f.close()
+        self.files = []
+        self.millis = self.millis[:0]
+        self.values = self.values[:0]
+
+
+class PyramidWriter:
+    # this class passes samples to a session writer and builds the pyramid alongside
+
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.path = writer.path
+        self.builder = PyramidBuilder(path)
+
+    def append(self, t, v):
+        self.writer.append(t, v)
+        self.builder.write([t], [v])
+
+    def write(self, millis, values):
+        self.writer.write(millis, values)
+        self.builder.write(millis, values)
+
+    def close(self):
+        self.writer.close()
+        self.builder.close()
+
+
+class Pyramid:
+    # this class reads the buckets of a pyramid, the level files are memory mapped
+
+    def __init__(self, path):
+        self.path = path
+        self.levels = []
+        self.index = []
+        self.refresh()
+
+    def refresh(self):
+        # this function maps the level files again, to see buckets added since
+        self.levels = []
+        self.index = []
+        while True:
+            level_path = os.path.join(self.path, "%d.bin" % len(self.levels))
+            if not os.path.exists(level_path):
+                break
+            rows = os.path.getsize(level_path) // LEVEL_DTYPE.itemsize
+            if rows == 0:
+                break
+            level = np.memmap(level_path, dtype=LEVEL_DTYPE, mode='r', shape=(rows,))
+            self.levels.append(level)
+            self.index.append(np.ascontiguousarray(level['first'][::INDEX_ROWS]))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def end(self):
+        # this function returns the last time covered by level 0, None if there is no level
+        if not self.levels:
+            return None
+        return int(self.levels[0]['last'][-1])
+
+    def _search(self, k, t):
+        # this function returns the number of buckets of level k that start at or before t
+        # only one step of the sparse index is searched in the mapped file
+        i = max(int(np.searchsorted(self.index[k], t, side='right')) - 1, 0) * INDEX_ROWS
+        return i + int(np.searchsorted(self.levels[k]['first'][i:i + INDEX_ROWS], t, side='right'))
+
+    def _range(self, k, t0, t1):
+        # this function returns the start and stop of the buckets of level k that overlap t0 to t1
+        lo = max(self._search(k, t0) - 1, 0)
+        hi = self._search(k, t1)
+        if lo < hi and self.levels[k]['last'][lo] < t0:
+            lo += 1
+        return lo, hi
+
+    def view(self, t0, t1, buckets):
+        # this function returns the buckets between t0 and t1 (millis) from the finest level
+        # with at most about buckets of them in view, and the level they came from
+        if not self.levels:
+            return np.empty(0, dtype=LEVEL_DTYPE), 0
+
+        # every level has about half the buckets of the one below, so the count at level 0
+        # says where to start looking
+        lo, hi = self._range(0, t0, t1)
+        k = 0
+        if hi - lo > buckets:
+            k = min(int(np.ceil(np.log2((hi - lo) / buckets))), len(self.levels) - 1)
+            lo, hi = self._range(k, t0, t1)
+            while hi - lo > buckets and k < len(self.levels) - 1:
+                k += 1
+                lo, hi = self._range(k, t0, t1)
+        rows = self.levels[k][lo:hi]
+
+        # the end of a level not closed properly is filled in from the finer levels
+        parts = [rows]
+        last = rows['last'][-1] if len(rows) else t0 - 1
+        for j in range(k - 1, -1, -1):
+            if last >= t1:
+                break
+            a, b = self._range(j, last + 1, t1)
+            tail = self.levels[j][a:b]
+            tail = tail[tail['first'] > last]
+            if len(tail):
+                parts.append(tail)
+                last = tail['last'][-1]
+        if len(parts) > 1:
+            rows = np.concatenate(parts)
+        return rows, k
+
+    def close(self):
+        # views returned by view keep a level mapped until they are gone
+        self.levels = []
+        self.index = []
+
+
+def build(path, blocks, base=BASE):
+    # this function builds the pyramid of a session from its (millis, values) blocks
+    # any pyramid already there is replaced
+    lod = lod_path(path)
+    if os.path.exists(lod):
+        shutil.rmtree(lod)
+    builder = PyramidBuilder(lod, base)
+    for millis, values in blocks:
+        builder.write(millis, values)
+    builder.close()
+    return lod
+
+
+def main(argv):
+    # build the pyramid of each session given on the command line
+    # analysis is only needed here, it reads every kind of session file
+    import analysis
+    if not argv:
+        print("usage: python pyramid.py <session files>")
+        return 1
+    for path in argv:
+        lod = build(path, analysis.iter_session(path))
+        levels = Pyramid(lod)
+        print(path + " -> " + lod + " (" + str(len(levels)) + " levels)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
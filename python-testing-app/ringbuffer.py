@@ -0,0 +1,141 @@
+# ringbuffer.py
+# fixed size circular buffer for the logged samples
+#
+# the samples are stored twice, at i and at i + capacity, so the newest n samples
+# are always one contiguous slice and plot() can take them as a view without copying
+# there is a single writer (the logging thread), readers only look at the write count
+# so no lock is needed, a reader that is lapped by the writer just sees newer data
+
+# import statements
+import numpy as np
+
+# layout of the samples written to the spill file when the buffer overflows
+SPILL_DTYPE = np.dtype([('time', '<f8'), ('value', '<f8')])
+
+
+class RingBuffer:
+    # this class holds the most recent samples in preallocated numpy arrays
+
+    def __init__(self, capacity=2 ** 20, spill_path=None):
+        self.capacity = capacity
+
+        # each array is twice the capacity so any window is contiguous
+        self.times, self.values = self._allocate(2 * capacity)
+
+        # total number of samples ever written, only the writer changes it
+        self.total = 0
+
+        # samples older than the buffer are appended to this file instead of being lost
+        self.spill_path = spill_path
+        self.spill_file = None
+        self.spilled = 0
+
+    def _allocate(self, n):
+        # this function returns the arrays for the samples, sharedring.SharedRing puts them
+        # in shared memory instead
+        return np.zeros(n, dtype=np.float64), np.zeros(n, dtype=np.float64)
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def put(self, t, v):
+        # this function adds a single sample, used by the ascii logging path
+        # spill in blocks so a full buffer does not cost a file write per sample
+        if self.total - self.spilled >= self.capacity:
+            self._spill(max(1, self.capacity // 64))
+
+        i = self.total % self.capacity
+        self.times[i] = self.times[i + self.capacity] = t
+        self.values[i] = self.values[i + self.capacity] = v
+
+        # publish the sample only once it is fully written
+        self.total += 1
+
+    def append(self, times, values):
+        # this function adds a batch of samples
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+
+        # only the newest capacity samples of a huge batch can be kept
+        n = len(times)
+        if n > self.capacity:
+            self._spill(self.total - self.spilled)
+            self._spill_arrays(times[:n - self.capacity], values[:n - self.capacity])
+            self.spilled += n - self.capacity
+            self.total += n - self.capacity
+            times = times[n - self.capacity:]
+            values = values[n - self.capacity:]
+            n = self.capacity
+
+        # spill whatever the batch is about to overwrite
+        over = self.total + n - self.capacity - self.spilled
+        if over > 0:
+            self._spill(over)
+
+        # copy the batch in, in at most two pieces when it wraps
+        start = self.total % self.capacity
+        first = min(n, self.capacity - start)
+        self._write(start, times[:first], values[:first])
+        self._write(0, times[first:], values[first:])
+
+        # publish the batch only once it is fully written
+        self.total += n
+
+    def _write(self, start, times, values):
+        # this function writes into both copies of the buffer
+        end = start + len(times)
+        self.times[start:end] = times
+        self.times[start + self.capacity:end + self.capacity] = times
+        self.values[start:end] = values
+        self.values[start + self.capacity:end + self.capacity] = values
+
+    def _spill(self, n):
+        # this function moves the n oldest samples that are still held out to disk
+        start = self.spilled % self.capacity
+        self._spill_arrays(self.times[start:start + n], self.values[start:start + n])
+        self.spilled += n
+
+    def _spill_arrays(self, times, values):
+        # without a spill file the samples are counted as dropped by spilled
+        if self.spill_path is None:
+            return
+
+        # open the spill file on first use
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_path, "ab")
+
+        out = np.empty(len(times), dtype=SPILL_DTYPE)
+        out['time'] = times
+        out['value'] = values
+        out.tofile(self.spill_file)
+
+    def view(self, n=None):
+        # this function returns the newest n samples as views into the buffer
+        total = self.total
+        held = min(total, self.capacity)
+        if n is None or n > held:
+            n = held
+
+        end = total % self.capacity + self.capacity if total >= self.capacity else total
+        return self.times[end - n:end], self.values[end - n:end]
+
+    def read_spill(self):
+        # this function reads back everything that was spilled to disk
+        if self.spill_file is not None:
+            self.spill_file.flush()
+        if self.spill_path is None or self.spill_file is None:
+            return np.empty(0, dtype=SPILL_DTYPE)
+        return np.fromfile(self.spill_path, dtype=SPILL_DTYPE)
+
+    def close(self):
+        # close the spill file
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def spill_to(self, path):
+        # this function starts a new spill file for a new session, the samples of the
+        # sessions before are held on for the plot but never spilled into it
+        self.close()
+        self.spill_path = path
+        self.spilled = self.total
@@ -0,0 +1,456 @@
+# session.py
+# session writers and readers for logging()
+#
+# two formats are supported
+# - csv, one "millis,value" row per sample, the original format
+# - chunk, a binary columnar file written in compressed chunks with an index at the end
+#
+# chunk file layout
+#   header   magic b"SWSESS01", value dtype (2 bytes, b"u2" or b"f4")
+#   chunks   b"CK", sample count (u4), first millis (i8), millis bytes (u4), value bytes (u4),
+#            zlib(int32 millis deltas), zlib(values)
+#   footer   index (one INDEX_DTYPE row per chunk), index offset (u8), chunk count (u4), b"SWIDX"
+#
+# the index lets a reader open a session of any length by reading only the footer
+# a file without a footer (e.g. after a crash) is recovered by walking the chunk headers
+#
+# csv logs have no index of their own, SessionReader keeps a sparse time index next to them
+#   "<file>.tidx"   magic b"SWTIDX01", bytes indexed (u8), samples indexed (u8),
+#                   then one TIME_INDEX_DTYPE row (first millis, byte offset, samples
+#                   before it) per block of about INDEX_BYTES of the csv
+# the index is built on first use and only extended when the log grows
+# new sessions also get a min/max/mean pyramid for drawing, "<file>.lod" (see pyramid.py)
+# run "python session.py convert <csv files>" to convert old logs
+
+# import statements
+import os
+import sys
+import zlib
+import struct
+import mmap
+import shutil
+import numpy as np
+import fastcsv
+import pyramid
+from ringbuffer import SPILL_DTYPE
+
+# file markers
+MAGIC = b"SWSESS01"
+CHUNK_MAGIC = b"CK"
+FOOTER_MAGIC = b"SWIDX"
+
+# fixed size pieces of the file
+HEADER = struct.Struct("<8s2s")
+CHUNK_HEADER = struct.Struct("<2sIqII")
+TRAILER = struct.Struct("<QI5s")
+
+# one row of the footer index per chunk
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('count', '<u4'), ('first', '<i8'), ('last', '<i8')])
+
+# number of samples per chunk
+CHUNK_SIZE = 65536
+
+# sparse time index of csv and spill files
+TIME_INDEX_MAGIC = b"SWTIDX01"
+TIME_INDEX_HEADER = struct.Struct("<8sQQ")
+TIME_INDEX_DTYPE = np.dtype([('millis', '<i8'), ('offset', '<u8'), ('row', '<u8')])
+
+# csv bytes per time index row, a range query parses at most two of these it does not need
+INDEX_BYTES = 2 ** 16
+
+# spill samples per time index row
+INDEX_ROWS = 4096
+
+# session formats
+CSV = "csv"
+CHUNK = "chunk"
+
+
+class CsvSessionWriter:
+    # this class writes a session as "millis,value" rows
+    # values are written with %g so raw counts have no decimal point
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "a", newline='', encoding='utf-8')
+
+    def append(self, t, v):
+        # write a single sample
+        self.f.write("%d,%.10g\r\n" % (t, v))
+
+    def write(self, millis, values):
+        # write a batch of samples
+        np.savetxt(self.f, np.column_stack((millis, values)), fmt=("%d", "%.10g"), delimiter=",", newline="\r\n")
+
+    def close(self):
+        self.f.close()
+
+
+class ChunkSessionWriter:
+    # this class writes a session as compressed columnar chunks
+    # samples are buffered and compressed a chunk at a time
+
+    def __init__(self, path, value_dtype='f4', chunk_size=CHUNK_SIZE, level=6):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.level = level
+
+        # buffers for the chunk being filled
+        self.millis = np.empty(chunk_size, dtype=np.int64)
+        self.values = np.empty(chunk_size, dtype=value_dtype)
+        self.count = 0
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # reopen an existing session and keep appending to it
+            index, self.value_dtype, end = _read_index(path)
+            self.index = list(index)
+            self.f = open(path, "r+b")
+            self.f.seek(end)
+            self.f.truncate()
+            self.values = np.empty(chunk_size, dtype=self.value_dtype)
+        else:
+            # start a new session
+            self.value_dtype = np.dtype(value_dtype)
+            self.index = []
+            self.f = open(path, "wb")
+            self.f.write(HEADER.pack(MAGIC, self.value_dtype.str[1:].encode('ascii')))
+
+    def append(self, t, v):
+        # add a single sample
+        self.millis[self.count] = t
+        self.values[self.count] = v
+        self.count += 1
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def write(self, millis, values):
+        # add a batch of samples
+        millis = np.asarray(millis)
+        values = np.asarray(values)
+        while len(millis) > 0:
+            n = min(len(millis), self.chunk_size - self.count)
+            self.millis[self.count:self.count + n] = millis[:n]
+            self.values[self.count:self.count + n] = values[:n]
+            self.count += n
+            millis = millis[n:]
+            values = values[n:]
+            if self.count == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        # this function compresses and writes out the buffered samples as one chunk
+        if self.count == 0:
+            return
+        millis = self.millis[:self.count]
+
+        # times are stored as differences from the first time, which compress far better
+        deltas = np.diff(millis, prepend=millis[0]).astype('<i4')
+        t_bytes = zlib.compress(deltas.tobytes(), self.level)
+        v_bytes = zlib.compress(self.values[:self.count].tobytes(), self.level)
+
+        offset = self.f.tell()
+        self.f.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self.count, int(millis[0]), len(t_bytes), len(v_bytes)))
+        self.f.write(t_bytes)
+        self.f.write(v_bytes)
+        self.index.append((offset, self.count, int(millis[0]), int(millis[-1])))
+        self.count = 0
+
+    def close(self):
+        # write the last chunk and the footer
+        self.flush()
+        end = self.f.tell()
+        np.array(self.index, dtype=INDEX_DTYPE).tofile(self.f)
+        self.f.write(TRAILER.pack(end, len(self.index), FOOTER_MAGIC))
+        self.f.close()
+
+
+def _read_chunk_header(f):
+    # this function reads one chunk header, returns None at the end of the chunks
+    raw = f.read(CHUNK_HEADER.size)
+    if len(raw) < CHUNK_HEADER.size:
+        return None
+    magic, count, first, t_len, v_len = CHUNK_HEADER.unpack(raw)
+    if magic != CHUNK_MAGIC:
+        return None
+    return count, first, t_len, v_len
+
+
+def _read_index(path):
+    # this function returns the chunk index, the value dtype and where the chunks end
+    with open(path, "rb") as f:
+        magic, code = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a session file")
+        value_dtype = np.dtype('<' + code.decode('ascii'))
+
+        # the normal case, read the index from the footer
+        size = f.seek(0, os.SEEK_END)
+        if size >= HEADER.size + TRAILER.size:
+            f.seek(size - TRAILER.size)
+            end, chunks, footer = TRAILER.unpack(f.read(TRAILER.size))
+            if footer == FOOTER_MAGIC and end + chunks * INDEX_DTYPE.itemsize + TRAILER.size == size:
+                f.seek(end)
+                index = np.fromfile(f, dtype=INDEX_DTYPE, count=chunks)
+                return index, value_dtype, end
+
+        # no footer, rebuild the index by walking the chunks
+        index = []
+        offset = HEADER.size
+        f.seek(offset)
+        while True:
+            header = _read_chunk_header(f)
+            if header is None:
+                break
+            count, first, t_len, v_len = header
+            data = f.read(t_len + v_len)
+            if len(data) < t_len + v_len:
+                break
+            deltas = np.frombuffer(zlib.decompress(data[:t_len]), dtype='<i4')
+            index.append((offset, count, first, first + int(deltas.sum(dtype=np.int64))))
+            offset = f.tell()
+
+        return np.array(index, dtype=INDEX_DTYPE), value_dtype, offset
+
+
+class SessionFile:
+    # this class reads a chunk session file
+
+    def __init__(self, path):
+        self.path = path
+        self.index, self.value_dtype, self.end = _read_index(path)
+
+    def __len__(self):
+        return int(self.index['count'].sum())
+
+    def read_chunk(self, i):
+        # this function decompresses one chunk and returns its times and values
+        row = self.index[i]
+        with open(self.path, "rb") as f:
+            f.seek(int(row['offset']))
+            count, first, t_len, v_len = _read_chunk_header(f)
+            data = f.read(t_len + v_len)
+        deltas = np.frombuffer(zlib.decompress(data[:t_len]), dtype='<i4')
+        millis = first + np.cumsum(deltas, dtype=np.int64)
+        values = np.frombuffer(zlib.decompress(data[t_len:]), dtype=self.value_dtype)
+        return millis, values
+
+    def read(self):
+        # this function reads the whole session
+        if len(self.index) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=self.value_dtype)
+        parts = [self.read_chunk(i) for i in range(len(self.index))]
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+
+def _load_time_index(path):
+    # this function reads a time index file, returns the rows, bytes and samples indexed
+    try:
+        with open(path, "rb") as f:
+            magic, end, rows = TIME_INDEX_HEADER.unpack(f.read(TIME_INDEX_HEADER.size))
+            if magic != TIME_INDEX_MAGIC:
+                return None
+            return np.fromfile(f, dtype=TIME_INDEX_DTYPE), end, rows
+    except (OSError, struct.error):
+        return None
+
+
+def _save_time_index(path, index, end, rows):
+    # this function writes a time index file, a half written one is never left behind
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(TIME_INDEX_HEADER.pack(TIME_INDEX_MAGIC, end, rows))
+        index.tofile(f)
+    os.replace(tmp, path)
+
+
+def _index_csv(mm, index, end, rows, index_bytes=INDEX_BYTES):
+    # this function extends a csv time index over the lines after end
+    # a last line without a newline may still be being written, it is left for next time
+    added = []
+    for start, stop in fastcsv.block_ranges(mm, end, index_bytes):
+        if mm[stop - 1] != 10:
+            stop = mm.rfind(b'\n', start, stop) + 1
+            if stop <= start:
+                break
+        millis, values, errors = fastcsv.parse_block(mm[start:stop], final=False)
+        if len(millis):
+            added.append((millis[0], start, rows))
+            rows += len(millis)
+        end = stop
+    if added:
+        index = np.concatenate((index, np.array(added, dtype=TIME_INDEX_DTYPE)))
+    return index, end, rows
+
+
+class SessionReader:
+    # this class reads any time range of a session without reading the rest of it
+    # - csv, memory mapped, the time index says which blocks of lines to parse
+    # - spill (_spill.bin), memory mapped fixed size records, ranges are views of the file
+    # - chunk (.swt), only the chunks the footer index says overlap are decompressed
+    # times must not go backwards in the file, which holds for anything logging() writes
+
+    def __init__(self, path, index_bytes=INDEX_BYTES):
+        self.path = path
+        self.index_bytes = index_bytes
+        self.f = None
+        self.mm = None
+        self.data = None
+        self.chunks = None
+        self.refresh()
+
+    def refresh(self):
+        # this function maps the file again and indexes anything added since it was opened
+        self.close()
+        if self.path.endswith(".swt"):
+            self.chunks = SessionFile(self.path)
+            self.index = self.chunks.index['first']
+            return
+
+        size = os.path.getsize(self.path)
+        if self.path.endswith("_spill.bin"):
+            # the records are fixed size, so every INDEX_ROWS-th time is the index
+            # reading it only touches one page in every few
+            if size >= SPILL_DTYPE.itemsize:
+                self.data = np.memmap(self.path, dtype=SPILL_DTYPE, mode='r', shape=(size // SPILL_DTYPE.itemsize,))
+            else:
+                self.data = np.empty(0, dtype=SPILL_DTYPE)
+            self.index = np.ascontiguousarray(self.data['time'][::INDEX_ROWS])
+            return
+
+        # csv, reuse the saved index unless the log got shorter
+        index_path = self.path + ".tidx"
+        saved = _load_time_index(index_path)
+        if saved is None or saved[1] > size:
+            saved = (np.empty(0, dtype=TIME_INDEX_DTYPE), 0, 0)
+        self.csv_index, self.end, self.rows = saved
+        if size > 0:
+            self.f = open(self.path, "rb")
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.end < size:
+                old_end = self.end
+                self.csv_index, self.end, self.rows = _index_csv(self.mm, self.csv_index, self.end, self.rows, self.index_bytes)
+                if self.end != old_end:
+                    _save_time_index(index_path, self.csv_index, self.end, self.rows)
+        self.index = self.csv_index['millis']
+
+    def __len__(self):
+        if self.chunks is not None:
+            return len(self.chunks)
+        if self.data is not None:
+            return len(self.data)
+        return int(self.rows)
+
+    def read_range(self, t0, t1):
+        # this function returns the times and values with t0 <= millis <= t1
+        # the work is in proportion to the samples in the range, not to the file, and for
+        # spill files the arrays are views of the mapped file
+        lo = max(int(np.searchsorted(self.index, t0, side='right')) - 1, 0)
+        hi = int(np.searchsorted(self.index, t1, side='right'))
+
+        if self.chunks is not None:
+            if hi <= lo:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=self.chunks.value_dtype)
+            parts = [self.chunks.read_chunk(i) for i in range(lo, hi)]
+            millis = np.concatenate([p[0] for p in parts])
+            values = np.concatenate([p[1] for p in parts])
+        elif self.data is not None:
+            # narrow down to whole index steps, then search only inside them
+            start = lo * INDEX_ROWS
+            times = self.data['time'][start:hi * INDEX_ROWS]
+            a = start + int(np.searchsorted(times, t0, side='left'))
+            b = start + int(np.searchsorted(times, t1, side='right'))
+            return self.data['time'][a:b], self.data['value'][a:b]
+        else:
+            if hi <= lo:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            start = int(self.csv_index['offset'][lo])
+            stop = int(self.csv_index['offset'][hi]) if hi < len(self.csv_index) else self.end
+            millis, values, errors = fastcsv.parse_block(self.mm[start:stop], final=False)
+
+        a = int(np.searchsorted(millis, t0, side='left'))
+        b = int(np.searchsorted(millis, t1, side='right'))
+        return millis[a:b], values[a:b]
+
+    def time_range(self):
+        # this function returns the first and last time in the session
+        if self.chunks is not None:
+            index = self.chunks.index
+            return (int(index['first'][0]), int(index['last'][-1])) if len(index) else (None, None)
+        if self.data is not None:
+            return (float(self.data['time'][0]), float(self.data['time'][-1])) if len(self.data) else (None, None)
+        if len(self.csv_index) == 0:
+            return None, None
+        start = int(self.csv_index['offset'][-1])
+        millis, values, errors = fastcsv.parse_block(self.mm[start:self.end], final=False)
+        return int(self.csv_index['millis'][0]), int(millis[-1])
+
+    def close(self):
+        # views returned by read_range keep a spill file mapped until they are gone
+        if self.mm is not None:
+            self.mm.close()
+            self.f.close()
+        self.mm = None
+        self.f = None
+        self.data = None
+        self.chunks = None
+
+
+def open_writer(base, storage=CSV, value_dtype='f4'):
+    # this function creates the session writer used by logging()
+    # base is the file name without an extension
+    # the pyramid for drawing the session is built alongside (see pyramid.py), a session
+    # that is appended to loses its pyramid until it is rebuilt
+    path = base + (".swt" if storage == CHUNK else ".csv")
+    lod = pyramid.lod_path(path)
+    if os.path.exists(lod):
+        shutil.rmtree(lod)
+    appending = os.path.exists(path) and os.path.getsize(path) > 0
+    writer = ChunkSessionWriter(path, value_dtype) if storage == CHUNK else CsvSessionWriter(path)
+    if appending:
+        return writer
+    return pyramid.PyramidWriter(writer, lod)
+
+
+def iter_csv(path, rows=CHUNK_SIZE):
+    # this function reads a csv log in blocks of about rows lines, so memory stays flat
+    # debug output and partial lines are skipped (see fastcsv.py)
+    for millis, values, errors in fastcsv.iter_blocks(path, rows * 16):
+        yield millis, values
+
+
+def read_csv(path):
+    # this function reads the millis,value columns of a csv log
+    millis, values, errors = fastcsv.load(path)
+    return millis, values
+
+
+def convert_csv(csv_path, out_path=None):
+    # this function converts a csv log into a chunk session file
+    if out_path is None:
+        out_path = os.path.splitext(csv_path)[0] + ".swt"
+    millis, values = read_csv(csv_path)
+
+    # whole numbers that fit are raw ADC counts, anything else is a voltage
+    value_dtype = 'f4'
+    if len(values) and np.all(values == np.round(values)) and values.min() >= 0 and values.max() < 65536:
+        value_dtype = 'u2'
+
+    writer = ChunkSessionWriter(out_path, value_dtype)
+    writer.write(millis, values)
+    writer.close()
+    return out_path
+
+
+def main(argv):
+    # convert each csv given on the command line
+    if len(argv) < 2 or argv[0] != "convert":
+        print("usage: python session.py convert <csv files>")
+        return 1
+    for path in argv[1:]:
+        out_path = convert_csv(path)
+        print(path + " -> " + out_path + " (" + str(os.path.getsize(path)) + " -> " + str(os.path.getsize(out_path)) + " bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
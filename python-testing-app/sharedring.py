@@ -0,0 +1,221 @@
+# sharedring.py
+# the ring buffer of the samples in shared memory, for other processes to read
+#
+# SharedRing is the RingBuffer of the acquisition process (core.Acquisition with a ring name,
+# "daemon.py serve --ring <name>") with its arrays in a multiprocessing.shared_memory block, so
+# analysis, plotting and storage can run in processes of their own, off the GIL of the process
+# reading the board
+# - the block holds HEADER int64 counters and then the times and the values, each twice the
+#   capacity as in ringbuffer.py so any window of the ring is one contiguous slice
+# - TOTAL is the sequence number of the next sample, the writer moves WRITING on to the end of
+#   a batch, stores the batch and only then moves TOTAL on, BATCHES counts the batches and
+#   CLOSED is set when the writer is gone
+# - there is one writer and any number of readers, the readers never write to the block, so
+#   there is no lock and a reader can not hold up the writer
+# RingReader follows the ring from another process and returns the new samples as views into
+# the block, without copying them
+# - a reader that falls more than the capacity behind WRITING skips ahead and counts what it
+#   lost, so it never starts on the slots of the batch being written
+# - the writer may overwrite a view while it is being used, valid() tells afterwards whether
+#   the last views read are still intact (WRITING has not moved a whole capacity past them)
+#
+# "python sharedring.py <name>" prints the rate and the mean of a ring once a second
+
+# import statements
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from ringbuffer import RingBuffer
+
+# samples held, 32 MB of shared memory (containers often give /dev/shm only 64 MB)
+SHARED_CAPACITY = 2 ** 20
+
+# the counters at the start of the block
+MAGIC, CAPACITY, TOTAL, BATCHES, CLOSED, PID, WRITING = range(7)
+HEADER = 8
+
+# set last by the writer, a reader only attaches to a ring that is ready
+RING_MAGIC = 0x5357454154
+
+# seconds between looks at TOTAL while a reader waits
+POLL_INTERVAL = 0.002
+
+
+def _layout(buf, capacity):
+    # this function returns the header, the times and the values in a block
+    n = 2 * capacity
+    header = np.ndarray(HEADER, dtype=np.int64, buffer=buf)
+    times = np.ndarray(n, dtype=np.float64, buffer=buf, offset=HEADER * 8)
+    values = np.ndarray(n, dtype=np.float64, buffer=buf, offset=HEADER * 8 + n * 8)
+    return header, times, values
+
+
+def _attach(name):
+    # this function opens a block made by another process without registering it with the
+    # resource tracker, which would remove it when this process ends, it belongs to the writer
+    # (track=False from python 3.13, before that registering is skipped for the call)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _release(shm):
+    # this function unmaps a block, unless views into it are still held somewhere, then it
+    # stays mapped until the process ends
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+class SharedRing(RingBuffer):
+    # this class is a RingBuffer in shared memory, with the same single writer
+
+    def __init__(self, capacity=SHARED_CAPACITY, name=None, spill_path=None):
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=8 * (HEADER + 4 * capacity))
+        self.name = self.shm.name
+        self.header, times, values = _layout(self.shm.buf, capacity)
+        self.header[:] = 0
+        self.header[CAPACITY] = capacity
+        self.header[PID] = os.getpid()
+        self.arrays = (times, values)
+        RingBuffer.__init__(self, capacity, spill_path)
+        self.header[MAGIC] = RING_MAGIC
+
+    def _allocate(self, n):
+        return self.arrays
+
+    # the write count lives in the block, RingBuffer moves it on once a batch is written
+    @property
+    def total(self):
+        return int(self.header[TOTAL])
+
+    @total.setter
+    def total(self, value):
+        self.header[TOTAL] = value
+
+    # the slots up to WRITING are claimed before they are overwritten
+    def put(self, t, v):
+        self.header[WRITING] = self.total + 1
+        RingBuffer.put(self, t, v)
+
+    def append(self, times, values):
+        self.header[WRITING] = self.total + len(times)
+        RingBuffer.append(self, times, values)
+        self.header[BATCHES] += 1
+
+    def unlink(self):
+        # this function tells the readers the writer is gone and removes the block, the
+        # readers keep what they have mapped
+        if self.shm is None:
+            return
+        self.close()
+        self.header[CLOSED] = 1
+        self.header = self.times = self.values = self.arrays = None
+        self.shm.unlink()
+        _release(self.shm)
+        self.shm = None
+
+
+class RingReader:
+    # this class reads a SharedRing from any process
+    # backlog is how many of the samples already held the first read returns
+
+    def __init__(self, name, backlog=0):
+        self.shm = _attach(name)
+        header = np.ndarray(HEADER, dtype=np.int64, buffer=self.shm.buf)
+        if header[MAGIC] != RING_MAGIC:
+            del header
+            _release(self.shm)
+            raise ValueError(name + " is not a sample ring")
+        self.name = name
+        self.capacity = int(header[CAPACITY])
+        del header
+        self.header, self.times, self.values = _layout(self.shm.buf, self.capacity)
+
+        # sequence number of the next sample to read, and of the first of the last read
+        total = int(self.header[TOTAL])
+        self.position = max(total - min(backlog, total), self._oldest(total))
+        self.first = self.position
+        self.lost = 0
+
+    def _oldest(self, total):
+        # this function returns the oldest sample the writer is not overwriting, TOTAL is
+        # read first so WRITING is never behind it
+        return min(int(self.header[WRITING]) - self.capacity, total)
+
+    def available(self):
+        # this function returns how many samples are waiting
+        return int(self.header[TOTAL]) - self.position
+
+    def closed(self):
+        return bool(self.header[CLOSED])
+
+    def read(self, limit=None):
+        # this function returns the samples written since the last read as views into the
+        # ring, at most limit of them
+        total = int(self.header[TOTAL])
+        oldest = self._oldest(total)
+        if self.position < oldest:
+            self.lost += oldest - self.position
+            self.position = oldest
+        n = total - self.position
+        if limit is not None:
+            n = min(n, limit)
+        start = self.position % self.capacity
+        self.first = self.position
+        self.position += n
+        return self.times[start:start + n], self.values[start:start + n]
+
+    def valid(self):
+        # this function checks that the writer has not overwritten the last read yet
+        return int(self.header[WRITING]) - self.first <= self.capacity
+
+    def wait(self, timeout=None):
+        # this function waits until there are new samples, returns False on timeout or once
+        # the writer is gone
+        end = None if timeout is None else time.perf_counter() + timeout
+        while int(self.header[TOTAL]) == self.position:
+            if self.header[CLOSED] or (end is not None and time.perf_counter() >= end):
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def close(self):
+        # views handed out by read() keep the block mapped until they are dropped
+        self.header = self.times = self.values = None
+        _release(self.shm)
+
+
+def main(argv):
+    # follow a ring and print what arrives once a second
+    if not argv:
+        print("usage: python sharedring.py <name>")
+        return 1
+    reader = RingReader(argv[0])
+    print("following %s, %d samples" % (argv[0], reader.capacity))
+    try:
+        while not reader.closed():
+            time.sleep(1.0)
+            times, values = reader.read()
+            if len(values) and reader.valid():
+                print("%7d samples/s  lost %d  mean %.4f  last %d ms"
+                      % (len(values), reader.lost, float(values.mean()), int(times[-1])))
+    except KeyboardInterrupt:
+        pass
+    reader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,538 @@
+# simulator.py
+# stand in for the SWEATsens board so the apps can run without hardware
+#
+# the simulator opens a pty and behaves like board_main.ino on the other end of it
+# - "func,val" commands, 0 testing, 1 LED, 2 stimulation, 3 logging (ascii), 4 electrode,
+#   5 logging (binary frames), logging runs when the value is more than 1 and the value
+#   is the interval between samples in ms, as on the board
+# - logging writes "millis,value" lines or binary frames, testing writes "millis,value"
+#   lines with random whole volts
+# - commands end at a newline, or after command_gap without a byte, and one with an id
+#   ("func,val,id") is acknowledged with an "ack,id,func" line or an ack frame
+# - legacy=True reads commands like the firmware before that, Serial.readString() takes
+#   everything that arrives before a gap of command_gap and nothing is sampled meanwhile,
+#   and nothing is acknowledged
+# - "6,baud" changes the rate once its ack has gone out and goes back unless "6,baud" comes
+#   again within link.CONFIRM, "7,n" sends n test frames and an ack frame (see link.py)
+# with max_baud set the pty stands for a UART, bytes are garbled while the rate the host set
+# on the port differs from the board's, and above max_baud error_rate of the bytes get a bit
+# flipped, without it the pty is the native USB port and the rate only limits the output
+# alias makes a link to the pty like the /dev/serial/by-id links, unplug() takes the port
+# away and plug() brings it back under the same alias with the board restarted
+# millis() can start anywhere (e.g. just before the 32 bit wrap) and run fast or slow by
+# drift_ppm, like a board that has been on for weeks with an off crystal
+# the rate can be forced above what the interval allows, output is limited to what the
+# baud rate could carry (10 bits per byte), and like the board blocking in Serial.write()
+# no new samples are taken while the transmit buffer is full
+#
+# BleNotifier produces the batched notifications of logsCharacteristic and
+# FakeBleClient wraps it in the parts of the bleak client that bluetooth.py uses
+#
+# run "python simulator.py" to get a port for logger.py
+
+# import statements
+import os
+import sys
+import tty
+import time
+import select
+import asyncio
+import argparse
+from threading import Thread
+import numpy as np
+import termios
+import frames
+import link
+
+
+def sine_signal(millis):
+    # this function makes a noisy sine in ADC counts like the sample log
+    noise = np.random.randint(-20, 21, size=len(millis))
+    return np.clip(2048 + 1500 * np.sin(millis / 2000.0) + noise, 0, 4095).astype(np.uint16)
+
+
+# termios speed codes of the standard rates
+SPEEDS = {getattr(termios, 'B%d' % baud): baud for baud in (9600, 19200, 38400, 57600, 115200, 230400, 460800,
+                                                             500000, 921600, 1000000, 2000000, 4000000)
+          if hasattr(termios, 'B%d' % baud)}
+
+
+def corrupt(data, p):
+    # this function flips one bit in about p of the bytes
+    raw = np.frombuffer(data, dtype=np.uint8).copy()
+    hit = np.flatnonzero(np.random.random(len(raw)) < p)
+    raw[hit] ^= (1 << np.random.randint(0, 8, size=len(hit))).astype(np.uint8)
+    return raw.tobytes()
+
+
+class BoardSimulator:
+    # this class runs the simulated board on a pty
+
+    def __init__(self, rate=None, baud=9600, signal=sine_signal, chatter=False, tick=0.005, command_gap=0.05,
+                 tx_buffer=4096, start_millis=0, drift_ppm=0.0, legacy=False, max_baud=None, error_rate=0.01,
+                 alias=None):
+        # rate overrides the logging interval, in samples per second
+        self.rate = rate
+        self.baud = baud
+        self.signal = signal
+        self.chatter = chatter
+        self.tick = tick
+        self.command_gap = command_gap
+        self.tx_buffer = tx_buffer
+        self.start_millis = start_millis
+        self.drift_ppm = drift_ppm
+        self.legacy = legacy
+        self.max_baud = max_baud
+        self.error_rate = error_rate
+        self.alias = alias
+        self.start_baud = baud
+
+        # a rate asked for by "6," and the one to go back to if it is not kept
+        self.next_baud = None
+        self.previous_baud = baud
+        self.baud_changed = None
+
+        # statistics
+        self.bytes_out = 0
+        self.samples_out = 0
+        self.commands = []
+        self.acks = 0
+        self.garbled = 0
+        self.plugs = 0
+
+        self._reset()
+        self._open()
+        self.running = False
+
+    def _reset(self):
+        # board state, same names as the firmware, as it is after a restart
+        self.testing = 0
+        self.led_state = 0
+        self.stim_state = 0.0
+        self.sensor_state = 0.0
+        self.logging_state = 0
+        self.output_format = frames.ASCII
+        self.baud = self.start_baud
+        self.next_baud = None
+        self.baud_changed = None
+
+    def _open(self):
+        # the board side of the pty is master, the host opens port
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.tty = os.ttyname(self.slave)
+        self.port = self.tty
+        if self.alias is not None:
+            # replace the link atomically, like udev does
+            tmp = self.alias + ".new"
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(self.tty, tmp)
+            os.replace(tmp, self.alias)
+            self.port = self.alias
+
+    def _close(self):
+        # closing the master removes the pty node, the host's reads fail
+        if self.alias is not None and os.path.lexists(self.alias):
+            os.remove(self.alias)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self._close()
+
+    def unplug(self):
+        # this function takes the board away, the pty and the alias go
+        self.stop()
+
+    def plug(self):
+        # this function brings the board back restarted, on a new pty under the same alias
+        self._reset()
+        self.start_millis = 0
+        self.plugs += 1
+        self._open()
+        return self.start()
+
+    def millis(self):
+        # board time since start, an unsigned long on the board so it wraps at 2^32
+        elapsed = (time.perf_counter() - self.start_time) * 1000 * (1 + self.drift_ppm * 1e-6)
+        return (self.start_millis + int(elapsed)) % 2 ** 32
+
+    def handle(self, command):
+        # this function applies one "func,val[,id]" command the way loop() does and returns
+        # the acknowledgement to send, if any
+        command = command.strip()
+        if not command:
+            return b''
+        self.commands.append(command)
+        parts = command.split(',')
+        try:
+            func = int(parts[0])
+            val = float(parts[1])
+        except (IndexError, ValueError):
+            return b''
+
+        # the readString() firmware only knows 0 to 5
+        if self.legacy and func > 5:
+            return b''
+        rid = None
+        if len(parts) > 2:
+            try:
+                rid = int(parts[2])
+            except ValueError:
+                pass
+
+        if func == 0:
+            self.testing = int(val)
+        elif func == 1:
+            self.led_state = int(val)
+        elif func == 2:
+            self.stim_state = val
+        elif func == 3:
+            self.logging_state = int(val)
+            self.output_format = frames.ASCII
+        elif func == 4:
+            self.sensor_state = val
+        elif func == 5:
+            self.logging_state = int(val)
+            self.output_format = frames.BINARY
+        elif func == 6:
+            # the same rate again keeps it
+            if int(val) == self.baud:
+                self.baud_changed = None
+            elif int(val) >= link.SAFE_BAUD:
+                self.next_baud = int(val)
+        elif func == 7:
+            # the test pattern and its ack frame, whatever the output format
+            index = np.arange(min(int(val), link.MAX_PROBE_FRAMES))
+            self.acks += 1
+            return frames.encode_frames(index, link.test_values(index)) + frames.encode_acks([rid or 0], [7])
+
+        # the readString() firmware ignores the id
+        if self.legacy or rid is None:
+            return b''
+        self.acks += 1
+        if self.output_format == frames.BINARY:
+            return frames.encode_acks([rid], [func])
+        return ('ack,%d,%d\r\n' % (rid, func)).encode('utf-8')
+
+    def sample_rate(self):
+        # samples per second for the current state
+        if self.rate is not None:
+            return self.rate
+        # the board waits until more than interval ms have passed
+        interval = self.logging_state if self.logging_state > 1 else 2000
+        return 1000.0 / (interval + 1)
+
+    def encode(self, millis, values):
+        # this function formats samples the way the firmware prints them
+        if self.logging_state > 1 and self.output_format == frames.BINARY:
+            return frames.encode_frames(millis, values)
+        if self.logging_state > 1:
+            lines = ['%d,%d\r\n' % (t, v) for t, v in zip(millis.tolist(), values.tolist())]
+            if self.chatter:
+                # startLogging() also prints the SPI reading before every sample
+                lines = ['%d\r\n%s' % (v, line) for v, line in zip(values.tolist(), lines)]
+            return ''.join(lines).encode('utf-8')
+        # testing mode prints random volts truncated to a whole number
+        volts = np.random.randint(0, 3300, size=len(millis)) // 1000
+        return ''.join('%d,%d\r\n' % (t, v) for t, v in zip(millis.tolist(), volts.tolist())).encode('utf-8')
+
+    def host_baud(self):
+        # this function returns the rate the host set on the port, None for a rate with no
+        # termios code
+        return SPEEDS.get(termios.tcgetattr(self.slave)[5])
+
+    def garble(self, data):
+        # this function returns data as it comes through the link at the current rates
+        if self.max_baud is None or not data:
+            return data
+        if self.host_baud() != self.baud:
+            self.garbled += len(data)
+            return os.urandom(len(data))
+        if self.baud > self.max_baud:
+            return corrupt(data, self.error_rate)
+        return data
+
+    def _switch_baud(self, now, flushed):
+        # this function changes the rate once the ack has gone out, and goes back if the
+        # new rate is not kept in time
+        if self.next_baud is not None and flushed:
+            self.previous_baud = self.baud
+            self.baud = self.next_baud
+            self.next_baud = None
+            self.baud_changed = now
+        elif self.baud_changed is not None and now - self.baud_changed > link.CONFIRM:
+            self.baud = self.previous_baud
+            self.baud_changed = None
+
+    def _run(self):
+        # this function is the main loop of the simulated board
+        command = b''
+        last_byte = 0.0
+        due = 0.0
+        credit = 0.0
+        pending = b''
+        last = time.perf_counter()
+
+        # millis of the last sample taken, the board's clock never goes back
+        taken = None
+
+        while self.running:
+            # wait for a command or the next tick
+            ready, _, _ = select.select([self.master], [], [], self.tick)
+            now = time.perf_counter()
+
+            if ready:
+                try:
+                    command += self.garble(os.read(self.master, 4096))
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    break
+                last_byte = now
+
+            if not self.legacy:
+                # a newline ends a command straight away
+                while b'\n' in command:
+                    line, _, command = command.partition(b'\n')
+                    pending += self.handle(line.decode('utf-8', 'replace'))
+
+            # like readString(), a command ends when the host stops sending
+            stalled = False
+            if command and now - last_byte > self.command_gap:
+                for line in command.decode('utf-8', 'replace').splitlines():
+                    pending += self.handle(line)
+                command = b''
+            elif command and self.legacy:
+                # readString() holds up loop(), nothing is sampled until it returns
+                stalled = True
+
+            elapsed = now - last
+            last = now
+            active = (self.logging_state > 1 or self.testing) and not stalled
+
+            if active and len(pending) >= self.tx_buffer:
+                # the transmit buffer is full, the board is stuck writing
+                due = 0.0
+            elif active:
+                # work out how many samples are due since the last tick
+                rate = self.sample_rate()
+                due += elapsed * rate
+                n = int(due)
+                due -= n
+                if n > 0:
+                    end = self.millis()
+                    if self.rate is not None:
+                        # forced rates space the samples evenly up to now
+                        millis = (end - (np.arange(n)[::-1] * (1000.0 / rate)).astype(np.int64)) % 2 ** 32
+
+                        # the spacing is rounded, so the first samples can land before the
+                        # last one of the previous tick, the host would take that for a restart
+                        if taken is not None:
+                            millis[(taken - millis) % 2 ** 32 < 2 ** 31] = taken
+                    else:
+                        millis = np.full(n, end, dtype=np.int64)
+                    taken = int(millis[-1])
+                    values = self.signal(millis)
+                    pending += self.encode(millis, values)
+                    self.samples_out += n
+            else:
+                due = 0.0
+
+            # send no faster than the baud rate allows, a UART can not save up for a burst
+            # beyond a tick or so
+            credit = min(credit + elapsed * self.baud / 10.0, self.baud / 10.0 * 0.05)
+            if pending and credit >= 1:
+                size = min(len(pending), int(credit))
+                try:
+                    written = os.write(self.master, self.garble(pending[:size]))
+                except (BlockingIOError, OSError):
+                    written = 0
+                pending = pending[written:]
+                credit -= written
+                self.bytes_out += written
+
+            # like Serial.flush() before Serial.begin(), the rate changes once all is sent
+            self._switch_baud(now, not pending)
+
+
+class BleNotifier:
+    # this class calls a callback with logsCharacteristic notifications at a fixed sample rate
+    # the callback has the same signature as a bleak notification handler
+    # like the board, samples are sent in batches of batch samples, a partial batch is sent
+    # once its first sample is timeout seconds old, batch=None sends one btOut_type per sample
+
+    def __init__(self, callback, rate=10.0, signal=sine_signal, tick=0.005, drop=0.0, batch=frames.MIN_BATCH,
+                 timeout=0.1):
+        self.callback = callback
+        self.rate = rate
+        self.signal = signal
+        self.tick = tick
+        self.batch = batch
+        self.timeout = timeout
+
+        # fraction of notifications to lose on the way, to exercise the drop statistics
+        self.drop = drop
+        self.sent = 0
+        self.dropped = 0
+        self.notifications = 0
+        self.seq = 0
+        self.running = False
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _packets(self, millis, values):
+        # this function returns the notifications and how many samples each one carries
+        if self.batch is None:
+            return frames.pack_ble(millis, values), np.ones(len(millis), dtype=np.int64)
+        packets = frames.pack_ble_batches(millis, values, self.batch, self.seq)
+        self.seq += len(packets)
+        sizes = np.full(len(packets), self.batch)
+        sizes[-1] = len(millis) - self.batch * (len(packets) - 1)
+        return packets, sizes
+
+    def _run(self):
+        due = 0.0
+        last = self.start_time
+        held_t = np.zeros(0, dtype=np.int64)
+        held_v = np.zeros(0, dtype=np.uint16)
+        while self.running:
+            time.sleep(self.tick)
+            now = time.perf_counter()
+            due += (now - last) * self.rate
+            last = now
+            n = int(due)
+            due -= n
+            end = int((now - self.start_time) * 1000)
+            if n > 0:
+                millis = end - (np.arange(n)[::-1] * (1000.0 / self.rate)).astype(np.int64)
+                held_t = np.concatenate((held_t, millis))
+                held_v = np.concatenate((held_v, self.signal(millis)))
+
+            # send the full batches, and the partial one when it has waited long enough
+            if len(held_t) == 0:
+                continue
+            ready = len(held_t) if self.batch is None else len(held_t) - len(held_t) % self.batch
+            if ready == 0 and end - held_t[0] >= self.timeout * 1000:
+                ready = len(held_t)
+            if ready == 0:
+                continue
+            packets, sizes = self._packets(held_t[:ready], held_v[:ready])
+            held_t = held_t[ready:]
+            held_v = held_v[ready:]
+
+            lost = np.random.random(len(packets)) < self.drop
+            for packet, skip in zip(packets, lost.tolist()):
+                if not skip:
+                    self.callback(None, bytearray(packet))
+            self.notifications += len(packets)
+            self.sent += ready
+            self.dropped += int(sizes[lost].sum())
+
+
+class FakeBleClient:
+    # this class stands in for a bleak BleakClient connected to the board
+    # it has the methods bluetooth.py uses, writing the logging characteristic starts
+    # a BleNotifier and the notifications are delivered on the asyncio loop like bleak does
+
+    def __init__(self, rate=None, drop=0.0, mtu_size=247):
+        # rate overrides the logging interval, in samples per second
+        self.rate = rate
+        self.drop = drop
+        self.mtu_size = mtu_size
+        self.batch = frames.MIN_BATCH
+        self.is_connected = False
+        self.values = {}
+        self.callbacks = {}
+        self.notifier = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.is_connected = True
+
+    async def disconnect(self):
+        self._stop_notifier()
+        self.is_connected = False
+
+    async def start_notify(self, uuid, callback):
+        self.callbacks[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self.callbacks.pop(uuid, None)
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        self.values[uuid] = bytes(data)
+        if uuid == frames.BATCH_UUID:
+            self.batch = min(max(data[0], frames.MIN_BATCH), frames.MAX_BATCH)
+        if uuid != frames.LOGGING_UUID:
+            return
+
+        # the board logs while the logging value is more than 1, the value is the interval
+        self._stop_notifier()
+        interval = data[0]
+        if interval > 1:
+            rate = self.rate or 1000.0 / (interval + 1)
+            self.notifier = BleNotifier(self._deliver, rate, drop=self.drop, batch=self.batch).start()
+
+    def _deliver(self, sender, data):
+        # hand the notification to the loop thread
+        callback = self.callbacks.get(frames.LOGS_UUID)
+        if callback is not None:
+            self.loop.call_soon_threadsafe(callback, sender, data)
+
+    def _stop_notifier(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulated SWEATsens board on a pty")
+    parser.add_argument("--rate", type=float, default=None, help="force a sample rate in samples/s")
+    parser.add_argument("--baud", type=int, default=9600, help="baud rate to limit the output to")
+    parser.add_argument("--chatter", action="store_true", help="print the extra debug lines the firmware prints")
+    parser.add_argument("--start-millis", type=int, default=0, help="millis() at start, e.g. 4294960000 to wrap soon")
+    parser.add_argument("--drift-ppm", type=float, default=0.0, help="how much faster the board clock runs")
+    parser.add_argument("--legacy", action="store_true", help="read commands with readString() like older firmware")
+    parser.add_argument("--max-baud", type=int, default=None, help="fastest rate the simulated UART carries intact")
+    args = parser.parse_args()
+
+    sim = BoardSimulator(args.rate, args.baud, chatter=args.chatter, start_millis=args.start_millis,
+                         drift_ppm=args.drift_ppm, legacy=args.legacy, max_baud=args.max_baud).start()
+    print("Simulated board on " + sim.port)
+    print("Run: python logger.py " + sim.port)
+    # the board clock on the host's perf_counter clock (the same in every process on linux), for
+    # benchmark.py to time samples from the board to the disk
+    print("Board millis 0 at perf_counter %.6f" % (sim.start_time - sim.start_millis / 1000.0))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+    print("Sent " + str(sim.samples_out) + " samples, " + str(sim.bytes_out) + " bytes")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+# streamstats.py
+# running statistics and alarms on the live sample stream
+#
+# StreamStats sits between decoding and the session writer, every batch of samples is
+# folded into
+# - mean and standard deviation over the last window samples
+# - an exponentially weighted moving average (ewma) with a span of ewma_span samples
+# - the least squares slope (V/s) over the last slope_window samples
+# - min and max over the last extreme_window samples
+# and checked against the alarms, e.g. a threshold on the voltage or on the slope
+# the cost per sample does not depend on the window
+# - the sums behind the mean, std and slope are kept up to date by adding the samples
+#   coming into the window and taking off the ones leaving it, they are summed again
+#   from the window every 16 windows so rounding errors do not build up
+# - min and max use van Herk / Gil-Werman blocks (see analysis._moving_extreme), keeping
+#   only the suffix extremes of the last whole block and the prefix of the current one
+# - the ewma recurrence is solved for a run of samples at once with a cumulative sum
+# everything is done on whole batches with numpy, the same numbers come out however the
+# stream is cut into batches
+#
+# the engine collects the decoded batches and feeds them on a worker thread a few times a
+# second, then posts the latest row and any alarms to the GUI (see engine.Device)
+
+# import statements
+import numpy as np
+import analysis
+
+# one row of statistics per sample
+STATS_DTYPE = np.dtype([('millis', '<i8'), ('value', '<f8'), ('mean', '<f8'), ('std', '<f8'),
+                        ('ewma', '<f8'), ('slope', '<f8'), ('min', '<f8'), ('max', '<f8')])
+
+# one alarm going on or off
+ALARM_DTYPE = np.dtype([('millis', '<i8'), ('name', 'U32'), ('active', '?'), ('value', '<f8')])
+
+# default windows in samples
+WINDOW = 1000
+EWMA_SPAN = 100
+
+# the window sums are summed again from scratch after this many windows
+REBASE = 16
+
+# the ewma is solved this many decades of decay at a time, so the weights stay in range
+EWMA_DECADES = 12
+
+
+class RollingSums:
+    # this class keeps the sums of v, v^2, t, t^2 and t*v over the last window samples
+    # times and values are taken relative to an origin close to the window so the sums
+    # keep their precision
+
+    def __init__(self, window):
+        self.window = max(int(window), 1)
+        self.times = np.zeros(self.window)
+        self.values = np.zeros(self.window)
+        self.count = 0
+        self.origin = None
+        self.sums = np.zeros(5)
+        self.since = 0
+
+    def _terms(self, t, v):
+        # this function returns the five terms of every sample, relative to the origin
+        dt = t - self.origin[0]
+        dv = v - self.origin[1]
+        return np.column_stack((dv, dv * dv, dt, dt * dt, dt * dv))
+
+    def feed(self, t, v):
+        # this function adds a batch, returns the sample count and the five sums at every
+        # sample and the origin they are relative to
+        n = len(v)
+        if self.origin is None:
+            self.origin = (float(t[0]), float(v[0]))
+        origin = self.origin
+        w = self.window
+
+        # the sample leaving the window as each new one comes in, the first ones leave from
+        # the history ring, the rest from the batch itself
+        k = min(n, w)
+        g = self.count + np.arange(k)
+        slots = g % w
+        gone = g >= w
+        terms = self._terms(t, v)
+        leaving = np.zeros_like(terms)
+        leaving[:k] = self._terms(self.times[slots], self.values[slots]) * gone[:, None]
+        leaving[k:] = terms[:n - k]
+
+        sums = np.cumsum(terms - leaving, axis=0)
+        sums += self.sums
+        counts = np.minimum(self.count + np.arange(1, n + 1), w)
+
+        # keep the last window samples
+        tail = np.arange(max(n - w, 0), n)
+        self.times[(self.count + tail) % w] = t[tail]
+        self.values[(self.count + tail) % w] = v[tail]
+        self.count += n
+        self.sums = sums[-1]
+
+        # sum the window again around the newest sample once in a while
+        self.since += n
+        if self.since >= REBASE * w:
+            self._rebase(float(t[-1]), float(v[-1]))
+        return counts, sums, origin
+
+    def _rebase(self, t, v):
+        # this function moves the origin to (t, v) and sums the window from scratch
+        self.origin = (t, v)
+        m = min(self.count, self.window)
+        slots = (self.count - 1 - np.arange(m)) % self.window
+        self.sums = self._terms(self.times[slots], self.values[slots]).sum(axis=0)
+        self.since = 0
+
+
+class RollingExtreme:
+    # this class keeps the min (np.minimum) or max (np.maximum) over the last window samples
+    # a window always spans the end of the previous block of window samples and the start
+    # of the current one, so only the suffix extremes of the previous block and the running
+    # extreme of the current one are needed
+
+    def __init__(self, window, ufunc):
+        self.window = max(int(window), 1)
+        self.ufunc = ufunc
+        self.fill = np.inf if ufunc is np.minimum else -np.inf
+
+        # the suffix of the previous block, with one more fill for windows that start at
+        # the start of the current block
+        self.suffix = np.full(self.window + 1, self.fill)
+        self.block = np.empty(self.window)
+        self.filled = 0
+        self.prefix = self.fill
+
+    def _partial(self, x, out):
+        # this function adds samples up to the end of the current block
+        f = self.filled
+        prefix = self.ufunc.accumulate(x)
+        self.ufunc(prefix, self.prefix, out=prefix)
+        self.ufunc(prefix, self.suffix[f + 1:f + 1 + len(x)], out=out)
+        self.block[f:f + len(x)] = x
+        self.filled += len(x)
+        self.prefix = prefix[-1]
+        if self.filled == self.window:
+            self.suffix[:-1] = self.ufunc.accumulate(self.block[::-1])[::-1]
+            self.filled = 0
+            self.prefix = self.fill
+
+    def feed(self, x):
+        # this function adds a batch and returns the extreme at every sample
+        w = self.window
+        out = np.empty(len(x))
+        i = 0
+        if self.filled:
+            i = min(len(x), w - self.filled)
+            self._partial(x[:i], out[:i])
+
+        # whole blocks, each one looks back into the suffix of the block before it
+        m = (len(x) - i) // w
+        if m:
+            blocks = x[i:i + m * w].reshape(m, w)
+            prefix = self.ufunc.accumulate(blocks, axis=1)
+            suffix = self.ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]
+            before = np.empty((m, w + 1))
+            before[0] = self.suffix
+            before[1:, :w] = suffix[:-1]
+            before[1:, w] = self.fill
+            self.ufunc(prefix, before[:, 1:], out=out[i:i + m * w].reshape(m, w))
+            self.suffix[:-1] = suffix[-1]
+            i += m * w
+
+        if i < len(x):
+            self._partial(x[i:], out[i:])
+        return out
+
+
+def ewma(x, alpha, start):
+    # this function returns the ewma of x carrying on from start
+    # y[i] = d^(i+1) * (start + alpha * sum(x[j] / d^(j+1))) with d = 1 - alpha, solved a run
+    # of samples at a time so d^-(j+1) stays below 10^EWMA_DECADES
+    d = 1.0 - alpha
+    if d <= 0.0:
+        return np.array(x, dtype=np.float64)
+    step = max(int(EWMA_DECADES * np.log(10) / -np.log(d)), 1)
+    out = np.empty(len(x))
+    for i in range(0, len(x), step):
+        seg = x[i:i + step]
+        powers = d ** np.arange(1, len(seg) + 1)
+        np.cumsum(seg / powers, out=out[i:i + len(seg)])
+        out[i:i + len(seg)] *= alpha
+        out[i:i + len(seg)] += start
+        out[i:i + len(seg)] *= powers
+        start = out[i + len(seg) - 1]
+    return out
+
+
+class Alarm:
+    # this class is one alarm on a column of the statistics (value, mean, ewma, slope, ...)
+    # it goes on above high or below low, and off once back inside by hysteresis
+    # e.g. Alarm("saturated", "ewma", high=3.2) or Alarm("falling", "slope", low=-0.05)
+
+    def __init__(self, name, column="value", high=None, low=None, hysteresis=0.0):
+        self.name = name
+        self.column = column
+        self.high = np.inf if high is None else high
+        self.low = -np.inf if low is None else low
+        self.hysteresis = hysteresis
+        self.active = False
+
+    def check(self, rows):
+        # this function returns the times the alarm went on or off in a batch of rows
+        x = rows[self.column]
+        on = (x > self.high) | (x < self.low)
+        off = (x <= self.high - self.hysteresis) & (x >= self.low + self.hysteresis)
+        if not (off if self.active else on).any():
+            return np.empty(0, dtype=ALARM_DTYPE)
+
+        # the state holds between samples that are neither, e.g. the nan slope of the
+        # first sample or a value in the hysteresis band
+        marks = np.where(on | off, np.arange(len(x)), -1)
+        np.maximum.accumulate(marks, out=marks)
+        state = np.where(marks >= 0, on[marks], self.active)
+        changes = np.flatnonzero(state != np.concatenate(([self.active], state[:-1])))
+        self.active = bool(state[-1]) if len(state) else self.active
+
+        events = np.empty(len(changes), dtype=ALARM_DTYPE)
+        events['millis'] = rows['millis'][changes]
+        events['name'] = self.name
+        events['active'] = state[changes]
+        events['value'] = x[changes]
+        return events
+
+
+class StreamStats:
+    # this class computes running statistics of a sample stream batch by batch
+    # counts=None converts the values to volts if the first batch looks like ADC counts
+    # reset() starts it again for a new session, which may carry counts or volts
+
+    def __init__(self, window=WINDOW, ewma_span=EWMA_SPAN, slope_window=None, extreme_window=None,
+                 alarms=(), counts=None):
+        self.window = window
+        self.slope_window = slope_window
+        self.extreme_window = window if extreme_window is None else extreme_window
+        self.alpha = 2.0 / (ewma_span + 1.0)
+        self.alarms = list(alarms)
+        self.reset(counts)
+
+    def reset(self, counts=None):
+        # this function forgets the samples so far and whether they were counts
+        # the alarms keep their state, one still on goes off with the first rows back inside
+        self.sums = RollingSums(self.window)
+        self.slope_sums = self.sums if self.slope_window in (None, self.window) else RollingSums(self.slope_window)
+        self.low = RollingExtreme(self.extreme_window, np.minimum)
+        self.high = RollingExtreme(self.extreme_window, np.maximum)
+        self.ewma = None
+        self.counts = counts
+        self.samples = 0
+        self.last = None
+
+    def feed(self, millis, values):
+        # this function adds a batch, returns a STATS_DTYPE row per sample and the alarm events
+        millis = np.asarray(millis)
+        values = np.asarray(values, dtype=np.float64)
+        if self.counts is None and len(values):
+            self.counts = analysis.is_counts(values)
+        if self.counts:
+            values = analysis.counts_to_volts(values)
+        rows = np.empty(len(values), dtype=STATS_DTYPE)
+        if len(values) == 0:
+            return rows, np.empty(0, dtype=ALARM_DTYPE)
+        t = millis.astype(np.float64)
+        rows['millis'] = millis
+        rows['value'] = values
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n, s, origin = self.sums.feed(t, values)
+            mean = s[:, 0] / n
+            rows['mean'] = origin[1] + mean
+            rows['std'] = np.sqrt(np.maximum(s[:, 1] / n - mean * mean, 0.0))
+
+            # least squares slope, the times are in ms
+            if self.slope_sums is not self.sums:
+                n, s, origin = self.slope_sums.feed(t, values)
+            rows['slope'] = 1000.0 * (n * s[:, 4] - s[:, 2] * s[:, 0]) / (n * s[:, 3] - s[:, 2] * s[:, 2])
+
+        if self.ewma is None:
+            self.ewma = values[0]
+        rows['ewma'] = ewma(values, self.alpha, self.ewma)
+        self.ewma = rows['ewma'][-1]
+        rows['min'] = self.low.feed(values)
+        rows['max'] = self.high.feed(values)
+
+        self.samples += len(rows)
+        self.last = rows[-1]
+        events = [e for e in (alarm.check(rows) for alarm in self.alarms) if len(e)]
+        if not events:
+            return rows, np.empty(0, dtype=ALARM_DTYPE)
+        return rows, np.sort(np.concatenate(events), order='millis', kind='stable')
+
+    def latest(self):
+        # this function returns the last row as a dict, for the GUI
+        if self.last is None:
+            return None
+        row = dict(zip(STATS_DTYPE.names, self.last.tolist()))
+        row['samples'] = self.samples
+        return row
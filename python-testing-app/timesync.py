@@ -0,0 +1,349 @@
+# timesync.py
+# board to host time alignment
+#
+# samples only carry the board's millis(), an unsigned 32 bit count that wraps after about
+# 49.7 days and runs a little fast or slow against the computer clock (tens of ppm, a few
+# seconds a day)
+# TimeSync turns them into absolute host times (ms since the epoch)
+# - millis are unwrapped into a 64 bit count, a step back of more than half the range is a
+#   wrap, a board reset is only taken when the board confirms it (RESET_CONFIRM samples in a
+#   row going on from a step back of more than RESET_STEP, or a reconnect), the count then
+#   carries on from there, any other sample that goes back is garbled or out of order, it is
+#   dropped and counted and the count is left alone
+# - every batch is stamped with time.perf_counter() when it is read, the samples in it were
+#   taken at or before that, so host - board is the clock offset plus a delay that is never
+#   negative
+# - the smallest host - board in every BUCKET ms of board time has the least delay, a least
+#   squares line through those points, older ones forgotten by FORGET a bucket, gives the
+#   offset and the drift
+# - the line is followed with a slew, each new fit is reached by the end of the next bucket
+#   so the corrected times never step back
+# perf_counter is tied to the wall clock once when the session starts, so the computer's
+# clock being set during a session does not move the timestamps
+#
+# the session keeps the board millis (unwrapped), the mapping is stored next to it
+#   "<file>.clock"   one CLOCK_DTYPE row (board ms, host ms, rate) every time the slew changes,
+#                    host = host_row + (board - board_row) * rate from that row on
+# to_host() turns the millis of any session into host times with numpy, merge() puts
+# several sessions (e.g. from multidevice.py) onto one time axis
+
+# import statements
+import os
+import time
+import numpy as np
+import analysis
+
+# one segment of the board to host mapping
+CLOCK_DTYPE = np.dtype([('board', '<i8'), ('host', '<f8'), ('rate', '<f8')])
+
+# millis() wraps at 2^32
+WRAP = 2 ** 32
+
+# a step back of more than this (ms) may be a board reset, a smaller one never is
+RESET_STEP = 5000
+
+# samples in a row that have to go on from a big step back before it is taken for a reset
+RESET_CONFIRM = 3
+
+# board ms per point of the fit, and the weight left to a point after every bucket
+BUCKET = 10000
+FORGET = 0.99
+
+# the slew never runs the corrected clock faster or slower than this
+MAX_SLEW = 0.5
+
+# one sample of a merged set of sessions
+MERGED_DTYPE = np.dtype([('host', '<f8'), ('millis', '<i8'), ('value', '<f8'), ('source', '<i4')])
+
+
+def clock_path(path):
+    # this function returns the file holding the clock mapping of a session file
+    return path + ".clock"
+
+
+class Unwrapper:
+    # this class turns 32 bit millis into a count that keeps going up
+    # the first samples after a reset that was not announced with restart() are dropped while
+    # it is confirmed
+
+    def __init__(self):
+        # the last two samples kept, unwrapped, and what is added to the millis
+        self.last = None
+        self.previous = None
+        self.offset = 0
+        self.resets = 0
+
+        # samples dropped, garbled or out of order
+        self.errors = 0
+
+        # a big step back not confirmed yet, (samples in a row, millis of the last one)
+        self.candidate = None
+        self.restarted = False
+
+    def restart(self):
+        # this function says the board may have restarted (it was reconnected), a step back
+        # at the next sample is a reset
+        self.restarted = True
+
+    def feed(self, millis):
+        # this function returns the unwrapped millis (int64) of the samples of a batch that are
+        # kept, and which were kept as a boolean mask, None when all of them were
+        raw = np.asarray(millis).astype(np.int64) % WRAP
+        if len(raw) == 0:
+            return raw, None
+        start = raw[0] if self.last is None else self.last - self.offset
+        step = np.diff(raw, prepend=start)
+
+        # a wrap adds the range, nothing goes back, the usual batch
+        wraps = step < -WRAP // 2
+        if np.all((step >= 0) | wraps):
+            board = raw + self.offset + np.cumsum(np.where(wraps, WRAP, 0))
+            self.offset = int(board[-1] - raw[-1])
+            self.previous = int(board[-2]) if len(board) > 1 else self.last
+            self.last = int(board[-1])
+            self.candidate = None
+            self.restarted = False
+            return board, None
+        return self._feed_each(raw.tolist())
+
+    def _unwrap(self, x):
+        # this function returns a millis unwrapped against the last sample, and the wrap added
+        u = x + self.offset
+        if u < self.last - WRAP // 2:
+            return u + WRAP, WRAP
+        return u, 0
+
+    def _confirmed(self, x):
+        # this function counts a sample that goes on from a step back, returns True once
+        # RESET_CONFIRM of them came in a row
+        count = 1
+        if self.candidate is not None and self.candidate[1] <= x:
+            count = self.candidate[0] + 1
+        if count < RESET_CONFIRM:
+            self.candidate = (count, x)
+            self.errors += 1
+            return False
+        self.candidate = None
+        return True
+
+    def _feed_each(self, raw):
+        # this function goes through a batch with a step back in it sample by sample
+        # nothing returned is ever below a sample returned before
+        keep = np.zeros(len(raw), dtype=bool)
+        board = np.empty(len(raw), dtype=np.int64)
+
+        # the index of the last sample if it is in this batch
+        last_i = None
+        for i, x in enumerate(raw):
+            if self.last is None:
+                self.last = x + self.offset
+                board[i] = self.last
+                keep[i] = True
+                last_i = i
+                continue
+            u, wrap = self._unwrap(x)
+            restarted = self.restarted
+            self.restarted = False
+
+            if u >= self.last:
+                # a sample above the next one, when the next goes on from the last, is garbled
+                if i + 1 < len(raw) and self.last <= self._unwrap(raw[i + 1])[0] < u:
+                    self.errors += 1
+                    continue
+                self.offset += wrap
+                self.previous, self.last = self.last, u
+                self.candidate = None
+
+            elif self.previous is not None and u >= self.previous and last_i is not None:
+                # the sample before was garbled, it is taken back
+                keep[last_i] = False
+                self.errors += 1
+                self.last = u
+                self.candidate = None
+
+            elif self.previous is not None and u >= self.previous:
+                # the sample before was garbled but has been returned already, once the board
+                # confirms it the count goes on from there
+                if not self._confirmed(x):
+                    continue
+                self.offset += self.last - u
+                self.previous = None
+
+            elif restarted or self.last - u > RESET_STEP:
+                # a reset, once the board confirms it
+                if not restarted and not self._confirmed(x):
+                    continue
+                self.candidate = None
+                self.offset = self.last
+                self.previous, self.last = None, x + self.offset
+                self.resets += 1
+
+            else:
+                # out of order
+                self.errors += 1
+                continue
+            board[i] = self.last
+            keep[i] = True
+            last_i = i
+        return board[keep], keep
+
+
+class TimeSync:
+    # this class fits the board clock to the host clock while logging and writes the
+    # mapping to path (None keeps it in memory only)
+
+    def __init__(self, path=None, bucket=BUCKET, forget=FORGET):
+        self.path = path
+        self.bucket = bucket
+        self.forget = forget
+        self.unwrapper = Unwrapper()
+
+        # perf_counter seconds to epoch ms
+        self.wall = time.time() - time.perf_counter()
+
+        # weighted sums of 1, x, y, x^2 and x*y, with x the board ms and y host - board,
+        # both from an origin so the sums keep their precision
+        self.sums = np.zeros(5)
+        self.origin = None
+        self.fit = None
+
+        # the sample with the smallest delay in the bucket being filled
+        self.best = None
+        self.bucket_start = None
+
+        # the current segment of the mapping and every segment so far
+        self.segment = None
+        self.segments = []
+        self.f = open(path, "ab") if path is not None else None
+
+    def stamp(self):
+        # this function returns the receive time to pass to feed, taken as soon as data arrives
+        return time.perf_counter()
+
+    def feed(self, millis, received):
+        # this function takes a batch of board millis and the perf_counter time (s) it was
+        # read, one for the batch or one per sample, and returns the unwrapped millis and
+        # the host time (epoch ms) of the samples kept, and the mask of the samples kept
+        # (None when all were, see Unwrapper)
+        resets = self.unwrapper.resets
+        board, keep = self.unwrapper.feed(millis)
+        if keep is not None and np.ndim(received):
+            received = np.asarray(received)[keep]
+        if len(board) == 0:
+            return board, np.empty(0), keep
+        if self.unwrapper.resets != resets:
+            # the board restarted, its clock has to be fitted again
+            self.sums[:] = 0
+            self.origin = None
+            self.fit = None
+            self.best = None
+            self.bucket_start = None
+
+        # the least delayed sample of the batch
+        offsets = (np.asarray(received, dtype=np.float64) + self.wall) * 1000 - board
+        i = int(np.argmin(offsets))
+        offset = float(offsets[i])
+        x = int(board[i])
+        if self.segment is None:
+            self._start(x, x + offset, 1.0)
+        if self.best is None or offset < self.best[1]:
+            self.best = (x, offset)
+        if self.bucket_start is None:
+            self.bucket_start = int(board[0])
+
+        # the times come from the segment that was current when the batch arrived
+        host = self.to_host(board)
+
+        if board[-1] - self.bucket_start >= self.bucket:
+            self._commit(int(board[-1]))
+        return board, host, keep
+
+    def to_host(self, board):
+        # this function maps unwrapped millis to host ms with the current segment
+        b, h, rate = self.segment
+        return h + (board - b) * rate
+
+    def _commit(self, now):
+        # this function adds the best point of the bucket to the fit and slews towards it
+        x, y = self.best
+        if self.origin is None:
+            self.origin = (x, y)
+        dx = (x - self.origin[0]) / 1000.0
+        dy = y - self.origin[1]
+        self.sums *= self.forget
+        self.sums += (1.0, dx, dy, dx * dx, dx * dy)
+        self.best = None
+        self.bucket_start = now
+
+        # least squares line, only the offset until there are two points apart in time
+        w, sx, sy, sxx, sxy = self.sums
+        var = w * sxx - sx * sx
+        drift = (w * sxy - sx * sy) / var if var > 1e-9 * w * w else 0.0
+        intercept = (sy - drift * sx) / w
+        self.fit = (drift, intercept)
+
+        # reach the fitted line one bucket from now without stepping back
+        end = now + self.bucket
+        target = end + self.origin[1] + intercept + drift * (end - self.origin[0]) / 1000.0
+        start = float(self.to_host(now))
+        rate = (target - start) / self.bucket
+        self._start(now, start, min(max(rate, 1.0 - MAX_SLEW), 1.0 + MAX_SLEW))
+
+    def _start(self, board, host, rate):
+        # this function starts a new segment of the mapping
+        self.segment = (board, host, rate)
+        row = np.array([self.segment], dtype=CLOCK_DTYPE)
+        self.segments.append(row[0])
+        if self.f is not None:
+            row.tofile(self.f)
+            self.f.flush()
+
+    def drift_ppm(self):
+        # this function returns the fitted drift of the board clock, in parts per million
+        # a positive drift means the board clock runs slow
+        if self.fit is None:
+            return None
+        return self.fit[0] * 1000.0
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def load_clock(path):
+    # this function reads the clock mapping of a session, None if it has none
+    mapping = clock_path(path)
+    if not os.path.exists(mapping):
+        return None
+    rows = np.fromfile(mapping, dtype=CLOCK_DTYPE)
+    return rows if len(rows) else None
+
+
+def to_host(rows, millis):
+    # this function maps the millis of a session to host times (epoch ms) with its mapping
+    millis = np.asarray(millis, dtype=np.int64)
+    i = np.maximum(np.searchsorted(rows['board'], millis, side='right') - 1, 0)
+    return rows['host'][i] + (millis - rows['board'][i]) * rows['rate'][i]
+
+
+def merge(paths):
+    # this function reads several sessions and returns their samples as one MERGED_DTYPE
+    # array in host time order, the source column is the index of the path
+    # sessions without a clock mapping can not be placed and raise ValueError
+    parts = []
+    for source, path in enumerate(paths):
+        rows = load_clock(path)
+        if rows is None:
+            raise ValueError(path + " has no clock mapping")
+        millis, values = analysis.load_session(path)
+        part = np.empty(len(millis), dtype=MERGED_DTYPE)
+        part['host'] = to_host(rows, millis)
+        part['millis'] = millis
+        part['value'] = values
+        part['source'] = source
+        parts.append(part)
+    if not parts:
+        return np.empty(0, dtype=MERGED_DTYPE)
+    merged = np.concatenate(parts)
+    return merged[np.argsort(merged['host'], kind='stable')]